@@ -0,0 +1,314 @@
+#! /usr/bin/env python
+"""Checks that a solver engine matches golden outputs of the reference solver.
+
+The golden outputs are solutions of the reference RK4 solver (cl0.solve_system)
+for a curated set of inputs: the defaults, the extremes of the optimiser bounds
+(load_default_params), active thermoregulation and estimated heart volumes.
+Any alternative engine (batched, adaptive, reduced precision, ...) must match
+every case within per-channel and per-metric tolerances before it replaces the
+reference.
+
+An engine is any callable that takes the same inputs as solve_system and
+returns a dictionary of the solution keys, e.g.
+
+    python benchmarks/equivalence.py --engine mypackage.engines:solve_batched
+"""
+
+# Python imports
+import os
+import sys
+import json
+import logging
+import argparse
+import importlib
+from typing import Optional
+
+# Module imports
+import numpy as np
+
+# Local imports
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+from src.cl0 import solve_system, beat_metrics, SOLUTION_KEYS
+from src.opt import load_default_params, _flatten_dict, _unflatten_dict
+
+logger = logging.getLogger(__file__)
+
+GOLDEN_DIR = os.path.join(BASE_DIR, "benchmarks", "golden")
+
+# Every decimate-th sample of the waveforms is stored, metrics are computed
+# from the full solution
+DECIMATE = 4
+
+# Largest root mean square error of each waveform relative to the range of
+# the golden waveform. Valve states switch within a time step, so a small
+# shift in the opening time gives a large error.
+DEFAULT_CHANNEL_TOL = 1e-3
+CHANNEL_TOLERANCES = {
+    'Aortic Valve Status': 2e-2,
+    'Mitral Valve Status': 2e-2,
+    'Pulmonary Valve Status': 2e-2,
+    'Tricuspid Valve Status': 2e-2,
+}
+
+# Largest relative error of each beat metric
+METRIC_TOLERANCES = {
+    "sys": 1e-3,
+    "dia": 1e-3,
+    "map": 1e-3,
+    "sv": 1e-3,
+    "co": 1e-3,
+    "edv": 1e-3,
+    "esv": 1e-3,
+}
+
+
+def _bounds(index: int) -> dict:
+    """Returns every optimiser parameter at its lower (0) or upper (1) bound."""
+    return _unflatten_dict({
+        key: bounds[index] for key, bounds in _flatten_dict(load_default_params()).items()
+    })
+
+
+def load_cases() -> dict:
+    """Returns the inputs of each golden case."""
+    lower, upper = _bounds(0), _bounds(1)
+    lower["generic_params"] = {"est_h_vol": False}
+    upper["generic_params"] = {"est_h_vol": False}
+
+    return {
+        "defaults": {},
+        "lower_bounds": lower,
+        "upper_bounds": upper,
+        "tachycardia": {"generic_params": {"period": 0.5}},
+        "vasodilation": {
+            "thermal_system": {"t_cr": 38.0, "t_sk": 35.5},
+        },
+        "vasoconstriction": {
+            "thermal_system": {"t_cr": 36.5, "t_sk": 30.0},
+        },
+        "vasodilation_upper_bounds": {
+            "thermal_system": {
+                "q_sk_basal": 3, "k_dil": 113, "t_cr": 38.5, "t_sk": 36.0,
+            },
+        },
+        "est_h_vol_off": {"generic_params": {"est_h_vol": False}},
+        "est_h_vol_small": {
+            "generic_params": {"height": 150, "weight": 50, "age": 70, "sex": 0},
+        },
+        "est_h_vol_large": {
+            "generic_params": {"height": 195, "weight": 120, "age": 25, "sex": 1},
+        },
+    }
+
+
+def _metrics(sol: dict) -> dict:
+    """Returns the beat metrics of a solution as floats."""
+    with np.errstate(all="ignore"):
+        return {key: float(value) for key, value in beat_metrics(sol).items()}
+
+
+def generate_golden(
+        directory: str = GOLDEN_DIR,
+        cases: Optional[list] = None,
+        engine=solve_system,
+):
+    """Solves each case with the reference engine and saves the outputs.
+
+    Args:
+        directory (str, optional) : Directory of the golden outputs.
+        cases (list, optional) : Names of the cases to save. If None
+                (default), saves every case.
+        engine (callable, optional) : Engine that produces the golden
+                outputs. Defaults to cl0.solve_system.
+    """
+    os.makedirs(directory, exist_ok=True)
+    all_cases = load_cases()
+    for name in cases if cases is not None else all_cases.keys():
+        inputs = all_cases[name]
+        sol = engine(**inputs)
+        np.savez_compressed(
+            os.path.join(directory, f"{name}.npz"),
+            inputs=json.dumps(inputs),
+            metrics=json.dumps(_metrics(sol)),
+            decimate=DECIMATE,
+            **{key: np.asarray(sol[key])[::DECIMATE] for key in SOLUTION_KEYS},
+        )
+        logger.info(f"Saved golden outputs of {name}.")
+
+
+def compare_case(
+        sol: dict,
+        golden,
+        channel_tol: Optional[dict] = None,
+        metric_tol: Optional[dict] = None,
+) -> dict:
+    """Compares a solution with the golden outputs of a case.
+
+    Args:
+        sol (dict) : Solution of the engine being checked.
+        golden (NpzFile) : Golden outputs, as saved by generate_golden.
+        channel_tol (dict, optional) : Tolerances of each channel, overriding
+                CHANNEL_TOLERANCES.
+        metric_tol (dict, optional) : Tolerances of each metric, overriding
+                METRIC_TOLERANCES.
+
+    Returns:
+        report (dict) : The error and tolerance of each channel ('channels')
+                and metric ('metrics') and whether every one is within its
+                tolerance ('passed').
+    """
+    channel_tol = {**CHANNEL_TOLERANCES, **(channel_tol or dict())}
+    metric_tol = {**METRIC_TOLERANCES, **(metric_tol or dict())}
+    decimate = int(golden["decimate"])
+
+    channels = dict()
+    for key in SOLUTION_KEYS:
+        ref = golden[key]
+        value = np.asarray(sol[key], dtype=np.float64)[::decimate]
+        if value.shape != ref.shape:
+            error = np.inf
+        else:
+            with np.errstate(all="ignore"):
+                error = float(
+                    np.sqrt(np.mean((value - ref) ** 2)) / max(np.ptp(ref), 1e-12)
+                )
+            error = error if np.isfinite(error) else np.inf
+        channels[key] = (error, channel_tol.get(key, DEFAULT_CHANNEL_TOL))
+
+    metrics = dict()
+    ref_metrics = json.loads(str(golden["metrics"]))
+    sol_metrics = _metrics(sol)
+    for key, tol in metric_tol.items():
+        error = abs(sol_metrics[key] - ref_metrics[key]) / abs(ref_metrics[key])
+        metrics[key] = (error if np.isfinite(error) else np.inf, tol)
+
+    passed = all(
+        error <= tol for error, tol in list(channels.values()) + list(metrics.values())
+    )
+    return {"channels": channels, "metrics": metrics, "passed": passed}
+
+
+def check_engine(
+        engine=solve_system,
+        directory: str = GOLDEN_DIR,
+        cases: Optional[list] = None,
+        channel_tol: Optional[dict] = None,
+        metric_tol: Optional[dict] = None,
+) -> dict:
+    """Checks an engine against every golden case.
+
+    Args:
+        engine (callable, optional) : Engine taking the inputs of
+                solve_system. Defaults to cl0.solve_system.
+        directory (str, optional) : Directory of the golden outputs.
+        cases (list, optional) : Names of the cases to check. If None
+                (default), checks every saved case.
+        channel_tol (dict, optional) : Tolerances of each channel.
+        metric_tol (dict, optional) : Tolerances of each metric.
+
+    Returns:
+        reports (dict) : Maps each case to its report, see compare_case.
+    """
+    if cases is None:
+        cases = sorted(
+            f[:-len(".npz")] for f in os.listdir(directory) if f.endswith(".npz")
+        )
+    if not cases:
+        logger.critical(f"No golden outputs found in {directory}.")
+        raise ValueError
+
+    reports = dict()
+    for name in cases:
+        with np.load(os.path.join(directory, f"{name}.npz")) as golden:
+            inputs = json.loads(str(golden["inputs"]))
+            try:
+                with np.errstate(all="ignore"):
+                    sol = engine(**inputs)
+            except Exception as e:
+                logger.error(f"{name} failed: {e!r}")
+                reports[name] = {"channels": {}, "metrics": {}, "passed": False}
+                continue
+            reports[name] = compare_case(sol, golden, channel_tol, metric_tol)
+    return reports
+
+
+def _load_engine(spec: str):
+    """Imports an engine given as 'module:function'."""
+    module, _, func = spec.partition(":")
+    if not func:
+        logger.critical(f"Engine must be given as module:function, got {spec}.")
+        raise ValueError
+    return getattr(importlib.import_module(module), func)
+
+
+def main(args):
+    """Generates the golden outputs or checks an engine against them."""
+
+    if args.generate:
+        generate_golden(args.directory, args.case)
+        print(f"Golden outputs written to {args.directory}")
+        return 0
+
+    reports = check_engine(
+        _load_engine(args.engine), args.directory, args.case,
+    )
+    for name, report in reports.items():
+        print(f"{name:<30} {'passed' if report['passed'] else 'FAILED'}")
+        for group in ("metrics", "channels"):
+            for key, (error, tol) in report[group].items():
+                if args.verbose or error > tol:
+                    print(f"    {key:<35} {error:.2e} (tol {tol:.0e})")
+
+    failed = [name for name, report in reports.items() if not report["passed"]]
+    print(f"{len(reports) - len(failed)}/{len(reports)} cases passed.")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Checks a solver engine against golden reference outputs'
+    )
+
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default="src.cl0:solve_system",
+        help="Engine to check, as module:function.",
+    )
+    parser.add_argument(
+        "--generate",
+        action="store_true",
+        help="Regenerates the golden outputs with the reference solver.",
+    )
+    parser.add_argument(
+        "--case",
+        nargs="+",
+        help="Only uses these cases.",
+    )
+    parser.add_argument(
+        "--directory",
+        type=str,
+        default=GOLDEN_DIR,
+        help="Directory of the golden outputs.",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Prints the error of every channel and metric.",
+    )
+    parser.add_argument(
+        "--log",
+        type=str,
+        default='warning',
+        help="Sets the logging level.",
+    )
+
+    args = parser.parse_args()
+
+    log_level = getattr(logging, args.log.upper())
+    if not isinstance(log_level, int):
+        raise ValueError(f"Invalid log level: {args.log}")
+    logging.basicConfig(level=log_level)
+
+    sys.exit(main(args))
@@ -0,0 +1,305 @@
+#! /usr/bin/env python
+"""Runs the benchmark suite and compares the results against a baseline."""
+
+# Python imports
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import platform
+import resource
+import subprocess
+import tracemalloc
+import multiprocessing as mp
+
+# Module imports
+import numpy as np
+
+# Local imports
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import suite
+from src.cl0 import STATUS_OK
+
+logger = logging.getLogger(__file__)
+
+RESULTS_DIR = os.path.join(BASE_DIR, "benchmarks", "results")
+BASELINE = os.path.join(BASE_DIR, "benchmarks", "baseline.json")
+
+
+def _run_case(case: dict, repeats: int, queue):
+    """Runs a single case and puts its measurements on the queue.
+
+    Runs in a fresh process so the peak memory is that of the case alone.
+    Python allocations are traced in a separate untimed run, as tracing
+    slows every allocation down.
+    """
+    try:
+        func = getattr(suite, case["func"])
+        result = func(**case["params"], repeats=repeats)
+
+        tracemalloc.start()
+        func(**case["params"], repeats=1)
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # ru_maxrss is in kB on Linux
+        result["peak_rss_mb"] = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        ) / 1024
+        result["peak_traced_mb"] = peak_traced / 1024 ** 2
+        queue.put(result)
+    except Exception as e:
+        queue.put({"error": repr(e)})
+
+
+def run_case(case: dict, repeats: int) -> dict:
+    """Runs a case in a fresh process and summarises its times."""
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_run_case, args=(case, repeats, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+
+    record = {
+        "name": case["name"],
+        "group": case["group"],
+        "params": case["params"],
+    }
+    if "error" in result:
+        logger.error(f"{case['name']} failed: {result['error']}")
+        record["error"] = result["error"]
+        return record
+
+    # Solves that diverged were stopped early, so their times are not valid
+    status = result.pop("status", STATUS_OK)
+    record["status"] = int(status)
+    if status != STATUS_OK:
+        logger.warning(f"{case['name']} did not solve (status {status}).")
+
+    times = np.array(result.pop("times"))
+    record.update({
+        "times": times.tolist(),
+        "median": float(np.median(times)),
+        "min": float(np.min(times)),
+        "mean": float(np.mean(times)),
+        "std": float(np.std(times)),
+    })
+    record.update({key: float(value) for key, value in result.items()})
+    return record
+
+
+def _git_revision() -> dict:
+    """Returns the current commit and whether the tree has changes."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=BASE_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+        dirty = bool(subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+    return {"commit": commit, "dirty": dirty}
+
+
+def metadata(args) -> dict:
+    """Describes the machine and code the benchmarks were run on."""
+    return {
+        **_git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": socket.gethostname(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "quick": args.quick,
+        "repeats": args.repeats,
+    }
+
+
+def compare(baseline: dict, results: dict, threshold: float = 1.1) -> list:
+    """Prints a comparison of results against a baseline.
+
+    Args:
+        baseline (dict) : Baseline results as written by this script.
+        results (dict) : Results to compare.
+        threshold (float, optional) : Ratio of median times (or peak
+                memory) above which a case is reported as a regression.
+                Defaults to 1.1.
+
+    Returns:
+        regressions (list) : Names of the cases that regressed.
+    """
+    base = {
+        r["name"]: r for r in baseline["results"]
+        if "error" not in r and r.get("status", STATUS_OK) == STATUS_OK
+    }
+    regressions = []
+
+    print(
+        f"Baseline {baseline['metadata'].get('commit')} "
+        f"({baseline['metadata'].get('timestamp')}) vs "
+        f"{results['metadata'].get('commit')} "
+        f"({results['metadata'].get('timestamp')})"
+    )
+    print(f"{'case':<45} {'baseline':>10} {'current':>10} {'ratio':>7} {'memory':>7}")
+    for result in results["results"]:
+        if "error" in result or result["name"] not in base:
+            continue
+        if result.get("status", STATUS_OK) != STATUS_OK:
+            print(f"{result['name']:<45} skipped, status {result['status']}")
+            continue
+        old = base[result["name"]]
+        ratio = result["median"] / old["median"]
+        memory = result["peak_rss_mb"] / old["peak_rss_mb"]
+
+        status = ""
+        if ratio > threshold or memory > threshold:
+            status = "REGRESSION"
+            regressions.append(result["name"])
+        elif ratio < 1 / threshold:
+            status = "faster"
+        print(
+            f"{result['name']:<45} {old['median']:>10.4g} "
+            f"{result['median']:>10.4g} {ratio:>7.2f} {memory:>7.2f} {status}"
+        )
+
+    missing = set(base) - {r["name"] for r in results["results"]}
+    if missing:
+        print(f"{len(missing)} baseline cases were not run.")
+    return regressions
+
+
+def main(args):
+    """Runs the selected benchmarks and writes the results."""
+
+    if args.compare is not None:
+        with open(args.compare[0], "r") as f:
+            baseline = json.load(f)
+        with open(args.compare[1], "r") as f:
+            results = json.load(f)
+        return 1 if compare(baseline, results, args.threshold) else 0
+
+    cases = suite.cases(quick=args.quick, max_workers=args.max_workers)
+    if args.group is not None:
+        cases = [c for c in cases if c["group"] in args.group]
+    if args.filter is not None:
+        cases = [c for c in cases if args.filter in c["name"]]
+
+    results = {"metadata": metadata(args), "results": []}
+    for case in cases:
+        record = run_case(case, args.repeats)
+        results["results"].append(record)
+        if "error" not in record:
+            print(
+                f"{record['name']:<45} median {record['median']:.4g}s "
+                f"peak {record['peak_rss_mb']:.0f}MB"
+            )
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(
+            RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}.json"
+        )
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        return 1 if compare(baseline, results, args.threshold) else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the solver, wrapper, parallel solves and optimiser'
+    )
+
+    parser.add_argument(
+        "--group",
+        nargs="+",
+        choices=("solve", "wrapper", "parallel", "optimiser", "startup"),
+        help="Only runs these groups of benchmarks.",
+    )
+    parser.add_argument(
+        "--filter",
+        type=str,
+        help="Only runs cases whose name contains this string.",
+    )
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="Runs a reduced set of cases.",
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=5,
+        help="Number of timed repeats of each case.",
+    )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        help="Largest number of workers for the parallel benchmarks.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Path of the results file, defaults to benchmarks/results/.",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=BASELINE,
+        help="Baseline to compare against (if it exists).",
+    )
+    parser.add_argument(
+        "--save_baseline",
+        action="store_true",
+        help="Saves the results as the baseline instead of comparing.",
+    )
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BASELINE", "RESULTS"),
+        help="Compares two results files without running anything.",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.1,
+        help="Slowdown (or memory) ratio reported as a regression.",
+    )
+    parser.add_argument(
+        "--log",
+        type=str,
+        default='warning',
+        help="Sets the logging level.",
+    )
+
+    args = parser.parse_args()
+
+    log_level = getattr(logging, args.log.upper())
+    if not isinstance(log_level, int):
+        raise ValueError(f"Invalid log level: {args.log}")
+    logging.basicConfig(level=log_level)
+
+    sys.exit(main(args))
@@ -0,0 +1,252 @@
+#! /usr/bin/env python
+"""Benchmarks of the solver, its wrapper, parallel solves and the optimiser.
+
+Each benchmark takes its parameters and the number of repeats and returns a
+dictionary with the wall time of each repeat ('times') along with any derived
+throughput measures. Benchmarks are run (each in a fresh process) by
+run_benchmarks.py.
+"""
+
+# Python imports
+import os
+import sys
+import time
+import subprocess
+import ctypes as ct
+
+# Module imports
+import numpy as np
+
+# Local imports
+from src import solve_system, solve_system_parallel, Optimiser
+from src.cl0 import (
+    load_library, NUM_STATES, NUM_SENSITIVITIES, SolverStats,
+    _format_solver_inputs, _pack_solver_inputs,
+)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Statements timed in a fresh interpreter by the startup benchmarks
+STARTUP_STATEMENTS = {
+    "import": "import src",
+    "solve_system": (
+        "from src import solve_system\n"
+        "solve_system(generic_params={{'nstep': 2000, 'ncycle': 1}})"
+    ),
+    "optimiser": "from src import Optimiser",
+    "spawn_pool": (
+        "import multiprocessing as mp\n"
+        "from src.cl0 import load_defaults\n"
+        "pool = mp.get_context('spawn').Pool({num_workers}, initializer=load_defaults)\n"
+        "pool.close()\n"
+        "pool.join()"
+    ),
+}
+
+# Parameters optimised in the optimiser benchmarks
+OPTIMISER_PARAMS = {
+    "generic_params": {
+        "r_scale": [0.5, 2, 1],
+        "c_scale": [0.5, 2, 1],
+        "e_scale": [0.5, 2, 1],
+    },
+}
+
+
+def _timed(func, *args, **kwargs) -> float:
+    """Returns the wall time (s) of a function call."""
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def solve_latency(nstep: int, ncycle: int, rk: int, repeats: int = 5) -> dict:
+    """Latency of a single solve_system call.
+
+    The status of the solve is returned, as a solve that diverges is stopped
+    early and its time is not comparable.
+    """
+    inputs = {"generic_params": {"nstep": nstep, "ncycle": ncycle, "rk": rk}}
+    sol = solve_system(**inputs)
+
+    times = [_timed(solve_system, **inputs) for _ in range(repeats)]
+    return {
+        "times": times,
+        "steps_per_s": nstep * ncycle / np.median(times),
+        "status": sol.metadata["status"],
+    }
+
+
+def wrapper_breakdown(nstep: int, ncycle: int, repeats: int = 5) -> dict:
+    """Splits a solve into formatting, packing and Fortran time."""
+    inputs = {"generic_params": {"nstep": nstep, "ncycle": ncycle}}
+    sol = solve_system(**inputs)
+    formatted = _format_solver_inputs(**inputs)
+
+    def fortran():
+        sol_out = np.zeros((31, nstep), order='F', dtype=np.float64)
+        state = np.zeros(NUM_STATES, dtype=np.float64)
+        sens_params = np.zeros(1, dtype=np.int32)
+        sens_out = np.zeros((NUM_SENSITIVITIES, nstep, 1), order='F', dtype=np.float64)
+        args = _pack_solver_inputs(formatted)
+        fortlib = load_library()
+        start = time.perf_counter()
+        fortlib.solve_system(
+            *args,
+            sol_out.ctypes.data_as(ct.POINTER(ct.c_double)),
+            ct.c_int(0),
+            state.ctypes.data_as(ct.POINTER(ct.c_double)),
+            ct.c_int(0),
+            sens_params.ctypes.data_as(ct.POINTER(ct.c_int)),
+            sens_out.ctypes.data_as(ct.POINTER(ct.c_double)),
+            ct.c_int(0),
+            ct.byref(SolverStats()),
+            ct.c_int(50),
+            ct.byref(ct.c_int()),
+        )
+        return time.perf_counter() - start
+
+    times = [_timed(solve_system, **inputs) for _ in range(repeats)]
+    format_s = np.median([
+        _timed(_format_solver_inputs, **inputs) for _ in range(repeats)
+    ])
+    pack_s = np.median([
+        _timed(_pack_solver_inputs, formatted) for _ in range(repeats)
+    ])
+    fortran_s = np.median([fortran() for _ in range(repeats)])
+    total_s = np.median(times)
+    return {
+        "times": times,
+        "format_s": format_s,
+        "pack_s": pack_s,
+        "fortran_s": fortran_s,
+        "overhead_s": total_s - fortran_s,
+        "overhead_fraction": (total_s - fortran_s) / total_s,
+        "status": sol.metadata["status"],
+    }
+
+
+def parallel_scaling(num_workers: int, num_tasks: int, repeats: int = 3) -> dict:
+    """Throughput of solve_system_parallel with a number of workers."""
+    param_list = [
+        {"generic_params": {"r_scale": 0.8 + 0.4 * i / num_tasks}}
+        for i in range(num_tasks)
+    ]
+
+    times = [
+        _timed(solve_system_parallel, param_list, num_workers)
+        for _ in range(repeats)
+    ]
+    return {
+        "times": times,
+        "solves_per_s": num_tasks / np.median(times),
+    }
+
+
+def optimiser_throughput(num_workers: int, budget: int, repeats: int = 3) -> dict:
+    """Evaluations per second of the optimiser."""
+
+    def run():
+        opt = Optimiser(
+            optimiser="TwoPointsDE",
+            params=OPTIMISER_PARAMS,
+            pbar=False,
+            budget=budget,
+            num_workers=num_workers,
+        )
+        opt.run(sbp=120, dbp=80)
+
+    times = [_timed(run) for _ in range(repeats)]
+    return {
+        "times": times,
+        "evaluations_per_s": budget / np.median(times),
+    }
+
+
+def startup(statement: str, num_workers: int = 1, repeats: int = 5) -> dict:
+    """Wall time of a fresh interpreter running a startup statement.
+
+    Measures what short-lived scripts and spawned workers pay before doing
+    any work, e.g. importing the package or starting a pool of spawned
+    workers that each import the solver.
+    """
+    code = STARTUP_STATEMENTS[statement].format(num_workers=num_workers)
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=BASE_DIR, check=True)
+        times.append(time.perf_counter() - start)
+    return {"times": times}
+
+
+def cases(quick: bool = False, max_workers: int = None) -> list:
+    """Returns every benchmark case.
+
+    Args:
+        quick (bool, optional) : If True, uses a reduced set of cases.
+                Defaults to False.
+        max_workers (int, optional) : Largest number of workers for the
+                parallel benchmarks. If None (default), uses every core.
+
+    Returns:
+        cases (list) : Each case is a dictionary of its name ('name'), group
+                ('group'), the name of the benchmark function in this module
+                ('func') and its parameters ('params').
+    """
+    max_workers = max_workers if max_workers is not None else os.cpu_count()
+    workers = sorted({1, max_workers} | {
+        2 ** i for i in range(1, max_workers.bit_length()) if 2 ** i < max_workers
+    })
+
+    # The explicit solver diverges with fewer steps (and with rk=2 below
+    # around 3000 steps), and diverging solves are stopped early
+    nsteps = (2000, 4000) if quick else (2000, 3000, 4000)
+    ncycles = (1, 10) if quick else (1, 5, 10)
+
+    all_cases = []
+    for nstep in nsteps:
+        for ncycle in ncycles:
+            for rk in ((2, 4) if nstep >= 4000 else (4,)):
+                all_cases.append({
+                    "name": f"solve[nstep={nstep},ncycle={ncycle},rk={rk}]",
+                    "group": "solve",
+                    "func": "solve_latency",
+                    "params": {"nstep": nstep, "ncycle": ncycle, "rk": rk},
+                })
+
+    for nstep in nsteps:
+        all_cases.append({
+            "name": f"wrapper[nstep={nstep},ncycle=1]",
+            "group": "wrapper",
+            "func": "wrapper_breakdown",
+            "params": {"nstep": nstep, "ncycle": 1},
+        })
+
+    num_tasks = 16 if quick else 64
+    for num_workers in workers:
+        all_cases.append({
+            "name": f"parallel[workers={num_workers},tasks={num_tasks}]",
+            "group": "parallel",
+            "func": "parallel_scaling",
+            "params": {"num_workers": num_workers, "num_tasks": num_tasks},
+        })
+
+    budget = 20 if quick else 100
+    for num_workers in sorted({1, max_workers}):
+        all_cases.append({
+            "name": f"optimiser[workers={num_workers},budget={budget}]",
+            "group": "optimiser",
+            "func": "optimiser_throughput",
+            "params": {"num_workers": num_workers, "budget": budget},
+        })
+
+    for statement in STARTUP_STATEMENTS:
+        all_cases.append({
+            "name": f"startup[{statement}]",
+            "group": "startup",
+            "func": "startup",
+            "params": {"statement": statement, "num_workers": max_workers},
+        })
+
+    return all_cases
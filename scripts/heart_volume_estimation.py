@@ -33,7 +33,10 @@ def main():
             {"generic_params": {variable: x}} for x in v_list
         ]
 
-        sol_list = solve_system_parallel(param_list)
+        # Solutions are written to an archive on disk and read back lazily
+        sol_list = solve_system_parallel(
+            param_list, archive=f"analysis/archives/varried_{variable}",
+        )
 
         match variable.lower():
             case "height":
@@ -2,8 +2,10 @@
 """Sequentially optimisation entries from a database."""
 
 # Python imports
+import os
 import sys
 import logging
+import argparse
 
 # Module imports
 import numpy as np
@@ -12,13 +14,23 @@ from tqdm import tqdm
 import sqlite3
 
 # Local imports
-from src import solve_system, Optimiser
+from src import Optimiser
+from src.checkpoint import save_state, load_state, remove_state
+from src.sink import ResultsSink
+from src.ingest import (
+    apply_rules, to_param_list, ECG_INTERVAL_RULES, THERMAL_RULES,
+)
 
 logger = logging.getLogger(__file__)
 
 
-def main():
-    """Main script for optimisation against csv records. """
+def main(checkpoint_dir=None):
+    """Main script for optimisation against csv records.
+
+    If checkpoint_dir is supplied, the row cursor along with the state carried
+    between rows and the state of the current optimisation are periodically
+    saved there so a killed job can be rerun and resume.
+    """
 
     db_path = "../heat_response/data/exercise/processed_data.sqlite3"
     con = sqlite3.connect(db_path)
@@ -34,6 +46,12 @@ def main():
 
     cursor.execute(f"SELECT {', '.join(col_names)} FROM {table}")
     df = pd.DataFrame(cursor.fetchall(), columns=col_names)
+    con.close()
+
+    # Model inputs for every row, with the ECG timings from the intervals
+    input_list = to_param_list(
+        apply_rules(df, {**ECG_INTERVAL_RULES, **THERMAL_RULES})
+    )
 
     prev = {
         'id': None,
@@ -45,7 +63,29 @@ def main():
         'c_scale': 1,
     }
 
-    for i in tqdm(range(df.shape[0]), position=0, file=sys.stdout, leave=True):
+    # Resumes from the row cursor (if checkpointing)
+    first_row = 0
+    if checkpoint_dir is not None:
+        cursor_path = os.path.join(checkpoint_dir, f"{out_table_name}.cursor")
+        cursor = load_state(cursor_path)
+        if cursor is not None:
+            first_row = cursor["row"]
+            prev = cursor["prev"]
+            prev_loss = cursor["prev_loss"]
+            params = cursor["params"]
+            logger.info(f"Resuming from row {first_row} of {df.shape[0]}.")
+
+    # All results are written by a single writer in batched transactions
+    sink = ResultsSink(db_path, out_table_name, replace=first_row == 0)
+
+    for i in tqdm(
+            range(first_row, df.shape[0]),
+            initial=first_row,
+            total=df.shape[0],
+            position=0,
+            file=sys.stdout,
+            leave=True,
+    ):
 
         ########################
         # Sets up model inputs #
@@ -87,29 +127,11 @@ def main():
 
             new_pid = False
 
-        default_inputs = {
-            'generic_params': {
-                'period': 60/row['hr'],
-            },
-            'ecg': {
-                "t1": row['pr'] / 3,
-                "t2": row['pr'] + row['qrs']/2,
-                "t3": row['pr'] + row['qrs'] + 0.75 * (row['qt'] - row['qrs']),
-                "t4": row['pr'] + row['qt'],
-            },
-            'thermal_system': {
-                't_cr': row['core'],
-                't_cr_ref': row['core_ref'],
-                't_sk': row['skin'],
-                't_sk_ref': row['skin_ref'],
-            },
-        }
-
         ###################################################
         # Optimises for blood pressure and stroke volume  #
         ###################################################
 
-        inputs = default_inputs
+        inputs = input_list[i]
 
         params = {
             "generic_params": {
@@ -128,6 +150,12 @@ def main():
         else:
             inputs['generic_params']['v_scale'] = prev['v_scale']
 
+        opt_checkpoint = None
+        if checkpoint_dir is not None:
+            opt_checkpoint = os.path.join(
+                checkpoint_dir, f"{out_table_name}.row_{i}.opt"
+            )
+
         opt = Optimiser(
             optimiser="TwoPointsDE",
             inputs=inputs,
@@ -136,53 +164,43 @@ def main():
             num_workers=16,
             multi_objective=True,
             tol=1e-3,
+            stagnation_window=100,
             pbar=True,
             pbar_pos=1,
+            checkpoint=opt_checkpoint,
         )
 
-        best_params = opt.run(sbp=row['sys'], dbp=row['dia'], sv=row['sv'])
+        best_params, results = opt.run(
+            sbp=row['sys'], dbp=row['dia'], sv=row['sv'], return_results=True,
+        )
 
         #####################
         # Saves the results #
         #####################
 
-        for j, best_p in enumerate(best_params):
-            sol = solve_system(**best_p)
-
-            systolic, diastolic = opt.get_systemic_sysdia_pres(sol)
-            sv = opt.get_stroke_volume(sol)
-            loss = (
-                np.abs(systolic - row['sys']) / row['sys']
-                + np.abs(diastolic - row['dia']) / row['dia']
-                + np.abs(sv - row['sv']) / row['sv']
-            )
+        # Metrics were recorded during the optimisation, no need to re-solve
+        for j, (best_p, result) in enumerate(zip(best_params, results)):
+            loss = result['loss_sbp'] + result['loss_dbp'] + result['loss_sv']
 
             outputs = {
                 'id': row['id'],
                 'temp': row['temp'],
                 't': row['t'],
-                'sys': systolic,
+                'sys': result['sys'],
                 'sys_target': row['sys'],
-                'dia': diastolic,
+                'dia': result['dia'],
                 'dia_target': row['dia'],
-                'sv': sv,
+                'sv': result['sv'],
                 'sv_target': row['sv'],
                 'loss': loss,
                 **opt.flat_inputs_raw,
                 **opt.recommendation[j],
             }
 
+            sink.put(outputs)
             if i == 0 and j == 0:
-                pd.DataFrame([outputs]).to_sql(
-                    out_table_name, con, if_exists='replace', index=False,
-                )
                 prev_loss = loss
 
-            else:
-                pd.DataFrame([outputs]).to_sql(
-                    out_table_name, con, if_exists='append', index=False,
-                )
-
             if loss <= prev_loss:
                 for d in list(params.keys()):
                     for param in list(params[d].keys()):
@@ -192,8 +210,44 @@ def main():
                         else:
                             prev[param] = best_p[d][param]
 
+        # Advances the row cursor once the results are safely written
+        if checkpoint_dir is not None:
+            sink.flush()
+            save_state(cursor_path, {
+                "row": i + 1,
+                "prev": prev,
+                "prev_loss": prev_loss,
+                "params": params,
+            })
+            remove_state(opt_checkpoint)
+
         tqdm._instances.clear()
 
+    sink.close()
+
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(
+        description='Sequentially optimises entries from a database'
+    )
+
+    parser.add_argument(
+        "--checkpoint_dir",
+        type=str,
+        help="Directory for checkpoints, allows killed jobs to be resumed.",
+    )
+    parser.add_argument(
+        "--log",
+        type=str,
+        default='warning',
+        help="Sets the logging level.",
+    )
+
+    args = parser.parse_args()
+
+    log_level = getattr(logging, args.log.upper())
+    if not isinstance(log_level, int):
+        raise ValueError(f"Invalid log level: {args.log}")
+    logging.basicConfig(level=log_level)
+
+    main(checkpoint_dir=args.checkpoint_dir)
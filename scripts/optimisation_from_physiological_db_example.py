@@ -2,6 +2,7 @@
 """Sequentially optimisation entries from a database."""
 
 # Python imports
+import os
 import sys
 import logging
 import argparse
@@ -10,15 +11,35 @@ import traceback
 import sqlite3
 
 # Module imports
-import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
 # Local imports
-from src import solve_system, Optimiser
+from src import Optimiser
+from src.checkpoint import save_state, load_state, remove_state
+from src.sink import ResultsSink
+from src.work_queue import WorkQueue
+from src.manifest import CalibrationManifest
+from src.telemetry import Telemetry
+from src.ingest import (
+    apply_rules, to_param_list, ECG_TEMPLATE_RULES, HEART_VOLUME_RULES,
+)
 
 logger = logging.getLogger(__file__)
 
+# Model inputs of each patient, the ECGs are fixed and scaled from a sample
+# patient
+PATIENT_RULES = {**ECG_TEMPLATE_RULES, **HEART_VOLUME_RULES}
+
+# Variable parameters of the optimisation
+PARAMS = {
+    "generic_params": {
+        "r_scale": [0.1, 10, 1.5],
+        "c_scale": [0.1, 10, 0.5],
+        'e_scale': [0.25, 4, 2.0],
+    },
+}
+
 
 def execute_sql_concurrently(db_path, query, fetchone=False, max_tries=0, timeout=10):
     """Executes an SQL command concurrently 
@@ -68,8 +89,227 @@ def execute_sql_concurrently(db_path, query, fetchone=False, max_tries=0, timeou
 
 
 
-def main(num_workers=None, start=None, total=None, replace_table=False, budget=1000):
-    """Main script for optimisation against db records. """
+def optimise_patient(
+        row,
+        inputs,
+        num_workers,
+        budget=1000,
+        stagnation_window=100,
+        opt_checkpoint=None,
+        telemetry=None,
+        timeout=None,
+):
+    """Optimises the model against a single patient.
+
+    Args:
+        row (pd.Series) : Patient record.
+        inputs (dict) : Fixed model inputs of the patient.
+        num_workers (int) : Number of workers for the optimisation.
+        budget (int, optional) : Optimisation budget. Defaults to 1000.
+        stagnation_window (int, optional) : Stops the optimisation once the
+                Pareto front has not improved for this many evaluations.
+                Defaults to 100.
+        opt_checkpoint (str, optional) : Path to checkpoint the optimisation to.
+        telemetry (Telemetry, optional) : Records the throughput of the run.
+        timeout (float, optional) : Wall clock time (s) each solve may take
+                before its worker is killed and the candidate penalised.
+
+    Returns:
+        rows (list) : Output rows, one per member of the Pareto front.
+    """
+
+    ###################################################
+    # Optimises for blood pressure and stroke volume  #
+    ###################################################
+
+    params = PARAMS
+
+    logger.debug(
+        f"Beginning optimisation of patient {row['row_names']} with variable "
+        f"parameters:\n{params}\n and fixed inputs:\n{inputs}"
+    )
+
+    opt = Optimiser(
+        optimiser="TwoPointsDE",
+        inputs=inputs,
+        params=params,
+        budget=budget,
+        num_workers=num_workers,
+        multi_objective=True,
+        tol=1e-3,
+        stagnation_window=stagnation_window,
+        pbar=False,
+        checkpoint=opt_checkpoint,
+        telemetry=telemetry,
+        timeout=timeout,
+        telemetry_name=str(row['row_names']),
+    )
+
+    best_params, results = opt.run(
+        sbp=row['sbp'], dbp=row['dbp'], return_results=True,
+    )
+
+    if opt.failures:
+        logger.warning(
+            f"{len(opt.failures)} solves of patient {row['row_names']} timed "
+            "out or failed and were penalised."
+        )
+
+    logger.debug(
+        f"Optimisation for patient {row['row_names']} has been completed."
+    )
+
+    # Metrics were recorded during the optimisation, no need to re-solve
+    rows = []
+    for j, result in enumerate(results):
+        rows.append({
+            'row_names': row['row_names'],
+            'sys': result['sys'],
+            'sys_target': row['sbp'],
+            'dia': result['dia'],
+            'dia_target': row['dbp'],
+            'sv': result['sv'],
+            'loss': result['loss_sbp'] + result['loss_dbp'],
+            **opt.flat_inputs_raw,
+            **opt.recommendation[j],
+        })
+    return rows
+
+
+def calibrate_incremental(
+        df,
+        input_list,
+        manifest_path,
+        db_path,
+        out_table_name,
+        num_workers,
+        replace_table=False,
+        budget=1000,
+        checkpoint_dir=None,
+        stagnation_window=100,
+        telemetry=None,
+        timeout=None,
+):
+    """Optimises only the patients whose inputs have not been calibrated.
+
+    Each patient is hashed from its resolved inputs, targets and the optimiser
+    configuration. Patients already written with the same hash are skipped,
+    patients whose hash has stored results are written from the manifest and
+    patients sharing the same new hash are optimised once with the results
+    written for all of them.
+    """
+    config = {
+        "optimiser": "TwoPointsDE",
+        "params": PARAMS,
+        "budget": budget,
+        "tol": 1e-3,
+        "stagnation_window": stagnation_window,
+    }
+    manifest = CalibrationManifest(manifest_path, config)
+    if replace_table:
+        manifest.forget_rows()
+
+    hashes = {
+        row['row_names']: manifest.hash(
+            inputs, {"sbp": row['sbp'], "dbp": row['dbp']},
+        )
+        for (_, row), inputs in zip(df.iterrows(), input_list)
+    }
+    pending, cached, num_unchanged = manifest.plan(hashes)
+
+    # Removes old (or partially written) results of the rows to be written
+    rewrite = [r for rows in (*pending.values(), *cached.values()) for r in rows]
+    if rewrite and not replace_table:
+        con = sqlite3.connect(db_path, timeout=60)
+        if con.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+                (out_table_name,),
+        ).fetchone() is not None:
+            con.executemany(
+                f"DELETE FROM {out_table_name} WHERE row_names = ?",
+                ((int(r),) for r in rewrite),
+            )
+            con.commit()
+        con.close()
+
+    sink = ResultsSink(
+        db_path, out_table_name, index=["row_names"], replace=replace_table,
+    )
+
+    def write(h, results, row_ids):
+        """Writes the results of a calibration for every row sharing it."""
+        sink.put_many(
+            {**result, 'row_names': row_id}
+            for row_id in row_ids for result in results
+        )
+        sink.flush()
+        manifest.mark_written(row_ids, h)
+
+    for h, row_ids in cached.items():
+        write(h, manifest.results(h), row_ids)
+
+    position = {row_name: i for i, row_name in enumerate(df['row_names'])}
+    for h, row_ids in tqdm(
+            pending.items(),
+            total=len(pending),
+            position=0,
+            file=sys.stdout,
+            leave=True,
+    ):
+        i = position[row_ids[0]]
+
+        opt_checkpoint = None
+        if checkpoint_dir is not None:
+            opt_checkpoint = os.path.join(checkpoint_dir, f"calibration_{h}.opt")
+
+        results = optimise_patient(
+            df.iloc[i],
+            input_list[i],
+            num_workers,
+            budget=budget,
+            stagnation_window=stagnation_window,
+            opt_checkpoint=opt_checkpoint,
+            telemetry=telemetry,
+            timeout=timeout,
+        )
+        manifest.record(h, results)
+        write(h, results, row_ids)
+
+        if opt_checkpoint is not None:
+            remove_state(opt_checkpoint)
+        tqdm._instances.clear()
+
+    sink.close()
+    manifest.close()
+
+
+def main(
+        num_workers=None,
+        start=None,
+        total=None,
+        replace_table=False,
+        budget=1000,
+        checkpoint_dir=None,
+        stagnation_window=100,
+        manifest=None,
+        telemetry=None,
+        timeout=None,
+):
+    """Main script for optimisation against db records.
+
+    If checkpoint_dir is supplied, the index of the next row to process and
+    the state of the current optimisation are periodically saved there so a
+    killed job can be resubmitted with the same arguments and resume.
+
+    If manifest is supplied, only patients whose inputs have changed since
+    the last run are optimised (see calibrate_incremental).
+
+    If telemetry is supplied, the throughput of the run is periodically
+    written to that path (JSON, or the Prometheus text format for ".prom").
+
+    If timeout is supplied, solves that take longer are killed and penalised
+    rather than stalling the optimisation.
+    """
 
     # Sets up the parallel optimisation
     num_cores = mp.cpu_count()
@@ -114,117 +354,216 @@ def main(num_workers=None, start=None, total=None, replace_table=False, budget=1
 
     logger.debug(f"Sucessfully loaded database {db_path} with shape {df.shape}")
 
-    for i in tqdm(range(df.shape[0]), position=0, file=sys.stdout, leave=True):
+    # Model inputs for every patient
+    input_list = to_param_list(apply_rules(df, PATIENT_RULES))
+
+    if telemetry is not None:
+        telemetry = Telemetry(
+            telemetry, num_patients=df.shape[0], num_workers=num_workers,
+        )
+
+    if manifest is not None:
+        calibrate_incremental(
+            df,
+            input_list,
+            manifest,
+            db_path,
+            out_table_name,
+            num_workers,
+            replace_table=replace_table,
+            budget=budget,
+            checkpoint_dir=checkpoint_dir,
+            stagnation_window=stagnation_window,
+            telemetry=telemetry,
+            timeout=timeout,
+        )
+        if telemetry is not None:
+            telemetry.close()
+        return
+
+    # Resumes from the row cursor (if checkpointing)
+    first_row = 0
+    if checkpoint_dir is not None:
+        job_name = os.path.join(checkpoint_dir, f"job_{start}_{total}")
+        cursor_path = f"{job_name}.cursor"
+        first_row = load_state(cursor_path, default={"row": 0})["row"]
+        if first_row > 0:
+            logger.info(f"Resuming from row {first_row} of {df.shape[0]}.")
+
+    # All results are written by a single writer, never blocking the workers
+    sink = ResultsSink(
+        db_path,
+        out_table_name,
+        index=["row_names"],
+        replace=replace_table and first_row == 0,
+    )
 
-        ########################
-        # Sets up model inputs #
-        ########################
+    for i in tqdm(
+            range(first_row, df.shape[0]),
+            initial=first_row,
+            total=df.shape[0],
+            position=0,
+            file=sys.stdout,
+            leave=True,
+    ):
 
         row = df.iloc[i]
 
-        default_inputs = {
-            'generic_params': {
-                'period': 60/row['hr'],
-                'est_h_vol': True,
-                'height': row['height'],
-                'weight': row['weight'],
-                'age': row['age'],
-                'sex': 0 if row['sex'] == 'Male' else 1,
-            },
-            'ecg': {  # These ECGs are fixed and scaled from a sample patient.
-                "t1": 0.044 * 76 / row['hr'],
-                "t2": 0.184 * 76 / row['hr'],
-                "t3": 0.500 * 76 / row['hr'],
-                "t4": 0.588 * 76 / row['hr'],
-            },
-        }
-
-        ###################################################
-        # Optimises for blood pressure and stroke volume  #
-        ###################################################
-
-        inputs = default_inputs
-
-        params = {
-            "generic_params": {
-                "r_scale": [0.1, 10, 1.5],
-                "c_scale": [0.1, 10, 0.5],
-                'e_scale': [0.25, 4, 2.0],
-            },
-        }
-
-        logger.debug(
-            f"Beginning optimisation of patient {i} with variable parameters:\n"
-            f"{params}\n and fixed inputs:\n{inputs}"
-        )
+        opt_checkpoint = None
+        if checkpoint_dir is not None:
+            opt_checkpoint = f"{job_name}.row_{row['row_names']}.opt"
 
-        opt = Optimiser(
-            optimiser="TwoPointsDE",
-            inputs=inputs,
-            params=params,
+        rows = optimise_patient(
+            row,
+            input_list[i],
+            num_workers,
             budget=budget,
-            num_workers=num_workers,
-            multi_objective=True,
-            tol=1e-3,
-            pbar=False,
+            stagnation_window=stagnation_window,
+            opt_checkpoint=opt_checkpoint,
+            telemetry=telemetry,
+            timeout=timeout,
         )
 
-        best_params = opt.run(sbp=row['sbp'], dbp=row['dbp'])
+        sink.put_many(rows)
+        logger.debug(f"Pareto Front for patient {i} has been queued for writing.")
+
+        # Advances the row cursor once the results are safely written
+        if checkpoint_dir is not None:
+            sink.flush()
+            save_state(cursor_path, {"row": i + 1})
+            remove_state(opt_checkpoint)
 
-        logger.debug(f"Optimisation for patient {i} has been completed.")
+        tqdm._instances.clear()
 
-        #####################
-        # Saves the results #
-        #####################
+    sink.close()
+    if telemetry is not None:
+        telemetry.close()
+
+
+def main_queue(
+        queue_path,
+        num_workers=None,
+        replace_table=False,
+        budget=1000,
+        checkpoint_dir=None,
+        stagnation_window=100,
+        lease=3600,
+        max_attempts=3,
+        telemetry=None,
+        timeout=None,
+):
+    """Optimises patients claimed from a shared work queue.
+
+    Every job adds all of the patients to the queue (patients already in the
+    queue are ignored) and then claims patients one at a time until none are
+    left, so faster nodes simply process more patients. A patient is only
+    marked as done once its results are written. If a job is killed, its
+    patient is reclaimed once the lease expires and, if checkpoint_dir is
+    supplied, the optimisation resumes from its checkpoint. The lease is
+    renewed while the patient is optimised, so a patient taking longer than
+    the lease is not reclaimed by another job.
+
+    If telemetry is supplied, the throughput of the job and the depth of the
+    queue are periodically written to that path.
+    """
 
-        frames = []
-        for j, best_p in enumerate(best_params):
-            sol = solve_system(**best_p)
+    # Sets up the parallel optimisation
+    num_cores = mp.cpu_count()
+    num_workers = min(
+        num_cores,
+        num_workers if num_workers is not None else num_cores
+    )
 
-            systolic, diastolic = opt.get_systemic_sysdia_pres(sol)
-            sv = opt.get_stroke_volume(sol)
-            loss = (
-                np.abs(systolic - row['sbp']) / row['sbp']
-                + np.abs(diastolic - row['dbp']) / row['dbp']
+    db_path = "physiological.db"
+    col_names = (
+        "row_names", "hr", "sex", "age", "sbp", "dbp", "height", "weight"
+    )
+    table = 'literature_relations'
+    out_table_name = 'lumped_model_outputs'
+
+    queue = WorkQueue(queue_path, lease=lease, max_attempts=max_attempts)
+    query = f"SELECT row_names FROM {table}"
+    num_added = queue.add([r[0] for r in execute_sql_concurrently(db_path, query)])
+    logger.debug(f"Added {num_added} patients to the work queue {queue_path}.")
+
+    sink = ResultsSink(
+        db_path,
+        out_table_name,
+        index=["row_names"],
+        replace=replace_table and num_added > 0,
+    )
+
+    progress = queue.progress()
+    if telemetry is not None:
+        telemetry = Telemetry(telemetry, num_workers=num_workers)
+        telemetry.set_queue(progress)
+    pbar = tqdm(
+        initial=progress["done"],
+        total=progress["total"],
+        position=0,
+        file=sys.stdout,
+        leave=True,
+    )
+
+    for row_name in queue:
+        try:
+            query = (
+                f"SELECT {', '.join(col_names)} FROM {table} "
+                f"WHERE row_names = {row_name}"
+            )
+            patient = pd.DataFrame(
+                execute_sql_concurrently(db_path, query), columns=col_names,
             )
+            row = patient.iloc[0]
+            inputs = to_param_list(apply_rules(patient, PATIENT_RULES))[0]
 
-            outputs = {
-                'row_names': row['row_names'],
-                'sys': systolic,
-                'sys_target': row['sbp'],
-                'dia': diastolic,
-                'dia_target': row['dbp'],
-                'sv': sv,
-                'loss': loss,
-                **opt.flat_inputs_raw,
-                **opt.recommendation[j],
-            }
-            frames.append(pd.DataFrame([outputs]))
-
-
-        if replace_table:
-            if_exists = 'replace'
-        else:
-            if_exists = 'append'
-
-        best_df = pd.concat(frames, ignore_index=True, sort=False)
-
-        db_write_sucessful = False
-        logger.debug("Attempting to write Pareto Frontier to database ...")
-        while not db_write_sucessful:
-            try:
-                con = sqlite3.connect(db_path, timeout=10)
-                best_df.to_sql(
-                    out_table_name, con, if_exists=if_exists, index=False,
+            opt_checkpoint = None
+            if checkpoint_dir is not None:
+                opt_checkpoint = os.path.join(
+                    checkpoint_dir, f"row_{row_name}.opt"
                 )
-                db_write_sucessful = True
-                con.close()
-            except sqlite3.OperationalError or pd.errors.DatabaseError:
-                logger.debug(traceback.print_exc())
-        logger.debug(f"Pareto Front for patient {i} has been written to the database!")
 
+            # Renews the lease so a long optimisation is not reclaimed
+            with queue.heartbeat([row_name]):
+                rows = optimise_patient(
+                    row,
+                    inputs,
+                    num_workers,
+                    budget=budget,
+                    stagnation_window=stagnation_window,
+                    opt_checkpoint=opt_checkpoint,
+                    telemetry=telemetry,
+                    timeout=timeout,
+                )
+
+                sink.put_many(rows)
+                sink.flush()
+
+        except Exception:
+            logger.critical(f"Optimisation of patient {row_name} failed.")
+            queue.fail([row_name], traceback.format_exc())
+            continue
+
+        queue.complete([row_name])
+        if opt_checkpoint is not None:
+            remove_state(opt_checkpoint)
+
+        progress = queue.progress()
+        if telemetry is not None:
+            telemetry.set_queue(progress)
+        pbar.total = progress["total"]
+        pbar.n = progress["done"]
+        pbar.set_postfix(claimed=progress["claimed"], failed=progress["failed"])
+        pbar.refresh()
         tqdm._instances.clear()
 
+    sink.close()
+    pbar.close()
+    if telemetry is not None:
+        telemetry.close()
+    logger.info(f"Work queue {queue_path} is empty: {queue.progress()}")
+    queue.close()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -253,6 +592,71 @@ if __name__ == '__main__':
         help="Replaces the existing SQLite3 table.",
         action="store_true"
     )
+    parser.add_argument(
+        "--checkpoint_dir",
+        type=str,
+        help="Directory for checkpoints, allows killed jobs to be resumed.",
+    )
+    parser.add_argument(
+        "--stagnation_window",
+        type=int,
+        default=100,
+        help=(
+            "Stops an optimisation once the Pareto front has not improved "
+            "for this many evaluations, 0 disables."
+        ),
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        help=(
+            "Path to a calibration manifest database. If supplied, only "
+            "patients whose inputs have changed since the last run are "
+            "optimised and patients with identical inputs are optimised once."
+        ),
+    )
+    parser.add_argument(
+        "--work_queue",
+        type=str,
+        help=(
+            "Path to a shared work queue database. If supplied, patients are "
+            "claimed from the queue rather than split by --start and --total."
+        ),
+    )
+    parser.add_argument(
+        "--lease",
+        type=float,
+        default=3600,
+        help=(
+            "Time (s) a job has to finish a claimed patient before it is "
+            "given to another job (work queue only)."
+        ),
+    )
+    parser.add_argument(
+        "--max_attempts",
+        type=int,
+        default=3,
+        help=(
+            "Number of times a patient is claimed before it is marked as "
+            "failed (work queue only)."
+        ),
+    )
+    parser.add_argument(
+        "--telemetry",
+        type=str,
+        help=(
+            "Path to periodically write the throughput of the job to, as "
+            "JSON or in the Prometheus text format if it ends in .prom."
+        ),
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help=(
+            "Wall clock time (s) each solve may take before its worker is "
+            "killed and the candidate is penalised."
+        ),
+    )
     parser.add_argument(
         "--log",
         type=str,
@@ -267,9 +671,28 @@ if __name__ == '__main__':
         raise ValueError(f"Invalid log level: {args.log}")
     logging.basicConfig(level=log_level)
 
+    if args.work_queue is not None:
+        main_queue(
+            args.work_queue,
+            num_workers=args.num_workers,
+            replace_table=args.replace_table,
+            checkpoint_dir=args.checkpoint_dir,
+            stagnation_window=args.stagnation_window,
+            lease=args.lease,
+            max_attempts=args.max_attempts,
+            telemetry=args.telemetry,
+            timeout=args.timeout,
+        )
+        sys.exit()
+
     main(
         start=args.start,
         total=args.total,
         num_workers=args.num_workers,
         replace_table=args.replace_table,
+        checkpoint_dir=args.checkpoint_dir,
+        stagnation_window=args.stagnation_window,
+        manifest=args.manifest,
+        telemetry=args.telemetry,
+        timeout=args.timeout,
     )
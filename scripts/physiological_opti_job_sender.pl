@@ -17,16 +17,18 @@ my $script_path = 'scripts/physiological_opti_sbatch.sh';
 my $add_to_queue = 0;
 my $timeout = 2880;  # (min) 1440 = 24hrs
 my $debug = 0;
+my $work_queue = '';
 my $help = 0;
 
 GetOptions ('max=i' => \$max_node,
             'num=i' => \$num_node,
             'init=i' => \$init_node,
-            'wait=i' => \$delay,
+            'wait|w=i' => \$delay,
             'script=s' => \$script_path,
             'cpus=i' => \$cpus_per_task,
             'time=i' => \$timeout,
             'queue' => \$add_to_queue,
+            'work_queue=s' => \$work_queue,
             'help' => \$help,
             'debug' => \$debug);
 
@@ -47,6 +49,7 @@ Options:
 -s, --script    Path to sbatch script.
 -t, --time      sbatch timeout in minutes.
 -q, --queue     If there are not enough cores available for the job request, queue the remainder.
+--work_queue    Path to a shared work queue database, jobs claim patients from it instead of fixed ranges.
 -d, --debug     Print the results instead of calling sbatch.
 -h, --help      Display this message.
 ";
@@ -237,8 +240,13 @@ for my $i ( 0 .. $#filtered_jobs ) {
   my %job = $filtered_jobs[$i]->%*;
   print "| $job_num\t| $job{free}\t| $job{part}\t|";
 
+  my $export = "--export=ALL,START=$start_idx[$i],NUM=$job{free},TOTAL=$ttl_job_cpus";
+  if ($work_queue) {
+    $export .= ",WORK_QUEUE=$work_queue";
+  }
+
   my @options = (
-                 "--export=ALL,START=$start_idx[$i],NUM=$job{free},TOTAL=$ttl_job_cpus",
+                 $export,
                  "--cpus-per-task=$job{free}",
                  "--account=$job{account}",
                  "--partition=$job{part}",
@@ -26,7 +26,16 @@ module load singularity/3.8.5
 
 # START, NUM and TOTAL are environment variables
 # as sbatch scripts don't allow for command line arguments.
+# If WORK_QUEUE is set, patients are claimed from the shared queue instead
+# of being split by START and TOTAL.
+
+if [ -n "${WORK_QUEUE}" ]; then
+    SPLIT_ARGS="--work_queue ${WORK_QUEUE}"
+else
+    SPLIT_ARGS="--start ${START} --total ${TOTAL}"
+fi
 
 srun singularity exec --bind "$(pwd)":/app cl0.sif \
 python3 scripts/optimisation_from_physiological_db_example.py \
---start ${START} --total ${TOTAL} --num_workers ${NUM} --log WARNING
+${SPLIT_ARGS} --num_workers ${NUM} --log WARNING \
+--checkpoint_dir checkpoints
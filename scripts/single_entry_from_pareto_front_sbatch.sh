@@ -11,7 +11,7 @@
 # Number of tasks
 #SBATCH --ntasks=1
 # Number of CPUs per task
-#SBATCH --cpus-per-task=25
+#SBATCH --cpus-per-task=1
 # Parition
 #SBATCH --partition=compute
 # Time Limit (1440 = 24hrs)
@@ -24,9 +24,8 @@
 
 module load singularity/3.8.5
 
-# START, NUM and TOTAL are environment variables
-# as sbatch scripts don't allow for command line arguments.
+# The reduction is vectorised and streams the database in chunks
+# so a single core is enough for the whole table.
 
 srun singularity exec --bind "$(pwd)":/app cl0.sif \
-python3 scripts/single_entry_from_pareto_front.py \
---start ${START} --total ${TOTAL} --num_workers ${NUM} --log DEBUG
+python3 scripts/single_entry_from_pareto_front.py --log DEBUG
@@ -7,12 +7,12 @@ import logging
 
 # Module imports
 import matplotlib.pyplot as plt
-import h5py
 
 # Local imports
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(BASE_DIR)
 from src import solve_system_parallel
+from src.storage import WaveformStore
 
 logger = logging.getLogger(__file__)
 
@@ -71,17 +71,13 @@ def main():
             plt.legend()
         plt.show()
 
-        # Save the data to hdf5 file
+        # Save the data to hdf5 file, the parameters of each run are stored
+        # alongside in the params table
         file_name = os.path.join(
             os.getcwd(), "scripts", f"thermoregulation_{par}_output.hdf5"
         )
-        with h5py.File(file_name, "w") as _:
-            pass
-        with h5py.File(file_name, "a") as f:
-            for i, sol in enumerate(sol_list):
-                grp = f.create_group(str(param_list[i]['thermal_system'][par]))
-                for key in list(sol.keys()):
-                    grp.create_dataset(key, data=sol[key])
+        with WaveformStore(file_name, mode="w") as store:
+            store.append(sol_list, param_list)
 
 
 if __name__ == "__main__":
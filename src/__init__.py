@@ -1,5 +1,37 @@
-from src.cl0 import solve_system
-from src.cl0 import load_defaults
-from src.cl0 import solve_system_parallel
-from src.opt import Optimiser
-from src.opt import load_default_params
+"""Lumped parameter closed loop model of the cardiovascular system.
+
+The solvers and the optimiser are imported on first use, so that importing
+the package (e.g. in a spawned worker process) neither imports nevergrad nor
+loads the Fortran library until they are needed.
+"""
+
+# Python imports
+import importlib
+
+# Public names and the modules they are imported from
+_EXPORTS = {
+    "solve_system": "src.cl0",
+    "load_defaults": "src.cl0",
+    "solve_system_parallel": "src.cl0",
+    "solve_system_stream": "src.cl0",
+    "solve_system_periodic": "src.cl0",
+    "solve_system_async": "src.aio",
+    "solve_many_async": "src.aio",
+    "Optimiser": "src.opt",
+    "load_default_params": "src.opt",
+    "load_default_fidelities": "src.opt",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_EXPORTS[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
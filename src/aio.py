@@ -0,0 +1,178 @@
+#! /usr/bin/env python
+"""asyncio interface to the solver for event loop based services."""
+
+# Python imports
+import os
+import asyncio
+import logging
+import weakref
+import functools
+import threading
+from concurrent import futures
+from typing import Optional
+
+# Local imports
+from src.cl0 import solve_system
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSolver:
+
+    def __init__(
+            self,
+            num_workers: Optional[int] = None,
+            processes: bool = False,
+            timeout: Optional[float] = None,
+            max_pending: Optional[int] = None,
+    ):
+        """Shares a pool of solver workers between coroutines.
+
+        Solves are run by a pool of threads (the Fortran solver releases the
+        GIL, so threads solve in parallel) or, with processes, by a
+        supervisor.Supervisor whose workers are killed and replaced if a
+        solve exceeds timeout. Any number of coroutines, on any number of
+        event loops, can solve at once: at most max_pending solves are handed
+        to the pool, further callers wait their turn without blocking the
+        event loop. Cancelling a caller that is waiting, or whose solve has
+        not started, drops its solve.
+
+        Args:
+                num_workers (int, optional) : Number of threads or processes.
+                        Defaults to the number of CPUs.
+                processes (bool, optional) : Whether to solve in processes
+                        rather than threads. Defaults to False.
+                timeout (float, optional) : Wall clock time (s) a solve may
+                        take before its process is killed and the solve
+                        fails with supervisor.TaskTimeout. Requires
+                        processes. Defaults to None.
+                max_pending (int, optional) : Largest number of solves
+                        handed to the pool at once. Defaults to num_workers.
+        """
+        if timeout is not None and not processes:
+            logger.critical("A timeout requires solving in processes.")
+            raise ValueError
+
+        self.num_workers = num_workers if num_workers is not None else os.cpu_count()
+        self.processes = processes
+        self.max_pending = max_pending if max_pending is not None else self.num_workers
+
+        if processes:
+            from src.supervisor import Supervisor
+
+            self._pool = Supervisor(solve_system, self.num_workers, timeout)
+        else:
+            self._pool = futures.ThreadPoolExecutor(
+                self.num_workers, thread_name_prefix="solver",
+            )
+
+        # Each event loop has its own limit on the solves it hands over
+        self._semaphores = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        """Returns the semaphore of the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._semaphores:
+                self._semaphores[loop] = asyncio.Semaphore(self.max_pending)
+            return self._semaphores[loop]
+
+    def _submit(self, *args, **kwargs) -> futures.Future:
+        """Hands a solve to the pool."""
+        if self.processes:
+            return self._pool.submit(*args, **kwargs)
+        return self._pool.submit(functools.partial(solve_system, *args, **kwargs))
+
+    async def solve(self, *args, **kwargs):
+        """Solves the system, see cl0.solve_system for the arguments."""
+        async with self._semaphore():
+            return await asyncio.wrap_future(self._submit(*args, **kwargs))
+
+    async def solve_many(
+            self,
+            param_list: list,
+            return_exceptions: bool = False,
+    ) -> list:
+        """Solves the system with each set of parameters.
+
+        Args:
+                param_list (list) : A list of parameters to be unpacked and
+                        passed to solve_system.
+                return_exceptions (bool, optional) : Whether solves that fail
+                        return their exception instead of raising it.
+                        Defaults to False.
+
+        Returns:
+                sol_list (list) : A list of solution dictionaries, in the same
+                        order as param_list.
+        """
+        return await asyncio.gather(
+            *(self.solve(**params) for params in param_list),
+            return_exceptions=return_exceptions,
+        )
+
+    def close(self, wait: bool = True):
+        """Stops the workers, cancelling the solves that have not started."""
+        if self.processes:
+            self._pool.shutdown(wait=wait, cancel=True)
+        else:
+            self._pool.shutdown(wait=wait, cancel_futures=True)
+
+
+# Pool shared by solve_system_async and solve_many_async
+_default_solver = None
+_default_lock = threading.Lock()
+
+
+def default_solver() -> AsyncSolver:
+    """Returns the AsyncSolver shared by every caller, creating it if needed."""
+    global _default_solver
+    with _default_lock:
+        if _default_solver is None:
+            _default_solver = AsyncSolver()
+        return _default_solver
+
+
+async def solve_system_async(*args, solver: Optional[AsyncSolver] = None, **kwargs):
+    """Solves the system without blocking the event loop.
+
+    Takes the same arguments as cl0.solve_system, e.g.
+
+        sol = await solve_system_async(generic_params={"period": 0.8})
+
+    Args:
+        solver (AsyncSolver, optional) : Workers to solve with. If None
+                (default), uses a pool of threads shared by every caller.
+    """
+    solver = solver if solver is not None else default_solver()
+    return await solver.solve(*args, **kwargs)
+
+
+async def solve_many_async(
+        param_list: list,
+        solver: Optional[AsyncSolver] = None,
+        return_exceptions: bool = False,
+) -> list:
+    """Solves the system with each set of parameters without blocking.
+
+    Args:
+        param_list (list) : A list of parameters to be unpacked and passed
+                to solve_system.
+        solver (AsyncSolver, optional) : Workers to solve with. If None
+                (default), uses a pool of threads shared by every caller.
+        return_exceptions (bool, optional) : Whether solves that fail return
+                their exception instead of raising it. Defaults to False.
+
+    Returns:
+        sol_list (list) : A list of solution dictionaries, in the same order
+                as param_list.
+    """
+    solver = solver if solver is not None else default_solver()
+    return await solver.solve_many(param_list, return_exceptions)
@@ -0,0 +1,241 @@
+#! /usr/bin/env python
+"""Memory mapped archive of solutions for sweeps larger than memory."""
+
+# Python imports
+import os
+import json
+import logging
+from typing import Optional
+from collections.abc import Mapping, Sequence
+
+# Module imports
+import numpy as np
+import pandas as pd
+
+# Local imports
+from src.cl0 import SOLUTION_KEYS, load_defaults, _format_solver_inputs
+from src.cl0 import _flatten_dict
+
+logger = logging.getLogger(__name__)
+
+HEADER = "header.json"
+WAVEFORMS = "waveforms.dat"
+PARAMS = "params.npy"
+WRITTEN = "written.npy"
+
+
+class ArchiveSolution(Mapping):
+    """Lazy view of a single solution in an archive.
+
+    Behaves like the solution dictionary returned by solve_system but each
+    channel is a view into the memory mapped file, only read when used.
+    """
+
+    def __init__(self, archive, idx: int):
+        self._archive = archive
+        self.idx = idx
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        return self._archive._waveforms[self.idx, self._archive._channel_idx[key]]
+
+    def __iter__(self):
+        return iter(self._archive.channels)
+
+    def __len__(self) -> int:
+        return len(self._archive.channels)
+
+    @property
+    def params(self) -> dict:
+        """Flattened inputs used to produce this solution."""
+        return dict(zip(self._archive.columns, self._archive._params[self.idx]))
+
+    def to_dict(self) -> dict:
+        """Copies the solution into memory as a solution dictionary."""
+        return {key: np.array(self[key]) for key in self}
+
+
+class WaveformArchive(Sequence):
+
+    def __init__(self, path: str, mode: str = "r"):
+        """Opens an existing archive.
+
+        An archive is a directory holding a fixed layout (runs, channels,
+        samples) binary file of waveforms, a (runs, parameters) array of the
+        flattened inputs of each run and a JSON header describing both.
+        Nothing is read until it is accessed, so opening an archive is
+        instant regardless of its size. Use WaveformArchive.create to make a
+        new archive.
+
+        Different processes can write to different rows of the same archive
+        at the same time.
+
+        Args:
+                path (str) : Path to the archive directory.
+                mode (str, optional) : "r" for read only or "r+" to write.
+                        Defaults to "r".
+        """
+        if mode not in ("r", "r+"):
+            logger.critical(f"Archive mode must be 'r' or 'r+', not {mode}.")
+            raise ValueError
+
+        self.path = path
+        self.mode = mode
+
+        with open(os.path.join(path, HEADER), "r") as f:
+            self.header = json.load(f)
+
+        self.channels = self.header["channels"]
+        self.columns = self.header["columns"]
+        self.shape = tuple(self.header["shape"])
+        self._channel_idx = {c: i for i, c in enumerate(self.channels)}
+
+        self._waveforms = np.memmap(
+            os.path.join(path, WAVEFORMS),
+            dtype=self.header["dtype"],
+            mode=mode,
+            shape=self.shape,
+        )
+        self._params = np.load(os.path.join(path, PARAMS), mmap_mode=mode)
+        self._written = np.load(os.path.join(path, WRITTEN), mmap_mode=mode)
+
+    @classmethod
+    def create(
+            cls,
+            path: str,
+            num_runs: int,
+            nout: int,
+            dtype: str = "float64",
+            channels: Optional[list] = None,
+    ):
+        """Creates an empty archive and opens it for writing.
+
+        Args:
+                path (str) : Path to the archive directory.
+                num_runs (int) : Number of solutions the archive holds.
+                nout (int) : Number of samples per solution (nstep).
+                dtype (str, optional) : "float64" (default) or "float32",
+                        float32 halves the size of the archive.
+                channels (list, optional) : Solution keys to store. If None
+                        (default), stores every key.
+
+        Returns:
+                archive (WaveformArchive) : The archive opened in "r+" mode.
+        """
+        if np.dtype(dtype) not in (np.float32, np.float64):
+            logger.critical(f"Archive dtype must be float32 or float64, not {dtype}.")
+            raise ValueError
+
+        channels = list(SOLUTION_KEYS) if channels is None else list(channels)
+        columns = list(_flatten_dict(load_defaults()).keys())
+        shape = (num_runs, len(channels), nout)
+
+        os.makedirs(path, exist_ok=True)
+        header = {
+            "shape": shape,
+            "dtype": np.dtype(dtype).name,
+            "channels": channels,
+            "columns": columns,
+        }
+        with open(os.path.join(path, HEADER), "w") as f:
+            json.dump(header, f, indent=2)
+
+        # Sizes the waveform file without writing it, the rows are filled in
+        # as the runs complete
+        with open(os.path.join(path, WAVEFORMS), "wb") as f:
+            f.truncate(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+
+        params = np.lib.format.open_memmap(
+            os.path.join(path, PARAMS),
+            mode="w+",
+            dtype=np.float64,
+            shape=(num_runs, len(columns)),
+        )
+        params[:] = np.nan
+        params.flush()
+        written = np.lib.format.open_memmap(
+            os.path.join(path, WRITTEN),
+            mode="w+",
+            dtype=np.bool_,
+            shape=(num_runs,),
+        )
+        written.flush()
+        del params, written
+
+        logger.debug(f"Created archive {path} with shape {shape}")
+        return cls(path, mode="r+")
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Run {idx} is out of range for {len(self)} runs.")
+        return ArchiveSolution(self, idx)
+
+    @property
+    def written(self) -> np.ndarray:
+        """Boolean mask of the runs that have been written."""
+        return np.asarray(self._written)
+
+    def write(self, idx: int, sol: dict, params: Optional[dict] = None):
+        """Writes a solution, and the inputs that produced it, to a row.
+
+        Args:
+                idx (int) : Row to write to.
+                sol (dict) : Solution dictionary as returned by solve_system.
+                params (dict, optional) : Inputs passed to solve_system,
+                        defaults are filled in before storing.
+        """
+        for i, key in enumerate(self.channels):
+            if sol[key].shape[-1] != self.shape[-1]:
+                logger.critical(
+                    f"{key} has {sol[key].shape[-1]} samples, "
+                    f"expected {self.shape[-1]}."
+                )
+                raise ValueError
+            self._waveforms[idx, i] = sol[key]
+
+        flat = _flatten_dict(_format_solver_inputs(**(params or dict())))
+        self._params[idx] = [float(flat[c]) for c in self.columns]
+        self._written[idx] = True
+
+    def params(self, columns: Optional[list] = None, rows=slice(None)) -> pd.DataFrame:
+        """Reads the parameter table.
+
+        Args:
+                columns (list, optional) : Parameter columns to read.
+                        If None (default), reads every column.
+                rows (slice or array, optional) : Runs to read. Defaults to all.
+
+        Returns:
+                params (pd.DataFrame) : Parameters with one row per run.
+        """
+        columns = self.columns if columns is None else columns
+        idx = [self.columns.index(c) for c in columns]
+        return pd.DataFrame(self._params[rows][:, idx], columns=columns)
+
+    def channel(self, name: str, rows=slice(None)) -> np.ndarray:
+        """Returns a (rows, samples) view of a single channel."""
+        return self._waveforms[rows, self._channel_idx[name]]
+
+    def flush(self):
+        """Flushes any written rows to disk."""
+        if self.mode == "r+":
+            self._waveforms.flush()
+            self._params.flush()
+            self._written.flush()
+
+    def close(self):
+        """Flushes and releases the memory maps."""
+        self.flush()
+        del self._waveforms, self._params, self._written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,64 @@
+#! /usr/bin/env python
+"""Checkpointing utilities for long running optimisation jobs."""
+
+# Python imports
+import os
+import pickle
+import logging
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def save_state(path: str, state: Any):
+    """Atomically pickles a state to a file.
+
+    The state is first written to a temporary file which is then moved over
+    the existing checkpoint, so a job killed mid-write never leaves behind a
+    corrupt checkpoint.
+
+    Args:
+        path (str) : Path to the checkpoint file.
+        state (Any) : Picklable object to save.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    logger.debug(f"Checkpoint written to {path}")
+
+
+def load_state(path: str, default: Optional[Any] = None) -> Any:
+    """Loads a pickled state from a file.
+
+    Args:
+        path (str) : Path to the checkpoint file.
+        default (Any, optional) : Returned if the checkpoint does not exist.
+                Defaults to None.
+
+    Returns:
+        state (Any) : The unpickled state or the default.
+    """
+    if not os.path.exists(path):
+        return default
+
+    with open(path, "rb") as f:
+        state = pickle.load(f)
+    logger.debug(f"Checkpoint loaded from {path}")
+    return state
+
+
+def remove_state(path: str):
+    """Removes a checkpoint file if it exists.
+
+    Args:
+        path (str) : Path to the checkpoint file.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+        logger.debug(f"Checkpoint {path} removed")
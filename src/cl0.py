@@ -6,17 +6,142 @@ import os
 import ctypes as ct
 import logging
 from typing import Optional
+from collections.abc import MutableMapping
 import multiprocessing as mp
 
 # Module imports
 import numpy as np
 import numpy.typing as npt
 
+# Local imports
+from src.trace import span, flush as flush_trace
+
 logger = logging.getLogger(__name__)
 
-fortlib = ct.CDLL(
-    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'closed_loop_lumped.so')
+# Fortran solver library, loaded on first use by load_library
+LIBRARY_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'closed_loop_lumped.so'
 )
+_fortlib = None
+
+
+def load_library() -> ct.CDLL:
+    """Returns the Fortran solver library, loading it on the first call.
+
+    The library is not loaded when the module is imported so that scripts
+    and worker processes that never solve do not pay for it.
+    """
+    global _fortlib
+    if _fortlib is None:
+        if not os.path.exists(LIBRARY_PATH):
+            logger.critical(
+                f"The solver library {LIBRARY_PATH} does not exist, build it "
+                "by running `./build.sh lib` in the root of the repository."
+            )
+            raise FileNotFoundError(
+                f"Solver library {LIBRARY_PATH} not found, run `./build.sh lib`."
+            )
+        _fortlib = ct.CDLL(LIBRARY_PATH)
+    return _fortlib
+
+
+def __getattr__(name: str):
+    # Keeps `from src.cl0 import fortlib` working, loading the library
+    if name == "fortlib":
+        return load_library()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Names of the solution variables in the order returned by the solver
+SOLUTION_KEYS = (
+    'Aortic Valve Flow',
+    'Sinus Flow',
+    'Aortic Flow',
+    'Tricuspid Valve Flow',
+    'Pulmonary Valve Flow',
+    'Arterial Flow',
+    'Aterioles Flow',
+    'Mitral Valve Flow',
+    'Systemic Sinus Pressure',
+    'Systemic Artery Pressure',
+    'Systemic Venous Pressure',
+    'Pulmonary Sinus Pressure',
+    'Pulmonary Artery Pressure',
+    'Pulmonary Venous Pressure',
+    'Left Ventricular Volume',
+    'Left Atrial Volume',
+    'Right Ventricular Volume',
+    'Right Atrial Volume',
+    'Aortic Valve Status',
+    'Mitral Valve Status',
+    'Pulmonary Valve Status',
+    'Tricuspid Valve Status',
+    'Left Ventricular Pressure',
+    'Left Atrial Pressure',
+    'Right Ventricular Pressure',
+    'Right Atrial Pressure',
+    'Left Ventricular Elastance',
+    'Left Atrial Elastance',
+    'Right Ventricular Elastance',
+    'Right Atrial Elastance',
+    'Time (s)',
+)
+
+# Number of state variables (the first 22 solution keys) carried between solves
+NUM_STATES = 22
+
+# Number of solution keys with sensitivities (the states and chamber pressures)
+NUM_SENSITIVITIES = 26
+
+# Status of a solve returned by the solver, matching funcs.f90. Solves that
+# diverge or leave the physiological range (negative chamber volumes or
+# pressures beyond 1e4 mmHg) are stopped early and their solution is NaN.
+STATUS_OK = 0
+STATUS_NONFINITE = 1
+STATUS_OUT_OF_RANGE = 2
+
+# Status of solves that did not return a solution, set by solve_system_parallel
+STATUS_TIMEOUT = 3
+STATUS_FAILED = 4
+
+# Parameters the solver can differentiate with respect to, mapped to their
+# code in the Fortran solver and whether it returns relative (d/dlog)
+# derivatives that must be divided by the value of the parameter
+SENSITIVITY_PARAMS = {
+    "generic_params.r_scale": (1, True),
+    "generic_params.c_scale": (2, True),
+    "generic_params.e_scale": (3, True),
+    "thermal_system.k_dil": (4, False),
+    "thermal_system.k_con": (5, False),
+}
+
+
+class SolverStats(ct.Structure):
+    """Instrumentation of a solve, matching solver_stats in data_types.f90."""
+
+    _fields_ = [
+        ("t_setup", ct.c_double),
+        ("t_elastance", ct.c_double),
+        ("t_stepping", ct.c_double),
+        ("t_post", ct.c_double),
+        ("t_total", ct.c_double),
+        ("rhs_evals", ct.c_longlong),
+        ("tl_evals", ct.c_longlong),
+        ("steps", ct.c_longlong),
+        ("cycles", ct.c_longlong),
+    ]
+
+    def to_dict(self) -> dict:
+        """Returns the statistics as a dictionary."""
+        return {name: getattr(self, name) for name, _ in self._fields_}
+
+
+class Solution(dict):
+    """Solution dictionary along with metadata about the solve."""
+
+    def __init__(self, *args, metadata: Optional[dict] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metadata = metadata if metadata is not None else dict()
 
 
 def load_defaults():
@@ -167,6 +292,46 @@ def load_defaults():
     return defaults
 
 
+def _flatten_dict(
+        d: MutableMapping, parent_key: str = '', sep: str = '.'
+) -> MutableMapping:
+    """Takes a nested dictionary and returns a flattened year.
+
+    Args:
+        d (dict) : A nested dictionary.
+        parent_key (str) : Key of the parent dictionary.
+        sep (str, optional) : Separator to use for the flattened dictionary.
+                Defaults to '.'.
+    """
+    items = []
+    for k, v in d.items():
+        new_key = parent_key + sep + k if parent_key else k
+        if isinstance(v, MutableMapping):
+            items.extend(_flatten_dict(v, parent_key=new_key, sep=sep).items())
+        else:
+            items.append((new_key, v))
+    return dict(items)
+
+
+def _unflatten_dict(dictionary: dict, sep: str = '.') -> dict:
+    """Unflattens a dictionary into a nested dictionary.
+
+    Args:
+        dictionary (dict) : Flattened dictionary.
+        sep (str, optional) : Separator for the flattened dictionary.
+    """
+    rtn_dict = dict()
+    for key, value in dictionary.items():
+        parts = key.split(".")
+        d = rtn_dict
+        for part in parts[:-1]:
+            if part not in d:
+                d[part] = dict()
+            d = d[part]
+        d[parts[-1]] = value
+    return rtn_dict
+
+
 def _format_solver_inputs(
         generic_params: Optional[dict] = None,
         ecg: Optional[dict] = None,
@@ -247,99 +412,21 @@ def _format_solver_inputs(
     return inputs
 
 
-def solve_system(
-        generic_params: Optional[dict] = None,
-        ecg: Optional[dict] = None,
-        left_ventricle: Optional[dict] = None,
-        left_atrium: Optional[dict] = None,
-        right_ventricle: Optional[dict] = None,
-        right_atrium: Optional[dict] = None,
-        systemic: Optional[dict] = None,
-        pulmonary: Optional[dict] = None,
-        aortic_valve: Optional[dict] = None,
-        mitral_valve: Optional[dict] = None,
-        pulmonary_valve: Optional[dict] = None,
-        tricuspid_valve: Optional[dict] = None,
-        thermal_system: Optional[dict] = None,
-) -> npt.NDArray[np.float64]:
-    """Solves the lumped parameter closed loop system.
-
-    If any of the dictionaries or keys are not provided or any keys default values will be used.
+def _pack_solver_inputs(inputs: dict) -> tuple:
+    """Converts formatted solver inputs into the arguments of the Fortran solver.
 
     Args:
-    generic_params (dict, optional) : A dictionary containing: 'nstep' (number of time steps),
-        'ncycle' (number of cardiac cycles), 'rk' (Runge-Kutta order - either 2 or 4),
-        'period' (cardiac period in seconds) and 'rho' (density of blood).
-    ecg (dict, optional) : A dictionary containing: 't1' (location of the P peak),
-        't2' (location of the R peak), 't3' (location of the T peak)
-        and 't4' (location of the end of the T peak - also called T offset).
-    left_ventricle (dict, optional) : A dictionary containing 'emin' (minimum elastance),
-        'emax' (maximum elastance), 'vmin' (minimum volume) and 'vmax' (maximum volume).
-    left_atrium (dict, optional) : A dictionary containing 'emin' (minimum elastance),
-        'emax' (maximum elastance), 'vmin' (minimum volume) and 'vmax' (maximum volume)
-    right_ventricle (dict, optional) : A dictionary containing 'emin' (minimum elastance),
-        'emax' (maximum elastance), 'vmin' (minimum volume) and 'vmax' (maximum volume)..
-    right_atrium (dict, optional) : A dictionary containing 'emin' (minimum elastance),
-        'emax' (maximum elastance), 'vmin' (minimum volume) and 'vmax' (maximum volume).
-    systemic (dict, optional) : A dictionary containing: 'pini' (initial pressure),
-        'ras' (aortic sinus resistance), 'rat' (artery resistance),
-        'rar' (arterioles resistance), 'rcp' (capillary resistance),
-        'rvn' (venous resistance), 'cas' (aortic sinus compliance),
-        'cat' (artery compliance), 'cvn' (venous compliance),
-        'las' (aortic sinus inductance) and 'lat' (artery inductance).
-    pulmonary (dict, optional) : A dictionary containing: 'pini' (initial pressure),
-        'ras' (pulmonary sinus resistance), 'rat' (artery resistance),
-        'rar' (arterioles resistance), 'rcp' (capillary resistance),
-        'rvn' (venous resistance), 'cas' (pulmonary sinus compliance),
-        'cat' (artery compliance), 'cvn' (venous compliance),
-        'las' (pulmonary sinus inductance) and 'lat' (artery inductance).
-    aortic_valve (dict, optional) : A dictionary containing:
-        'leff' (effective inductance), 'aeffmin' (minimum effective area),
-        'aeffmax' (maximum effective area), 'kvc' (valve closing parameter),
-        'kvo' (valve opening parameter).
-    mitral_valve (dict, optional) : A dictionary containing:
-        'leff' (effective inductance), 'aeffmin' (minimum effective area),
-        'aeffmax' (maximum effective area), 'kvc' (valve closing parameter),
-        'kvo' (valve opening parameter).
-    pulmonary_valve (dict, optional) : A dictionary containing:
-        'leff' (effective inductance), 'aeffmin' (minimum effective area),
-        'aeffmax' (maximum effective area), 'kvc' (valve closing parameter),
-        'kvo' (valve opening parameter).
-    tricuspid_valve (dict, optional) : A dictionary containing:
-        'leff' (effective inductance), 'aeffmin' (minimum effective area),
-        'aeffmax' (maximum effective area), 'kvc' (valve closing parameter),
-        'kvo' (valve opening parameter).
-    thermal_system (dict, optional) : A dictionary containing:
-        'k_dil' (vasodilation coefficient), 't_cr' (core temperature),
-        't_cr_ref' (core temperature under neutral conditions),
-        'k_con' (vasoconstriction coefficient), 't_sk' (skin temperature),
-        't_sk_ref' (skin temperature under neutral condtions).
+        inputs (dict) : Inputs as returned by _format_solver_inputs.
+
     Returns:
-        sol (dict) : A dictionary of all of the solutions for system.
+        args (tuple) : ctypes arguments of the solver, in order, up to (but
+                not including) the solution array.
     """
 
-    ###############
-    # Load inputs #
-    ###############
-    inputs = _format_solver_inputs(
-        generic_params, ecg,
-        left_ventricle, left_atrium, right_ventricle, right_atrium,
-        systemic, pulmonary,
-        aortic_valve, mitral_valve, pulmonary_valve, tricuspid_valve,
-        thermal_system,
-    )
-
-    logger.info(f"Solving system with the following parameters:\n{inputs}\n")
-
-    ####################
-    # Formats the data #
-    ####################
-
     # Generic parameters
     nstep = ct.c_int(inputs["generic_params"]["nstep"])
     period = ct.c_double(inputs["generic_params"]["period"])
     ncycle = ct.c_int(inputs["generic_params"]["ncycle"])
-    ncycle = ct.c_int(inputs["generic_params"]["ncycle"])
     rk = ct.c_int(inputs["generic_params"]["rk"])
     est_h_vol = ct.c_bool(inputs["generic_params"]["est_h_vol"])
     height = ct.c_double(inputs["generic_params"]["height"])
@@ -453,17 +540,7 @@ def solve_system(
     t_sk = ct.c_double(inputs["thermal_system"]["t_sk"])
     t_sk_ref = ct.c_double(inputs["thermal_system"]["t_sk_ref"])
 
-    # Solution
-    sol_out = np.zeros(
-        (31, inputs["generic_params"]["nstep"]),
-        order='F',
-        dtype=np.float64,
-    )
-
-    ################
-    # Solve system #
-    ################
-    fortlib.solve_system(
+    return (
         nstep, period, ncycle, rk, rho,
         lv_emin, lv_emax, lv_v01, lv_v02,
         la_emin, la_emax, la_v01, la_v02,
@@ -482,55 +559,396 @@ def solve_system(
         tv_leff, tv_aeffmin, tv_aeffmax, tv_kvc, tv_kvo,
         t1, t2, t3, t4,
         q_sk_basal, k_dil, t_cr, t_cr_ref, k_con, t_sk, t_sk_ref,
-        sol_out.ctypes.data_as(ct.POINTER(ct.c_double)),
     )
 
-    sol = {
-        'Aortic Valve Flow': sol_out[0, :],
-        'Sinus Flow': sol_out[1, :],
-        'Aortic Flow': sol_out[2, :],
-        'Tricuspid Valve Flow': sol_out[3, :],
-        'Pulmonary Valve Flow': sol_out[4, :],
-        'Arterial Flow': sol_out[5, :],
-        'Aterioles Flow': sol_out[6, :],
-        'Mitral Valve Flow': sol_out[7, :],
-        'Systemic Sinus Pressure': sol_out[8, :],
-        'Systemic Artery Pressure': sol_out[9, :],
-        'Systemic Venous Pressure': sol_out[10, :],
-        'Pulmonary Sinus Pressure': sol_out[11, :],
-        'Pulmonary Artery Pressure': sol_out[12, :],
-        'Pulmonary Venous Pressure': sol_out[13, :],
-        'Left Ventricular Volume': sol_out[14, :],
-        'Left Atrial Volume': sol_out[15, :],
-        'Right Ventricular Volume': sol_out[16, :],
-        'Right Atrial Volume': sol_out[17, :],
-        'Aortic Valve Status': sol_out[18, :],
-        'Mitral Valve Status': sol_out[19, :],
-        'Pulmonary Valve Status': sol_out[20, :],
-        'Tricuspid Valve Status': sol_out[21, :],
-        'Left Ventricular Pressure': sol_out[22, :],
-        'Left Atrial Pressure': sol_out[23, :],
-        'Right Ventricular Pressure': sol_out[24, :],
-        'Right Atrial Pressure': sol_out[25, :],
-        'Left Ventricular Elastance': sol_out[26, :],
-        'Left Atrial Elastance': sol_out[27, :],
-        'Right Ventricular Elastance': sol_out[28, :],
-        'Right Atrial Elastance': sol_out[29, :],
-        'Time (s)': sol_out[30, :],
-    }
+
+def solve_system(
+        generic_params: Optional[dict] = None,
+        ecg: Optional[dict] = None,
+        left_ventricle: Optional[dict] = None,
+        left_atrium: Optional[dict] = None,
+        right_ventricle: Optional[dict] = None,
+        right_atrium: Optional[dict] = None,
+        systemic: Optional[dict] = None,
+        pulmonary: Optional[dict] = None,
+        aortic_valve: Optional[dict] = None,
+        mitral_valve: Optional[dict] = None,
+        pulmonary_valve: Optional[dict] = None,
+        tricuspid_valve: Optional[dict] = None,
+        thermal_system: Optional[dict] = None,
+        initial_state: Optional[npt.NDArray[np.float64]] = None,
+        sensitivities: Optional[list] = None,
+        stats: bool = False,
+        check_every: int = 50,
+) -> "Solution":
+    """Solves the lumped parameter closed loop system.
+
+    If any of the dictionaries or keys are not provided or any keys default values will be used.
+
+    Args:
+    generic_params (dict, optional) : A dictionary containing: 'nstep' (number of time steps),
+        'ncycle' (number of cardiac cycles), 'rk' (Runge-Kutta order - either 2 or 4),
+        'period' (cardiac period in seconds) and 'rho' (density of blood).
+    ecg (dict, optional) : A dictionary containing: 't1' (location of the P peak),
+        't2' (location of the R peak), 't3' (location of the T peak)
+        and 't4' (location of the end of the T peak - also called T offset).
+    left_ventricle (dict, optional) : A dictionary containing 'emin' (minimum elastance),
+        'emax' (maximum elastance), 'vmin' (minimum volume) and 'vmax' (maximum volume).
+    left_atrium (dict, optional) : A dictionary containing 'emin' (minimum elastance),
+        'emax' (maximum elastance), 'vmin' (minimum volume) and 'vmax' (maximum volume)
+    right_ventricle (dict, optional) : A dictionary containing 'emin' (minimum elastance),
+        'emax' (maximum elastance), 'vmin' (minimum volume) and 'vmax' (maximum volume)..
+    right_atrium (dict, optional) : A dictionary containing 'emin' (minimum elastance),
+        'emax' (maximum elastance), 'vmin' (minimum volume) and 'vmax' (maximum volume).
+    systemic (dict, optional) : A dictionary containing: 'pini' (initial pressure),
+        'ras' (aortic sinus resistance), 'rat' (artery resistance),
+        'rar' (arterioles resistance), 'rcp' (capillary resistance),
+        'rvn' (venous resistance), 'cas' (aortic sinus compliance),
+        'cat' (artery compliance), 'cvn' (venous compliance),
+        'las' (aortic sinus inductance) and 'lat' (artery inductance).
+    pulmonary (dict, optional) : A dictionary containing: 'pini' (initial pressure),
+        'ras' (pulmonary sinus resistance), 'rat' (artery resistance),
+        'rar' (arterioles resistance), 'rcp' (capillary resistance),
+        'rvn' (venous resistance), 'cas' (pulmonary sinus compliance),
+        'cat' (artery compliance), 'cvn' (venous compliance),
+        'las' (pulmonary sinus inductance) and 'lat' (artery inductance).
+    aortic_valve (dict, optional) : A dictionary containing:
+        'leff' (effective inductance), 'aeffmin' (minimum effective area),
+        'aeffmax' (maximum effective area), 'kvc' (valve closing parameter),
+        'kvo' (valve opening parameter).
+    mitral_valve (dict, optional) : A dictionary containing:
+        'leff' (effective inductance), 'aeffmin' (minimum effective area),
+        'aeffmax' (maximum effective area), 'kvc' (valve closing parameter),
+        'kvo' (valve opening parameter).
+    pulmonary_valve (dict, optional) : A dictionary containing:
+        'leff' (effective inductance), 'aeffmin' (minimum effective area),
+        'aeffmax' (maximum effective area), 'kvc' (valve closing parameter),
+        'kvo' (valve opening parameter).
+    tricuspid_valve (dict, optional) : A dictionary containing:
+        'leff' (effective inductance), 'aeffmin' (minimum effective area),
+        'aeffmax' (maximum effective area), 'kvc' (valve closing parameter),
+        'kvo' (valve opening parameter).
+    thermal_system (dict, optional) : A dictionary containing:
+        'k_dil' (vasodilation coefficient), 't_cr' (core temperature),
+        't_cr_ref' (core temperature under neutral conditions),
+        'k_con' (vasoconstriction coefficient), 't_sk' (skin temperature),
+        't_sk_ref' (skin temperature under neutral condtions).
+    initial_state (np.ndarray, optional) : State to start from instead of the
+        initial pressures and volumes, e.g. sol.metadata["state"] of a
+        previous solution to continue it.
+    sensitivities (list, optional) : Flattened parameters (see
+        SENSITIVITY_PARAMS, e.g. "generic_params.r_scale" or
+        "thermal_system.k_dil") to differentiate the solution with respect to.
+        The derivatives are found by differentiating each Runge-Kutta step
+        alongside the solution, so are exact for the solved cycles (the
+        initial state is taken to be independent of the parameters).
+    stats (bool, optional) : If True, the solver times each phase of the
+        solve and counts its work, returned in sol.metadata["stats"].
+    check_every (int, optional) : Number of time steps between checks that
+        the state is finite and within the physiological range, stopping the
+        solve as soon as it diverges. If 0, the state is never checked.
+        Defaults to 50.
+    Returns:
+        sol (Solution) : A dictionary of all of the solutions for system.
+            sol.metadata["state"] is the state at the end of the last cycle
+            and sol.metadata["initial_state"] the state it started from (if
+            supplied). With sensitivities, sol.metadata["sensitivities"] maps
+            each parameter to the derivatives of the states and chamber
+            pressures of the last cycle with respect to it. With stats,
+            sol.metadata["stats"] has the wall time (s) of the coefficient
+            setup ('t_setup'), elastance curves ('t_elastance'), time
+            stepping ('t_stepping'), post-processing including the copy to
+            the outputs ('t_post') and the whole solve ('t_total') along
+            with the number of right hand side ('rhs_evals') and tangent
+            linear ('tl_evals') evaluations, time steps ('steps') and
+            cycles ('cycles'). sol.metadata["status"] is STATUS_OK, or
+            STATUS_NONFINITE or STATUS_OUT_OF_RANGE if the solve was stopped
+            early, in which case the solution is NaN.
+    """
+
+    ###############
+    # Load inputs #
+    ###############
+    with span("format_inputs", "solver"):
+        inputs = _format_solver_inputs(
+            generic_params, ecg,
+            left_ventricle, left_atrium, right_ventricle, right_atrium,
+            systemic, pulmonary,
+            aortic_valve, mitral_valve, pulmonary_valve, tricuspid_valve,
+            thermal_system,
+        )
+
+    logger.info(f"Solving system with the following parameters:\n{inputs}\n")
+
+    # Solution
+    sol_out = np.zeros(
+        (31, inputs["generic_params"]["nstep"]),
+        order='F',
+        dtype=np.float64,
+    )
+
+    # State to continue from, overwritten with the final state
+    use_state = ct.c_int(initial_state is not None)
+    state = np.zeros(NUM_STATES, dtype=np.float64)
+    if initial_state is not None:
+        state[:] = initial_state
+
+    # Parameters to differentiate with respect to
+    sensitivities = list(sensitivities) if sensitivities is not None else []
+    for key in sensitivities:
+        if key not in SENSITIVITY_PARAMS:
+            logger.critical(
+                f"Sensitivities are not available for {key}, only for "
+                f"{list(SENSITIVITY_PARAMS.keys())}."
+            )
+            raise ValueError
+    npar = len(sensitivities)
+    sens_params = np.array(
+        [SENSITIVITY_PARAMS[key][0] for key in sensitivities] or [0],
+        dtype=np.int32,
+    )
+    sens_out = np.zeros(
+        (NUM_SENSITIVITIES, inputs["generic_params"]["nstep"], max(npar, 1)),
+        order='F',
+        dtype=np.float64,
+    )
+
+    # Instrumentation, only filled in if requested
+    solver_stats = SolverStats()
+    status = ct.c_int(STATUS_OK)
+
+    with span("pack_inputs", "solver"):
+        args = _pack_solver_inputs(inputs)
+
+    ################
+    # Solve system #
+    ################
+    with span("fortran", "solver", nstep=inputs["generic_params"]["nstep"]):
+        load_library().solve_system(
+            *args,
+            sol_out.ctypes.data_as(ct.POINTER(ct.c_double)),
+            use_state,
+            state.ctypes.data_as(ct.POINTER(ct.c_double)),
+            ct.c_int(npar),
+            sens_params.ctypes.data_as(ct.POINTER(ct.c_int)),
+            sens_out.ctypes.data_as(ct.POINTER(ct.c_double)),
+            ct.c_int(stats),
+            ct.byref(solver_stats),
+            ct.c_int(check_every),
+            ct.byref(status),
+        )
+
+    if status.value != STATUS_OK:
+        logger.debug(f"Solve stopped early with status {status.value}.")
+
+    sol = Solution(
+        {key: sol_out[i, :] for i, key in enumerate(SOLUTION_KEYS)},
+        metadata={"state": state, "status": status.value},
+    )
+    if initial_state is not None:
+        sol.metadata["initial_state"] = np.array(initial_state, dtype=np.float64)
+    if stats:
+        sol.metadata["stats"] = solver_stats.to_dict()
+
+    if sensitivities:
+        sol.metadata["sensitivities"] = dict()
+        for j, key in enumerate(sensitivities):
+            section, name = key.split(".")
+            relative = SENSITIVITY_PARAMS[key][1]
+            scale = 1 / inputs[section][name] if relative else 1
+            sol.metadata["sensitivities"][key] = {
+                sol_key: sens_out[i, :, j] * scale
+                for i, sol_key in enumerate(SOLUTION_KEYS[:NUM_SENSITIVITIES])
+            }
 
     return sol
 
 
+def _state_range(sol: dict) -> np.ndarray:
+    """Returns the range of each state variable over a solution."""
+    return np.maximum(
+        [np.ptp(sol[key]) for key in SOLUTION_KEYS[:NUM_STATES]], 1e-12
+    )
+
+
+def periodicity_residual(sol: dict) -> float:
+    """Returns how far a single cycle solution is from being periodic.
+
+    The residual is the largest change of a state variable over the cycle
+    relative to its range over the cycle, so a residual of 1e-3 means every
+    state returns to within 0.1% of its range.
+
+    Args:
+        sol (dict) : Solution of a single cycle solved from an initial state.
+
+    Returns:
+        residual (float) : Relative periodicity residual.
+    """
+    x0 = sol.metadata["initial_state"]
+    x1 = sol.metadata["state"]
+    return float(np.max(np.abs(x1 - x0) / _state_range(sol)))
+
+
+def solve_system_periodic(
+        tol: float = 1e-6,
+        max_iter: int = 50,
+        memory: int = 5,
+        warmup: int = 2,
+        initial_state: Optional[npt.NDArray[np.float64]] = None,
+        **inputs,
+) -> tuple:
+    """Solves for the periodic steady state of the system.
+
+    Finds the state x0 for which a single cycle solved from x0 returns to x0
+    using Anderson accelerated fixed point iteration on the one cycle map,
+    rather than solving a fixed number of cycles from an arbitrary state.
+    This typically reaches a residual of 1e-6 in around a dozen cycles where
+    plain cycling needs around forty.
+
+    Args:
+        tol (float, optional) : Periodicity residual to stop at, see
+                periodicity_residual. Defaults to 1e-6.
+        max_iter (int, optional) : Maximum number of one cycle solves.
+                Defaults to 50.
+        memory (int, optional) : Number of previous iterates used by the
+                Anderson acceleration, 0 for plain cycling. Defaults to 5.
+        warmup (int, optional) : Number of cycles solved from the initial
+                pressures and volumes for the first guess. Defaults to 2.
+        initial_state (np.ndarray, optional) : First guess of the periodic
+                state, e.g. the state of a solution with similar inputs. If
+                supplied, no warmup is done.
+        **inputs : Inputs passed to solve_system, ncycle is ignored.
+
+    Returns:
+        sol (Solution) : Solution of the periodic cycle.
+        info (dict) : Whether it converged ('converged'), the periodicity
+                residual ('residual'), the number of iterations
+                ('iterations'), the total number of cycles solved
+                ('cycles') and the residual of every iteration ('residuals').
+    """
+    generic_params = dict(inputs.pop("generic_params", None) or dict())
+    cycles = 0
+    if initial_state is None:
+        generic_params["ncycle"] = warmup
+        x = solve_system(generic_params, **inputs).metadata["state"]
+        cycles += warmup
+    else:
+        x = np.array(initial_state, dtype=np.float64)
+    generic_params["ncycle"] = 1
+
+    d_f, d_g = [], []
+    f_prev, g_prev = None, None
+    residuals = []
+    for iteration in range(1, max_iter + 1):
+        sol = solve_system(generic_params, **inputs, initial_state=x)
+        cycles += 1
+
+        residual = periodicity_residual(sol)
+        residuals.append(residual)
+        if residual < tol:
+            break
+
+        # Extrapolation can overshoot far from the periodic state, if it
+        # does the history is dropped and cycling continues from the last
+        # finite state
+        if not np.isfinite(residual):
+            if g_prev is None:
+                break
+            logger.debug(f"Restarting acceleration at iteration {iteration}.")
+            d_f, d_g = [], []
+            f_prev = None
+            x, g_prev = g_prev, None
+            continue
+
+        # Residuals are weighted by the range of each state so flows,
+        # pressures, volumes and valve states count equally
+        g = sol.metadata["state"]
+        f = (g - x) / _state_range(sol)
+
+        if f_prev is not None and memory > 0:
+            d_f.append(f - f_prev)
+            d_g.append(g - g_prev)
+            d_f, d_g = d_f[-memory:], d_g[-memory:]
+        f_prev, g_prev = f, g
+
+        if d_f:
+            gamma = np.linalg.lstsq(np.array(d_f).T, f, rcond=None)[0]
+            x = g - np.array(d_g).T @ gamma
+            # Valves can only be between fully closed and fully open
+            x[NUM_STATES - 4:] = np.clip(x[NUM_STATES - 4:], 0, 1)
+        else:
+            x = g
+
+    info = {
+        "converged": residuals[-1] < tol,
+        "residual": residuals[-1],
+        "iterations": len(residuals),
+        "cycles": cycles,
+        "residuals": residuals,
+    }
+    sol.metadata["residual"] = residuals[-1]
+    if not info["converged"]:
+        logger.warning(
+            f"Periodic solve did not converge after {len(residuals)} "
+            f"iterations, residual {residuals[-1]:.2e}."
+        )
+    return sol, info
+
+
 def _solve_system(return_dict, idx, params):
     """Wrapper to solve system and store in a dictionary."""
-    return_dict[idx] = solve_system(**params)
+    with span("task", "parallel", idx=idx):
+        sol = solve_system(**params)
+        with span("return_result", "parallel"):
+            return_dict[idx] = sol
+    flush_trace()
     return return_dict
 
 
+def _solve_system_to_archive(path, idx, params):
+    """Wrapper to solve system and write it directly into an archive."""
+    from src.archive import WaveformArchive
+
+    with span("task", "parallel", idx=idx):
+        archive = WaveformArchive(path, mode="r+")
+        sol = solve_system(**params)
+        with span("archive_write", "db"):
+            archive.write(idx, sol, params)
+        archive.close()
+    flush_trace()
+
+
+def _failed_solution(params: dict, status: int, error: str) -> "Solution":
+    """Returns the NaN solution recorded for a solve that did not complete."""
+    nstep = _format_solver_inputs(**params)["generic_params"]["nstep"]
+    return Solution(
+        {key: np.full(nstep, np.nan) for key in SOLUTION_KEYS},
+        metadata={
+            "state": np.full(NUM_STATES, np.nan),
+            "status": status,
+            "error": error,
+        },
+    )
+
+
+def _supervised_result(future, params: dict) -> "Solution":
+    """Returns the solution of a supervised solve, or a failed solution."""
+    from src.supervisor import TaskTimeout
+
+    try:
+        return future.result()
+    except TaskTimeout as e:
+        return _failed_solution(params, STATUS_TIMEOUT, str(e))
+    except Exception as e:
+        return _failed_solution(params, STATUS_FAILED, repr(e))
+
+
 def solve_system_parallel(
         param_list: list,
         num_workers: Optional[int] = None,
+        archive: Optional[str] = None,
+        archive_dtype: str = "float64",
+        timeout: Optional[float] = None,
 ) -> list:
     """Solve the system with multiple sets of arguments in parallel.
 
@@ -538,24 +956,267 @@ def solve_system_parallel(
         param_list (list) : A list of parameters to be unpacked and passed
                 to solve_system.
         num_workers (int, optional) : Maximum number of processes to use.
+        archive (str, optional) : Path of a WaveformArchive to create. If
+                supplied, each worker writes its solution straight into the
+                archive rather than returning it, so the sweep does not need
+                to fit in memory. Defaults to None.
+        archive_dtype (str, optional) : Data type of the archive, "float64"
+                (default) or "float32".
+        timeout (float, optional) : Wall clock time (s) each solve may take.
+                If supplied, the solves are run by a supervisor.Supervisor
+                which kills and replaces workers that exceed it (or die), and
+                every solve that does not complete is returned as a NaN
+                solution whose metadata has the status (STATUS_TIMEOUT or
+                STATUS_FAILED) and the error. Defaults to None.
 
     Returns:
-        sol_list (list) : A list of solution dictionaries.
+        sol_list (list) : A list of solution dictionaries, in the same order
+                as param_list. If archive is supplied, this is the archive
+                opened for reading whose items are lazy solution views.
     """
 
     num_workers = mp.cpu_count() - 1 if num_workers is None else num_workers
     num_workers = min(len(param_list), num_workers)
     logger.info(f"Solving {len(param_list)} systems using {num_workers} workerse.")
 
+    if archive is not None:
+        from src.archive import WaveformArchive
+
+        nsteps = {
+            _format_solver_inputs(**params)["generic_params"]["nstep"]
+            for params in param_list
+        }
+        if len(nsteps) != 1:
+            logger.critical(
+                f"All solutions in an archive must have the same nstep, got {nsteps}."
+            )
+            raise ValueError
+
+        WaveformArchive.create(
+            archive, len(param_list), nsteps.pop(), dtype=archive_dtype,
+        ).close()
+
+        if timeout is not None:
+            from src.supervisor import Supervisor
+
+            with Supervisor(_solve_system_to_archive, num_workers, timeout) as supervisor:
+                futures = [
+                    supervisor.submit(archive, idx, params)
+                    for idx, params in enumerate(param_list)
+                ]
+
+            # Failed solves are written as NaN so they are not mistaken for
+            # solves that were never run
+            with WaveformArchive(archive, mode="r+") as writer:
+                for idx, (future, params) in enumerate(zip(futures, param_list)):
+                    if future.exception() is not None:
+                        writer.write(idx, _supervised_result(future, params), params)
+            return WaveformArchive(archive)
+
+        pool = mp.Pool(num_workers)
+        results = [
+            pool.apply_async(_solve_system_to_archive, (archive, idx, params))
+            for idx, params in enumerate(param_list)
+        ]
+        pool.close()
+        pool.join()
+        for result in results:
+            result.get()
+        return WaveformArchive(archive)
+
+    if timeout is not None:
+        from src.supervisor import Supervisor
+
+        with Supervisor(solve_system, num_workers, timeout) as supervisor:
+            futures = [supervisor.submit(**params) for params in param_list]
+        return [
+            _supervised_result(f, params)
+            for f, params in zip(futures, param_list)
+        ]
+
     manager = mp.Manager()
     return_dict = manager.dict()
 
     pool = mp.Pool(num_workers)
-    for idx, param in enumerate(param_list):
-        pool.apply_async(_solve_system, (return_dict, idx, param_list[idx]))
+    results = [
+        pool.apply_async(_solve_system, (return_dict, idx, param))
+        for idx, param in enumerate(param_list)
+    ]
     pool.close()
     pool.join()
-    return list(return_dict.values())
+    # Re-raises the exception of any solve that failed
+    for result in results:
+        result.get()
+    return [return_dict[idx] for idx in range(len(param_list))]
+
+
+def _merge_inputs(inputs: dict, overrides: dict) -> dict:
+    """Returns a copy of nested solver inputs updated with overrides."""
+    merged = {key: dict(value) for key, value in inputs.items()}
+    for key, value in overrides.items():
+        merged.setdefault(key, dict()).update(value)
+    return merged
+
+
+def beat_metrics(sol: dict) -> dict:
+    """Returns summary metrics of a single cardiac cycle.
+
+    Args:
+        sol (dict) : Solution dictionary of a single cycle.
+
+    Returns:
+        metrics (dict) : Systolic ('sys'), diastolic ('dia') and mean ('map')
+                systemic artery pressure (mmHg), stroke volume ('sv', mL),
+                cardiac output ('co', L/min) and the end diastolic and end
+                systolic left ventricular volumes ('edv' and 'esv', mL).
+    """
+    t = sol['Time (s)']
+    dt = t[1] - t[0]
+    period = t[-1] - t[0] + dt
+    pressure = sol['Systemic Artery Pressure']
+    sv = np.sum(sol['Aortic Valve Flow']) * dt
+    return {
+        "sys": np.max(pressure),
+        "dia": np.min(pressure),
+        "map": np.mean(pressure),
+        "sv": sv,
+        "co": sv * 60 / period / 1000,
+        "edv": np.max(sol['Left Ventricular Volume']),
+        "esv": np.min(sol['Left Ventricular Volume']),
+    }
+
+
+def interpolate_schedule(times, values: dict):
+    """Creates a beat schedule by interpolating input time series.
+
+    Args:
+        times (np.ndarray) : Times (s) of the samples.
+        values (dict) : Maps flattened solver inputs (e.g. "thermal_system.t_cr"
+                or "generic_params.period") to their samples at each time.
+
+    Returns:
+        schedule (callable) : Returns the inputs of the beat starting at a
+                time, or None once the time is beyond the last sample.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    keys = [key.split(".", 1) for key in values.keys()]
+    samples = [np.asarray(v, dtype=np.float64) for v in values.values()]
+
+    def schedule(t: float, beat: int) -> Optional[dict]:
+        if t > times[-1]:
+            return None
+        overrides = dict()
+        for (section, key), sample in zip(keys, samples):
+            overrides.setdefault(section, dict())[key] = float(
+                np.interp(t, times, sample)
+            )
+        return overrides
+
+    return schedule
+
+
+def solve_system_stream(
+        schedule,
+        inputs: Optional[dict] = None,
+        duration: Optional[float] = None,
+        output: str = "metrics",
+        decimate: int = 1,
+        channels: Optional[list] = None,
+        initial_state: Optional[npt.NDArray[np.float64]] = None,
+):
+    """Simulates the system beat by beat with inputs that change every beat.
+
+    Each beat is solved for a single cycle starting from the state at the end
+    of the previous beat, so only one beat is held in memory at a time no
+    matter how long is simulated. Unless an initial state is supplied, the
+    first beat is solved for ncycle cycles to reach a periodic state.
+
+    Args:
+        schedule (iterable or callable) : Inputs for each beat, in the same
+                nested format as solve_system (e.g. {"generic_params":
+                {"period": 0.8}, "thermal_system": {"t_cr": 37.2}}) which
+                update the base inputs. Either an iterable yielding the inputs
+                of each beat or a callable taking the start time of the beat
+                and the beat number and returning its inputs (or None to
+                stop), see interpolate_schedule.
+        inputs (dict, optional) : Base inputs passed to solve_system.
+        duration (float, optional) : Simulated time (s) to stop after.
+                If None (default), runs until the schedule ends.
+        output (str, optional) : "metrics" (default) yields beat_metrics of
+                each beat, "waveforms" yields each beat's solution.
+        decimate (int, optional) : Keeps every decimate-th sample of the
+                waveforms. Defaults to 1.
+        channels (list, optional) : Solution keys to yield with waveforms.
+                If None (default), yields every key.
+        initial_state (np.ndarray, optional) : State to start from.
+
+    Yields:
+        beat (dict) : For "metrics", the beat number ('beat'), start time
+                ('t'), period ('period'), solve status ('status') and
+                beat_metrics of the beat. For "waveforms", a Solution with the
+                time axis offset by the start of the beat and the beat number,
+                start time, period, status, state and beat_metrics in its
+                metadata. A beat that diverges (status other than STATUS_OK)
+                is the last beat yielded, as every later beat would start from
+                its NaN state.
+    """
+    if output not in ("metrics", "waveforms"):
+        logger.critical(f"Output must be 'metrics' or 'waveforms', not {output}.")
+        raise ValueError
+
+    inputs = dict() if inputs is None else inputs
+    channels = list(SOLUTION_KEYS) if channels is None else list(channels)
+    beats = schedule if callable(schedule) else iter(schedule)
+
+    state = initial_state
+    t = 0.0
+    beat = 0
+    while duration is None or t < duration:
+        if callable(beats):
+            overrides = beats(t, beat)
+        else:
+            overrides = next(beats, None)
+        if overrides is None:
+            break
+
+        beat_inputs = _merge_inputs(inputs, overrides)
+        if state is not None:
+            beat_inputs.setdefault("generic_params", dict())["ncycle"] = 1
+
+        sol = solve_system(**beat_inputs, initial_state=state)
+        state = sol.metadata["state"]
+        status = sol.metadata["status"]
+        if status == STATUS_OK and not np.all(np.isfinite(state)):
+            status = STATUS_NONFINITE
+
+        time = sol['Time (s)']
+        period = time[-1] - time[0] + time[1] - time[0]
+
+        if output == "metrics":
+            yield {
+                "beat": beat, "t": t, "period": period, "status": status,
+                **beat_metrics(sol),
+            }
+        else:
+            waveforms = Solution(
+                {key: sol[key][::decimate].copy() for key in channels},
+                metadata={
+                    "beat": beat, "t": t, "period": period, "status": status,
+                    "state": state, "metrics": beat_metrics(sol),
+                },
+            )
+            if 'Time (s)' in waveforms:
+                waveforms['Time (s)'] += t
+            yield waveforms
+
+        if status != STATUS_OK:
+            logger.warning(
+                f"Solution diverged at beat {beat} (t={t:.2f}s), stopping."
+            )
+            return
+
+        t += period
+        beat += 1
 
 
 if __name__ == "__main__":
@@ -17,7 +17,8 @@ subroutine closed_loop_lumped(nstep, &
      tv_leff, tv_aeffmin, tv_aeffmax, tv_kvc, tv_kvo, &
      t1, t2, t3, t4, &
      q_sk_basal, k_dil, T_cr, T_cr_ref, k_con, T_sk, T_sk_ref, &
-     sol_out) bind(c, name='solve_system')
+     sol_out, use_state, state, npar, sens_params, sens_out, &
+     collect_stats, stats, check_every, status) bind(c, name='solve_system')
 
   use iso_c_binding
   use funcs
@@ -46,6 +47,15 @@ subroutine closed_loop_lumped(nstep, &
   real(c_double), intent(in), value :: pv_leff, pv_aeffmin, pv_aeffmax, pv_kvc, pv_kvo
   real(c_double), intent(in), value :: tv_leff, tv_aeffmin, tv_aeffmax, tv_kvc, tv_kvo
   real(c_double), intent(in), value :: q_sk_basal, k_dil, T_cr, T_cr_ref, k_con, T_sk, T_sk_ref
+  integer(c_int), intent(in), value :: use_state
+  real(c_double), intent(inout) :: state(22)
+  integer(c_int), intent(in), value :: npar
+  integer(c_int), intent(in) :: sens_params(npar)
+  real(c_double), intent(out) :: sens_out(26, nstep, npar)
+  integer(c_int), intent(in), value :: collect_stats
+  type (solver_stats), intent(inout) :: stats
+  integer(c_int), intent(in), value :: check_every
+  integer(c_int), intent(out) :: status
 
   type (arterial_system) :: sys, pulm
   type (chamber) :: LV, LA, RV, RA
@@ -57,6 +67,18 @@ subroutine closed_loop_lumped(nstep, &
   real(dp) :: sol(31, nstep)
   real(c_double), intent(out) :: sol_out(31, nstep)
 
+  ! Unallocated when not continuing from a state so it is passed as absent
+  real(dp), allocatable :: state_in(:)
+  real(dp) :: state_out(22)
+
+  ! Sensitivities of the solution to the parameters in sens_params
+  real(dp) :: sens(26, nstep, npar)
+
+  ! Unallocated when not collecting statistics so it is passed as absent
+  type (solver_stats), allocatable :: stats_in
+  real(dp) :: t_copy
+  integer :: stat
+
   ! Sets E scales to be 1 - this will likely be removed soon
   ! But will wait for further model development before deciding.
   scale_Emax = real(1, c_double)
@@ -93,6 +115,18 @@ subroutine closed_loop_lumped(nstep, &
        real(k_dil, dp), real(T_cr, dp), real(T_cr_ref, dp), &
        real(k_con, dp), real(T_sk, dp), real(T_sk_ref, dp))
 
+  ! Initial state, if continuing from a previous solution
+  if (use_state /= 0) then
+     allocate(state_in(22))
+     state_in = real(state, dp)
+  end if
+
+  ! Statistics of the solve, if requested
+  if (collect_stats /= 0) then
+     allocate(stats_in)
+     stats_in = stats
+  end if
+
   ! Solves the system
   sol = solve_system(int(nstep), &
        real(T, dp), int(ncycle), int(rk), real(pini_sys, dp), real(pini_pulm, dp), &
@@ -103,7 +137,23 @@ subroutine closed_loop_lumped(nstep, &
        LV, LA, RV, RA, &
        logical(est_h_vol), real(height, dp), real(weight, dp), real(age, dp), real(sex, dp), &
        real(t1, dp), real(t2, dp), real(t3, dp), real(t4, dp), &
-       therm)
+       therm, state_in=state_in, state_out=state_out, &
+       sens_params=int(sens_params), sens_out=sens, stats=stats_in, &
+       check_every=int(check_every), status=stat)
 
+  if (allocated(stats_in)) t_copy = wall_time()
+  status = int(stat, c_int)
   sol_out = real(sol, c_double)
+  state = real(state_out, c_double)
+  if (npar > 0) then
+     sens_out = real(sens, c_double)
+  end if
+
+  ! The copy to the outputs is part of the post-processing
+  if (allocated(stats_in)) then
+     t_copy = wall_time() - t_copy
+     stats = stats_in
+     stats%t_post = stats%t_post + t_copy
+     stats%t_total = stats%t_total + t_copy
+  end if
 end subroutine closed_loop_lumped
@@ -0,0 +1,340 @@
+#! /usr/bin/env python
+"""Convergence studies of the solver settings against a reference solution."""
+
+# Python imports
+import time
+import logging
+import itertools
+import multiprocessing as mp
+from typing import Optional
+
+# Module imports
+import numpy as np
+
+# Local imports
+from src.cl0 import solve_system, solve_system_periodic, beat_metrics
+
+logger = logging.getLogger(__name__)
+
+# Solver settings swept by default, from cheapest to most expensive
+DEFAULT_NSTEPS = (500, 1000, 2000, 4000)
+DEFAULT_NCYCLES = (2, 5, 10, 15, 20, 30, 40)
+DEFAULT_RKS = (2, 4)
+
+# Metrics whose relative error is measured
+METRICS = ("sys", "dia", "sv", "co")
+
+# Waveforms whose error is measured
+WAVEFORM_CHANNELS = (
+    "Systemic Artery Pressure",
+    "Left Ventricular Pressure",
+    "Left Ventricular Volume",
+    "Aortic Valve Flow",
+)
+
+
+def solve_reference(inputs: Optional[dict] = None, nstep: int = 8000) -> dict:
+    """Solves the high resolution reference for a convergence study.
+
+    The reference is the periodic steady state (see solve_system_periodic)
+    solved with a 4th order scheme and many time steps, so that it has
+    neither time stepping nor transient error.
+
+    Args:
+        inputs (dict, optional) : Inputs passed to solve_system.
+        nstep (int, optional) : Number of time steps. Defaults to 8000.
+
+    Returns:
+        sol (Solution) : Reference solution of a single cycle.
+    """
+    inputs = dict() if inputs is None else inputs
+    generic_params = dict(inputs.get("generic_params", dict()))
+    generic_params.update({"nstep": nstep, "rk": 4})
+
+    sol, info = solve_system_periodic(
+        tol=1e-9, max_iter=100,
+        **{**inputs, "generic_params": generic_params},
+    )
+    if not info["converged"]:
+        logger.warning(
+            f"Reference did not converge, residual {info['residual']:.2e}."
+        )
+    return sol
+
+
+def solution_errors(
+        sol: dict,
+        reference: dict,
+        channels: tuple = WAVEFORM_CHANNELS,
+) -> dict:
+    """Returns the error of a solution relative to a reference.
+
+    Metric errors are relative to the reference metric. Waveform errors are
+    the root mean square difference after interpolating the reference onto
+    the time steps of the solution, relative to the range of the reference
+    waveform. Solutions that are not finite have infinite errors.
+
+    Args:
+        sol (dict) : Solution of the last cycle.
+        reference (dict) : Reference solution of a single cycle.
+        channels (tuple, optional) : Waveforms whose error is measured.
+
+    Returns:
+        errors (dict) : The error of each metric ('sys', 'dia', 'sv' and
+                'co'), of each waveform and the largest waveform error
+                ('waveform').
+    """
+    channels = tuple(channels)
+    keys = METRICS + channels + ("waveform",)
+    finite = channels + ("Aortic Valve Flow", "Systemic Artery Pressure")
+    if not all(np.all(np.isfinite(sol[key])) for key in finite):
+        return {key: np.inf for key in keys}
+
+    metrics = beat_metrics(sol)
+    ref_metrics = beat_metrics(reference)
+    errors = {
+        key: abs(metrics[key] - ref_metrics[key]) / abs(ref_metrics[key])
+        for key in METRICS
+    }
+
+    # Phase within the cycle, both start at the start of a cycle
+    t = sol['Time (s)'] - sol['Time (s)'][0]
+    t_ref = reference['Time (s)'] - reference['Time (s)'][0]
+    period = t_ref[-1] + t_ref[1]
+    for key in channels:
+        ref = np.interp(t, t_ref, reference[key], period=period)
+        errors[key] = (
+            np.sqrt(np.mean((sol[key] - ref) ** 2))
+            / max(np.ptp(reference[key]), 1e-12)
+        )
+    errors["waveform"] = max(errors[key] for key in channels) if channels else 0.0
+    return errors
+
+
+def convergence_study(
+        inputs: Optional[dict] = None,
+        nsteps: tuple = DEFAULT_NSTEPS,
+        ncycles: tuple = DEFAULT_NCYCLES,
+        rks: tuple = DEFAULT_RKS,
+        reference: Optional[dict] = None,
+        reference_nstep: int = 8000,
+        channels: tuple = WAVEFORM_CHANNELS,
+) -> list:
+    """Measures the accuracy and cost of each combination of solver settings.
+
+    Args:
+        inputs (dict, optional) : Inputs passed to solve_system, nstep,
+                ncycle and rk are overridden.
+        nsteps (tuple, optional) : Numbers of time steps to sweep.
+        ncycles (tuple, optional) : Numbers of cardiac cycles to sweep.
+        rks (tuple, optional) : Runge-Kutta orders to sweep.
+        reference (dict, optional) : Reference solution. If None (default),
+                solved with solve_reference.
+        reference_nstep (int, optional) : Number of time steps of the
+                reference. Defaults to 8000.
+        channels (tuple, optional) : Waveforms whose error is measured.
+
+    Returns:
+        study (list) : A dictionary for each combination, from cheapest to
+                most expensive, of its settings ('nstep', 'ncycle' and
+                'rk'), its cost in right hand side evaluations ('cost'), its
+                wall time ('time', s) and its errors ('errors', see
+                solution_errors).
+    """
+    inputs = dict() if inputs is None else inputs
+    if reference is None:
+        reference = solve_reference(inputs, reference_nstep)
+
+    study = []
+    for nstep, ncycle, rk in itertools.product(nsteps, ncycles, rks):
+        generic_params = dict(inputs.get("generic_params", dict()))
+        generic_params.update({"nstep": nstep, "ncycle": ncycle, "rk": rk})
+
+        start = time.perf_counter()
+        with np.errstate(all="ignore"):
+            sol = solve_system(**{**inputs, "generic_params": generic_params})
+            elapsed = time.perf_counter() - start
+            errors = solution_errors(sol, reference, channels)
+
+        study.append({
+            "nstep": nstep,
+            "ncycle": ncycle,
+            "rk": rk,
+            "cost": nstep * ncycle * rk,
+            "time": elapsed,
+            "errors": errors,
+        })
+
+    return sorted(
+        study,
+        key=lambda record: tuple(record[key] for key in ("cost", "nstep", "ncycle", "rk")),
+    )
+
+
+def _meets_target(
+        errors: dict,
+        tol: float,
+        metrics: tuple,
+        waveform_tol: Optional[float],
+) -> bool:
+    """Whether the errors of a configuration meet an accuracy target."""
+    if any(not errors[key] <= tol for key in metrics):
+        return False
+    return waveform_tol is None or errors["waveform"] <= waveform_tol
+
+
+def recommend(
+        study: list,
+        tol: float = 1e-2,
+        metrics: tuple = METRICS,
+        waveform_tol: Optional[float] = None,
+) -> Optional[dict]:
+    """Recommends the cheapest solver settings that meet an accuracy target.
+
+    Args:
+        study (list) : Output of convergence_study.
+        tol (float, optional) : Largest relative error of each metric.
+                Defaults to 1e-2.
+        metrics (tuple, optional) : Metrics the target applies to.
+                Defaults to sys, dia, sv and co.
+        waveform_tol (float, optional) : Largest relative waveform error.
+                If None (default), waveforms are not checked.
+
+    Returns:
+        generic_params (dict) : The nstep, ncycle and rk to solve with, or
+                None if no settings meet the target.
+    """
+    for record in study:
+        if _meets_target(record["errors"], tol, metrics, waveform_tol):
+            return {key: record[key] for key in ("nstep", "ncycle", "rk")}
+
+    logger.warning(f"No solver settings meet a tolerance of {tol}.")
+    return None
+
+
+def sample_cohort(
+        num_patients: int,
+        params: Optional[dict] = None,
+        inputs: Optional[dict] = None,
+        seed: Optional[int] = None,
+) -> list:
+    """Samples a cohort of patients uniformly within parameter bounds.
+
+    Args:
+        num_patients (int) : Number of patients.
+        params (dict, optional) : Nested parameters mapped to their
+                [lower, upper, default] bounds, as passed to the Optimiser.
+                If None (default), uses load_default_params.
+        inputs (dict, optional) : Inputs shared by every patient.
+        seed (int, optional) : Seed of the random number generator.
+
+    Returns:
+        param_list (list) : Inputs of each patient.
+    """
+    from src.cl0 import _flatten_dict, _unflatten_dict
+    from src.opt import load_default_params
+
+    params = load_default_params() if params is None else params
+    inputs = dict() if inputs is None else inputs
+    rng = np.random.default_rng(seed)
+
+    param_list = []
+    for _ in range(num_patients):
+        sample = _unflatten_dict({
+            key: float(rng.uniform(bounds[0], bounds[1]))
+            for key, bounds in _flatten_dict(params).items()
+        })
+        patient = {key: dict(value) for key, value in inputs.items()}
+        for key, value in sample.items():
+            patient.setdefault(key, dict()).update(value)
+        param_list.append(patient)
+    return param_list
+
+
+def _study_patient(kwargs: dict) -> list:
+    """Wrapper to run a convergence study in a worker."""
+    with np.errstate(all="ignore"):
+        return convergence_study(**kwargs)
+
+
+def population_study(
+        param_list: list,
+        tol: float = 1e-2,
+        metrics: tuple = METRICS,
+        waveform_tol: Optional[float] = None,
+        coverage: float = 1.0,
+        num_workers: Optional[int] = None,
+        **kwargs,
+) -> dict:
+    """Finds solver settings that are accurate enough across a cohort.
+
+    Runs a convergence study for every patient and recommends the cheapest
+    settings that meet the accuracy target for at least a fraction of the
+    cohort.
+
+    Args:
+        param_list (list) : Inputs of each patient, e.g. from sample_cohort.
+        tol (float, optional) : Largest relative error of each metric.
+                Defaults to 1e-2.
+        metrics (tuple, optional) : Metrics the target applies to.
+        waveform_tol (float, optional) : Largest relative waveform error.
+                If None (default), waveforms are not checked.
+        coverage (float, optional) : Fraction of the cohort that must meet
+                the target. Defaults to 1 (every patient).
+        num_workers (int, optional) : Maximum number of processes to use.
+        **kwargs : Passed to convergence_study (e.g. nsteps, ncycles, rks).
+
+    Returns:
+        result (dict) : The recommended generic parameters
+                ('recommendation', None if no settings are accurate enough)
+                and, for each combination of settings from cheapest to most
+                expensive ('settings'), the fraction of the cohort meeting
+                the target ('pass_fraction') and the worst error of each
+                metric and waveform over the cohort ('worst').
+    """
+    num_workers = mp.cpu_count() - 1 if num_workers is None else num_workers
+    num_workers = max(1, min(len(param_list), num_workers))
+    logger.info(
+        f"Running convergence studies of {len(param_list)} patients "
+        f"using {num_workers} workers."
+    )
+
+    with mp.Pool(num_workers) as pool:
+        studies = pool.map(
+            _study_patient,
+            [{"inputs": inputs, **kwargs} for inputs in param_list],
+        )
+
+    settings = []
+    for records in zip(*studies):
+        passed = [
+            _meets_target(record["errors"], tol, metrics, waveform_tol)
+            for record in records
+        ]
+        settings.append({
+            **{key: records[0][key] for key in ("nstep", "ncycle", "rk", "cost")},
+            "time": float(np.mean([record["time"] for record in records])),
+            "pass_fraction": float(np.mean(passed)),
+            "worst": {
+                key: max(record["errors"][key] for record in records)
+                for key in records[0]["errors"].keys()
+            },
+        })
+
+    recommendation = None
+    for setting in settings:
+        if setting["pass_fraction"] >= coverage:
+            recommendation = {
+                key: setting[key] for key in ("nstep", "ncycle", "rk")
+            }
+            break
+    if recommendation is None:
+        logger.warning(
+            f"No solver settings meet a tolerance of {tol} for "
+            f"{coverage:.0%} of the cohort."
+        )
+
+    return {
+        "recommendation": recommendation,
+        "settings": settings,
+    }
@@ -1,6 +1,7 @@
 module data_types
 
     use kind_parameter
+    use iso_c_binding, only : c_double, c_long_long
     implicit none
 
     private
@@ -9,6 +10,7 @@ module data_types
     public valve, valve_system
     public heart_elastance
     public thermal_system
+    public solver_stats
 
     ! Declares the type for each chamber
     type :: chamber
@@ -83,4 +85,17 @@ module data_types
         real(dp) :: T_sk_ref    ! Skin temperature at neutral condtions
      end type thermal_system
 
+     ! Declares the instrumentation of a solve, shared with C
+     type, bind(c) :: solver_stats
+        real(c_double) :: t_setup           ! Wall time of the coefficient setup (s)
+        real(c_double) :: t_elastance       ! Wall time of the elastance curves (s)
+        real(c_double) :: t_stepping        ! Wall time of the time stepping (s)
+        real(c_double) :: t_post            ! Wall time of the post-processing (s)
+        real(c_double) :: t_total           ! Wall time of the whole solve (s)
+        integer(c_long_long) :: rhs_evals   ! Evaluations of the right hand side
+        integer(c_long_long) :: tl_evals    ! Evaluations of the tangent linear right hand side
+        integer(c_long_long) :: steps       ! Time steps taken
+        integer(c_long_long) :: cycles      ! Cardiac cycles solved
+     end type solver_stats
+
 end module data_types
@@ -1,5 +1,6 @@
 module funcs
 
+    use, intrinsic :: ieee_arithmetic
     use kind_parameter
     use data_types
     use inputs
@@ -10,12 +11,23 @@ module funcs
 
     private
     public solver
+    public solver_tl
     public solve_system
+    public wall_time
+    public status_ok, status_nonfinite, status_out_of_range
+
+    ! Status of a solve, returned through the C interface
+    integer, parameter :: status_ok = 0            ! Solved every step
+    integer, parameter :: status_nonfinite = 1     ! State became NaN or infinite
+    integer, parameter :: status_out_of_range = 2  ! State left the physiological range
+
+    ! Largest magnitude of the pressures (mmHg) in the physiological range
+    real(dp), parameter :: max_pressure = 1.0e4_dp
 
 contains
 
     ! Solves the system
-    pure function solver(sol, a_cof, v_cof, h_cof, elast, therm, k) result(ftot)
+    pure function solver(sol, a_cof, v_cof, h_cof, elast, k) result(ftot)
 
         ! Declare input variables
         real(dp), dimension(22), intent(in) :: sol
@@ -23,7 +35,6 @@ contains
         type (valve_system), intent(in) :: v_cof
         type (chambers), intent(in) :: h_cof
         type (heart_elastance), intent(in) :: elast
-        type (thermal_system), intent(in) :: therm
         integer, intent(in) :: k
 
         real(dp), dimension(22) :: ftot
@@ -37,7 +48,6 @@ contains
         real(dp), dimension(4) :: B
         real(dp), dimension(4) :: Z
         real(dp) :: dpav, dpmv, dppv, dptv
-        real(dp) :: R_scp
 
         ! Initialises ftot to be zero
         ftot = 0.0_dp
@@ -87,9 +97,8 @@ contains
         ! Inductance and resistance systemic 
         ftot(2) = (psas - psat - a_cof%sys%Ras * Qsas) / a_cof%sys%Las
 
-        ! Updates capillary resistance based on thermal model
-        R_scp = calc_r_sk(a_cof%sys%Rcp, therm)
-        ftot(3) = (psat - psvn - (a_cof%sys%Rat + a_cof%sys%Rar + R_scp)* Qsat) / a_cof%sys%Lat
+        ! Capillary resistance already includes the thermal model (see solve_system)
+        ftot(3) = (psat - psvn - (a_cof%sys%Rat + a_cof%sys%Rar + a_cof%sys%Rcp)* Qsat) / a_cof%sys%Lat
         Qsvn = (psvn  - pra) / a_cof%sys%Rvn
 
         ! Inductance and resistance pulmonary
@@ -178,6 +187,231 @@ contains
         end if
     end function solver
 
+    pure function solver_tl(sol, sol_d, a_cof, a_cof_d, v_cof, h_cof, elast, elast_d, k) result(ftot_d)
+        ! Tangent linear (forward derivative) of solver in the direction of a
+        ! change in the state (sol_d) and in the coefficients (a_cof_d and
+        ! elast_d). Only the resistances and compliances of a_cof_d and the
+        ! elastances of elast_d are used, everything else is held fixed.
+
+        ! Declare input variables
+        real(dp), dimension(22), intent(in) :: sol, sol_d
+        type (arterial_network), intent(in) :: a_cof, a_cof_d
+        type (valve_system), intent(in) :: v_cof
+        type (chambers), intent(in) :: h_cof
+        type (heart_elastance), intent(in) :: elast, elast_d
+        integer, intent(in) :: k
+
+        real(dp), dimension(22) :: ftot_d
+        real(dp) :: mmHg, resist, rho
+        real(dp) :: Qav, Qsas, Qsat, Qtv, Qpv, Qpas, Qpat, Qmv, Qpvn, Qsvn
+        real(dp) :: psas, psat, psvn, ppas, ppat, ppvn
+        real(dp) :: plv, pla, prv, pra
+        real(dp) :: Qpvn_d, Qsvn_d, plv_d, pla_d, prv_d, pra_d
+        real(dp) :: R_sys, R_pulm, R_sys_d, R_pulm_d
+        real(dp), dimension(4) :: ksi, ksi_d, Q, Q_d, dp_v, dp_v_d
+        real(dp), dimension(4) :: Aeff, Aeff_d, B, B_d, Z, Z_d
+        real(dp), dimension(4) :: Aeffmin, Aeffmax, Leff, Kvc, Kvo
+        integer, dimension(4), parameter :: iq = [1, 8, 5, 4]
+        integer :: j
+
+        ftot_d = 0.0_dp
+
+        mmHg = 1333.0_dp
+        resist = 1.0_dp
+        rho = a_cof%rho
+
+        ! Flows
+        Qav = sol(1)
+        Qsas = sol(2)
+        Qsat = sol(3)
+        Qtv = sol(4)
+        Qpv = sol(5)
+        Qpas = sol(6)
+        Qpat = sol(7)
+        Qmv = sol(8)
+
+        ! Pressures
+        psas = sol(9)
+        psat = sol(10)
+        psvn = sol(11)
+        ppas = sol(12)
+        ppat = sol(13)
+        ppvn = sol(14)
+
+        ! Pressures in the chambers of the heart
+        plv = elast%ELV(k) * (sol(15) - h_cof%LV%V0_1)
+        pla = elast%ELA(k) * (sol(16) - h_cof%LA%V0_1)
+        prv = elast%ERV(k) * (sol(17) - h_cof%RV%V0_1)
+        pra = elast%ERA(k) * (sol(18) - h_cof%RA%V0_1)
+        plv_d = elast_d%ELV(k) * (sol(15) - h_cof%LV%V0_1) + elast%ELV(k) * sol_d(15)
+        pla_d = elast_d%ELA(k) * (sol(16) - h_cof%LA%V0_1) + elast%ELA(k) * sol_d(16)
+        prv_d = elast_d%ERV(k) * (sol(17) - h_cof%RV%V0_1) + elast%ERV(k) * sol_d(17)
+        pra_d = elast_d%ERA(k) * (sol(18) - h_cof%RA%V0_1) + elast%ERA(k) * sol_d(18)
+
+        ! Inductance and resistance systemic
+        ftot_d(2) = (sol_d(9) - sol_d(10) - a_cof_d%sys%Ras * Qsas &
+             - a_cof%sys%Ras * sol_d(2)) / a_cof%sys%Las
+
+        R_sys = a_cof%sys%Rat + a_cof%sys%Rar + a_cof%sys%Rcp
+        R_sys_d = a_cof_d%sys%Rat + a_cof_d%sys%Rar + a_cof_d%sys%Rcp
+        ftot_d(3) = (sol_d(10) - sol_d(11) - R_sys_d * Qsat - R_sys * sol_d(3)) / a_cof%sys%Lat
+        Qsvn = (psvn - pra) / a_cof%sys%Rvn
+        Qsvn_d = (sol_d(11) - pra_d - Qsvn * a_cof_d%sys%Rvn) / a_cof%sys%Rvn
+
+        ! Inductance and resistance pulmonary
+        ftot_d(6) = (sol_d(12) - sol_d(13) - a_cof_d%pulm%Ras * Qpas &
+             - a_cof%pulm%Ras * sol_d(6)) / a_cof%pulm%Las
+
+        R_pulm = a_cof%pulm%Rat + a_cof%pulm%Rar + a_cof%pulm%Rcp
+        R_pulm_d = a_cof_d%pulm%Rat + a_cof_d%pulm%Rar + a_cof_d%pulm%Rcp
+        ftot_d(7) = (sol_d(13) - sol_d(14) - R_pulm_d * Qpat - R_pulm * sol_d(7)) / a_cof%pulm%Lat
+        Qpvn = (ppvn - pla) / a_cof%pulm%Rvn
+        Qpvn_d = (sol_d(14) - pla_d - Qpvn * a_cof_d%pulm%Rvn) / a_cof%pulm%Rvn
+
+        ! Compliance systemic
+        ftot_d(9) = (sol_d(1) - sol_d(2) - (Qav - Qsas) * a_cof_d%sys%Cas / a_cof%sys%Cas) &
+             / a_cof%sys%Cas
+        ftot_d(10) = (sol_d(2) - sol_d(3) - (Qsas - Qsat) * a_cof_d%sys%Cat / a_cof%sys%Cat) &
+             / a_cof%sys%Cat
+        ftot_d(11) = (sol_d(3) - Qsvn_d - (Qsat - Qsvn) * a_cof_d%sys%Cvn / a_cof%sys%Cvn) &
+             / a_cof%sys%Cvn
+
+        ! Compliance Pulmonary
+        ftot_d(12) = (sol_d(5) - sol_d(6) - (Qpv - Qpas) * a_cof_d%pulm%Cas / a_cof%pulm%Cas) &
+             / a_cof%pulm%Cas
+        ftot_d(13) = (sol_d(6) - sol_d(7) - (Qpas - Qpat) * a_cof_d%pulm%Cat / a_cof%pulm%Cat) &
+             / a_cof%pulm%Cat
+        ftot_d(14) = (sol_d(7) - Qpvn_d - (Qpat - Qpvn) * a_cof_d%pulm%Cvn / a_cof%pulm%Cvn) &
+             / a_cof%pulm%Cvn
+
+        ! Volume-Flow relations systemic
+        ftot_d(15) = sol_d(8) - sol_d(1)
+        ftot_d(16) = Qpvn_d - sol_d(8)
+        ftot_d(17) = sol_d(4) - sol_d(5)
+        ftot_d(18) = Qsvn_d - sol_d(4)
+
+        !!! Valves (aortic, mitral, pulmonary and tricuspid) !!!
+        ksi = sol(19:22)
+        ksi_d = sol_d(19:22)
+        Q = [Qav, Qmv, Qpv, Qtv]
+        Q_d = [sol_d(1), sol_d(8), sol_d(5), sol_d(4)]
+        dp_v = [plv - psas, pla - plv, prv - ppas, pra - prv] * mmHg
+        dp_v_d = [plv_d - sol_d(9), pla_d - plv_d, prv_d - sol_d(12), pra_d - prv_d] * mmHg
+        Aeffmin = [v_cof%AV%Aeffmin, v_cof%MV%Aeffmin, v_cof%PV%Aeffmin, v_cof%TV%Aeffmin]
+        Aeffmax = [v_cof%AV%Aeffmax, v_cof%MV%Aeffmax, v_cof%PV%Aeffmax, v_cof%TV%Aeffmax]
+        ! The tricuspid valve uses the mitral inductance, as in solver
+        Leff = [v_cof%AV%Leff, v_cof%MV%Leff, v_cof%PV%Leff, v_cof%MV%Leff]
+        Kvc = [v_cof%AV%Kvc, v_cof%MV%Kvc, v_cof%PV%Kvc, v_cof%TV%Kvc]
+        Kvo = [v_cof%AV%Kvo, v_cof%MV%Kvo, v_cof%PV%Kvo, v_cof%TV%Kvo]
+
+        do j = 1, 4
+           Aeff(j) = (Aeffmax(j) - Aeffmin(j)) * ksi(j) + Aeffmin(j)
+           Aeff_d(j) = (Aeffmax(j) - Aeffmin(j)) * ksi_d(j)
+           B(j) = rho / (2 * Aeff(j) ** 2) * resist
+           B_d(j) = -2 * B(j) * Aeff_d(j) / Aeff(j)
+           Z(j) = rho * Leff(j) / Aeff(j)
+           Z_d(j) = -Z(j) * Aeff_d(j) / Aeff(j)
+
+           ! Pressure-flow relations through valve
+           ftot_d(iq(j)) = (dp_v_d(j) - B_d(j) * Q(j) * abs(Q(j)) &
+                - 2 * B(j) * abs(Q(j)) * Q_d(j) &
+                - (dp_v(j) - B(j) * Q(j) * abs(Q(j))) * Z_d(j) / Z(j)) / Z(j)
+
+           if (dp_v(j) <= 0) then ! Valve closing
+              ftot_d(18 + j) = Kvc(j) * (ksi_d(j) * dp_v(j) + ksi(j) * dp_v_d(j))
+           else ! Valve opening
+              ftot_d(18 + j) = Kvo(j) * ((1 - ksi(j)) * dp_v_d(j) - ksi_d(j) * dp_v(j))
+           end if
+        end do
+    end function solver_tl
+
+    subroutine coefficient_tangent(param, a_cof, elast, therm, a_cof_d, elast_d)
+        ! Derivatives of the coefficients with respect to a parameter.
+        !
+        ! | param | Parameter                               |
+        ! |-------|-----------------------------------------|
+        ! | 1     | Resistance scale (relative, d/dlog)     |
+        ! | 2     | Compliance scale (relative, d/dlog)     |
+        ! | 3     | Elastance scale (relative, d/dlog)      |
+        ! | 4     | Coefficient of vasodilation (k_dil)     |
+        ! | 5     | Coefficient of vasoconstriction (k_con) |
+
+        ! Declare input variables
+        integer, intent(in) :: param
+        type (arterial_network), intent(in) :: a_cof
+        type (heart_elastance), intent(in) :: elast
+        type (thermal_system), intent(in) :: therm
+        type (arterial_network), intent(out) :: a_cof_d
+        type (heart_elastance), intent(out) :: elast_d
+
+        real(dp) :: lambda, dlambda_dk_dil, dlambda_dk_con
+
+        a_cof_d%sys = arterial_system(0.0_dp, 0.0_dp, 0.0_dp, 0.0_dp, 0.0_dp, &
+             0.0_dp, 0.0_dp, 0.0_dp, 0.0_dp, 0.0_dp)
+        a_cof_d%pulm = a_cof_d%sys
+        a_cof_d%rho = 0.0_dp
+        elast_d = heart_elastance(ELV=0 * elast%ELV, ELA=0 * elast%ELA, &
+             ERV=0 * elast%ERV, ERA=0 * elast%ERA)
+
+        select case (param)
+        case (1) ! Resistances scaled by artery_input (not the veins)
+           a_cof_d%sys%Ras = a_cof%sys%Ras
+           a_cof_d%sys%Rat = a_cof%sys%Rat
+           a_cof_d%sys%Rar = a_cof%sys%Rar
+           a_cof_d%sys%Rcp = a_cof%sys%Rcp
+           a_cof_d%pulm%Ras = a_cof%pulm%Ras
+           a_cof_d%pulm%Rat = a_cof%pulm%Rat
+           a_cof_d%pulm%Rar = a_cof%pulm%Rar
+           a_cof_d%pulm%Rcp = a_cof%pulm%Rcp
+        case (2) ! Compliances scaled by artery_input
+           a_cof_d%sys%Cas = a_cof%sys%Cas
+           a_cof_d%sys%Cat = a_cof%sys%Cat
+           a_cof_d%sys%Cvn = a_cof%sys%Cvn
+           a_cof_d%pulm%Cas = a_cof%pulm%Cas
+           a_cof_d%pulm%Cat = a_cof%pulm%Cat
+           a_cof_d%pulm%Cvn = a_cof%pulm%Cvn
+        case (3) ! Elastance curves are linear in the minimum and maximum elastance
+           elast_d = elast
+        case (4, 5) ! Skin capillary resistance is divided by the resistance index
+           call calc_resistance_index_d(therm, lambda, dlambda_dk_dil, dlambda_dk_con)
+           if (param == 4) then
+              a_cof_d%sys%Rcp = -a_cof%sys%Rcp * dlambda_dk_dil / lambda
+           else
+              a_cof_d%sys%Rcp = -a_cof%sys%Rcp * dlambda_dk_con / lambda
+           end if
+        end select
+    end subroutine coefficient_tangent
+
+    function wall_time() result(t)
+      ! Returns the wall clock time in seconds.
+
+      ! Declares variables
+      integer(i8) :: count, rate
+      real(dp) :: t
+
+      call system_clock(count, rate)
+      t = real(count, dp) / real(rate, dp)
+
+    end function wall_time
+
+    pure function check_state(x) result(status)
+      ! Returns whether a state is finite and within the physiological range.
+
+      ! Declares variables
+      real(dp), intent(in) :: x(22)
+      integer :: status
+
+      if ( .not. all(ieee_is_finite(x)) ) then
+         status = status_nonfinite
+      else if ( any(x(15:18) < 0.0_dp) .or. any(abs(x(9:14)) > max_pressure) ) then
+         ! Negative chamber volumes or runaway pressures
+         status = status_out_of_range
+      else
+         status = status_ok
+      end if
+
+    end function check_state
+
     function solve_system(&
          nstep, &
          T, &
@@ -212,7 +446,14 @@ contains
          t2, &
          t3, &
          t4, &
-         therm) result (soln_all)
+         therm, &
+         state_in, &
+         state_out, &
+         sens_params, &
+         sens_out, &
+         stats, &
+         check_every, &
+         status) result (soln_all)
 
       ! Declares input variables
       integer, intent(in) :: nstep, ncycle, rk
@@ -225,6 +466,13 @@ contains
       logical, intent(in) :: estimate_vol
       real(dp), intent(in) :: height, weight, age, sex
       type (thermal_system), intent(in) :: therm
+      real(dp), intent(in), optional :: state_in(22)
+      real(dp), intent(out), optional :: state_out(22)
+      integer, intent(in), optional :: sens_params(:)
+      real(dp), intent(out), optional :: sens_out(:, :, :)
+      type (solver_stats), intent(inout), optional :: stats
+      integer, intent(in), optional :: check_every
+      integer, intent(out), optional :: status
 
       ! Declare temp variables
       integer :: i, icycle, k, offset
@@ -244,11 +492,35 @@ contains
       real(dp), dimension(22) :: k1, k2, k3, k4
       real(dp), allocatable :: sol(:, :)
 
+      ! Declare sensitivity variables
+      logical :: do_sens
+      integer :: j, npar
+      type (arterial_network), allocatable :: a_cof_d(:)
+      type (heart_elastance), allocatable :: elast_d(:)
+      real(dp), allocatable :: sens(:, :)
+      real(dp), dimension(22) :: k1_d, k2_d, k3_d, k4_d
+
+      ! Declare instrumentation variables
+      logical :: do_stats
+      real(dp) :: t_start, t_phase
+      integer(i8) :: rhs_evals, tl_evals
+
+      ! Declare divergence check variables
+      integer :: every, stat
+
       ! Declare output variables
       real(dp), allocatable :: soln_all(:, :)
 
       !!! Initialisation !!!
 
+      ! Phases are only timed if the statistics are requested
+      do_stats = present(stats)
+      t_start = 0.0_dp
+      if ( do_stats ) t_start = wall_time()
+      t_phase = t_start
+      rhs_evals = 0
+      tl_evals = 0
+
       ! Relevant arterial coefficients
       sys = sys_in
       pulm = pulm_in
@@ -259,6 +531,10 @@ contains
       call artery_input(sys, pulm, scale_Rsys, scale_Csys, scale_Rpulm, scale_Cpulm)
       a_cof = arterial_network(sys, pulm, rho)
 
+      ! Updates capillary resistance based on thermal model, the temperatures
+      ! are fixed during a solve so this is done once rather than in the solver
+      a_cof%sys%Rcp = calc_r_sk(a_cof%sys%Rcp, therm)
+
       ! Relevant heart coefficients
       LV = LV_in
       LA = LA_in
@@ -275,6 +551,11 @@ contains
       ! Relevant valve coefficients
       v_cof = valve_system(AV, MV, PV, TV)
 
+      if ( do_stats ) then
+         stats%t_setup = wall_time() - t_phase
+         t_phase = wall_time()
+      end if
+
       !!! Main code !!!
 
       ! Calculates elastance curves for the different chambers of the heart
@@ -305,6 +586,11 @@ contains
            ERV=midpoint(ERV), &
            ERA=midpoint(ERA))
 
+      if ( do_stats ) then
+         stats%t_elastance = wall_time() - t_phase
+         t_phase = wall_time()
+      end if
+
       ! Initialise the solution
       allocate(sol(22, ncycle * nstep + 1))
 
@@ -334,30 +620,113 @@ contains
       sol(21, 1) = 0.0_dp  ! Pulmonary valve is initially closed.
       sol(22, 1) = 0.0_dp  ! Tricuspid valve is initially closed.
 
+      ! Continues from a previous solution (e.g. the end of the previous beat)
+      if ( present(state_in) ) then
+         sol(:, 1) = state_in
+      end if
+
+      ! Sensitivities of the state to each parameter, which start at 0 as the
+      ! initial state does not depend on the parameters
+      do_sens = present(sens_params) .and. present(sens_out)
+      if ( do_sens ) do_sens = size(sens_params) > 0
+      npar = 0
+      if ( do_sens ) npar = size(sens_params)
+      allocate(a_cof_d(npar), elast_d(npar))
+      if ( do_sens ) then
+         do j = 1, npar
+            call coefficient_tangent(sens_params(j), a_cof, elast, therm, a_cof_d(j), elast_d(j))
+         end do
+         allocate(sens(22, npar))
+         sens = 0.0_dp
+      end if
+
+      if ( do_stats ) then
+         stats%t_setup = stats%t_setup + wall_time() - t_phase
+         t_phase = wall_time()
+      end if
+
+      ! Checks the state every so many steps, if 0 the state is never checked
+      every = 0
+      if ( present(check_every) ) every = max(check_every, 0)
+      stat = status_ok
+
       ! Solves the system of equations using a 4th order Runge-Kutta method
       i = 0 ! Initialise
 
-      do icycle = 1, ncycle
+      stepping: do icycle = 1, ncycle
          do k = 1, nstep
             i = i + 1
             current_sol = sol(:, i)
             if (rk == 2) then ! Second order Runge-Kutta
-               k1 = h * solver(current_sol, a_cof, v_cof, h_cof, elast, therm, k)
-               k2 = h * solver(current_sol + k1/2, a_cof, v_cof, h_cof, elast, therm, k)
+               k1 = h * solver(current_sol, a_cof, v_cof, h_cof, elast, k)
+               k2 = h * solver(current_sol + k1/2, a_cof, v_cof, h_cof, elast, k)
                sol(:, i+1) = current_sol + k2
             else if (rk == 4) then ! Fourth order Runge-Kutta
-               k1 = h * solver(current_sol, a_cof, v_cof, h_cof, elast, therm, k)
-               k2 = h * solver(current_sol + k1/2, a_cof, v_cof, h_cof, elast, therm, k)
-               k3 = h * solver(current_sol + k2/2, a_cof, v_cof, h_cof, elast, therm, k)
+               k1 = h * solver(current_sol, a_cof, v_cof, h_cof, elast, k)
+               k2 = h * solver(current_sol + k1/2, a_cof, v_cof, h_cof, elast, k)
+               k3 = h * solver(current_sol + k2/2, a_cof, v_cof, h_cof, elast, k)
                if ( k /= nstep ) then
-                  k4 = h * solver(current_sol + k3, a_cof, v_cof, h_cof, elast, therm, k+1)
+                  k4 = h * solver(current_sol + k3, a_cof, v_cof, h_cof, elast, k+1)
                else
-                  k4 = h * solver(current_sol + k3, a_cof, v_cof, h_cof, elast, therm, 1)
+                  k4 = h * solver(current_sol + k3, a_cof, v_cof, h_cof, elast, 1)
                end if
                sol(:, i + 1) = current_sol + (k1 + 2 * k2 + 2 * k3 + k4) / 6
             end if
+            rhs_evals = rhs_evals + rk
+
+            ! Stops as soon as the solve diverges, as the remaining steps
+            ! would only propagate NaNs
+            if ( every > 0 ) then
+               if ( mod(i, every) == 0 .or. i == ncycle * nstep ) then
+                  stat = check_state(sol(:, i + 1))
+                  if ( stat /= status_ok ) exit stepping
+               end if
+            end if
+
+            ! Differentiates the Runge-Kutta step (tangent linear model), so
+            ! the sensitivities are exact for the discrete solution
+            if ( do_sens ) then
+               do j = 1, npar
+                  k1_d = h * solver_tl(current_sol, sens(:, j), &
+                       a_cof, a_cof_d(j), v_cof, h_cof, elast, elast_d(j), k)
+                  k2_d = h * solver_tl(current_sol + k1/2, sens(:, j) + k1_d/2, &
+                       a_cof, a_cof_d(j), v_cof, h_cof, elast, elast_d(j), k)
+                  if (rk == 2) then
+                     sens(:, j) = sens(:, j) + k2_d
+                  else if (rk == 4) then
+                     k3_d = h * solver_tl(current_sol + k2/2, sens(:, j) + k2_d/2, &
+                          a_cof, a_cof_d(j), v_cof, h_cof, elast, elast_d(j), k)
+                     if ( k /= nstep ) then
+                        k4_d = h * solver_tl(current_sol + k3, sens(:, j) + k3_d, &
+                             a_cof, a_cof_d(j), v_cof, h_cof, elast, elast_d(j), k+1)
+                     else
+                        k4_d = h * solver_tl(current_sol + k3, sens(:, j) + k3_d, &
+                             a_cof, a_cof_d(j), v_cof, h_cof, elast, elast_d(j), 1)
+                     end if
+                     sens(:, j) = sens(:, j) + (k1_d + 2 * k2_d + 2 * k3_d + k4_d) / 6
+                  end if
+               end do
+               tl_evals = tl_evals + rk * npar
+
+               ! Only the last cycle is returned
+               if ( icycle == ncycle ) then
+                  sens_out(1:22, k, :) = sens
+               end if
+            end if
          end do
-      end do
+      end do stepping
+
+      ! The solution of a diverged solve is NaN from the failed check on
+      if ( stat /= status_ok ) then
+         sol(:, i + 1:) = ieee_value(0.0_dp, ieee_quiet_nan)
+         if ( do_sens ) sens_out = ieee_value(0.0_dp, ieee_quiet_nan)
+      end if
+      if ( present(status) ) status = stat
+
+      if ( do_stats ) then
+         stats%t_stepping = wall_time() - t_phase
+         t_phase = wall_time()
+      end if
 
       ! Calculates ventricular pressures
       allocate(h_pres(4, nstep))
@@ -377,5 +746,30 @@ contains
       soln_all(30, :) = ERA
       soln_all(31, :) = t_axis
 
+      ! Sensitivities of the ventricular pressures
+      if ( do_sens ) then
+         do j = 1, npar
+            sens_out(23, :, j) = elast_d(j)%ELV * (sol(15, offset:) - LV%v0_1) + ELV * sens_out(15, :, j)
+            sens_out(24, :, j) = elast_d(j)%ELA * (sol(16, offset:) - LA%v0_1) + ELA * sens_out(16, :, j)
+            sens_out(25, :, j) = elast_d(j)%ERV * (sol(17, offset:) - RV%v0_1) + ERV * sens_out(17, :, j)
+            sens_out(26, :, j) = elast_d(j)%ERA * (sol(18, offset:) - RA%v0_1) + ERA * sens_out(18, :, j)
+         end do
+      end if
+
+      ! State at the end of the last cycle, to continue from
+      if ( present(state_out) ) then
+         state_out = sol(:, ncycle * nstep + 1)
+      end if
+
+      if ( do_stats ) then
+         stats%t_post = wall_time() - t_phase
+         stats%t_total = wall_time() - t_start
+         stats%rhs_evals = rhs_evals
+         stats%tl_evals = tl_evals
+         stats%steps = int(i, i8)
+         ! icycle is one past ncycle once every cycle has been stepped
+         stats%cycles = int(min(icycle, ncycle), i8)
+      end if
+
     end function solve_system
 end module funcs
@@ -0,0 +1,185 @@
+#! /usr/bin/env python
+"""Vectorised conversion of patient tables into solver inputs."""
+
+# Python imports
+import os
+import sqlite3
+import logging
+from typing import Optional, Iterator
+
+# Module imports
+import numpy as np
+import pandas as pd
+
+# Local imports
+from src.cl0 import _unflatten_dict
+
+logger = logging.getLogger(__name__)
+
+# Rules map a flattened solver input (e.g. "ecg.t1") to either an expression
+# of the table's columns (evaluated with pandas.eval over the whole table),
+# a constant or a callable taking the table and returning an array.
+
+# ECG timings from heart rate (bpm) and the PR, QRS and QT intervals (s)
+ECG_INTERVAL_RULES = {
+    "generic_params.period": "60 / hr",
+    "ecg.t1": "pr / 3",
+    "ecg.t2": "pr + qrs / 2",
+    "ecg.t3": "pr + qrs + 0.75 * (qt - qrs)",
+    "ecg.t4": "pr + qt",
+}
+
+# ECG timings from a sample patient at 76 bpm scaled to the heart rate (bpm)
+ECG_TEMPLATE_RULES = {
+    "generic_params.period": "60 / hr",
+    "ecg.t1": "0.044 * 76 / hr",
+    "ecg.t2": "0.184 * 76 / hr",
+    "ecg.t3": "0.500 * 76 / hr",
+    "ecg.t4": "0.588 * 76 / hr",
+}
+
+# Heart volume estimated from height (cm), weight (kg), age (years) and sex
+HEART_VOLUME_RULES = {
+    "generic_params.est_h_vol": True,
+    "generic_params.height": "height",
+    "generic_params.weight": "weight",
+    "generic_params.age": "age",
+    "generic_params.sex": lambda df: np.where(df["sex"] == "Male", 0, 1),
+}
+
+# Core and skin temperatures along with their neutral references (°C)
+THERMAL_RULES = {
+    "thermal_system.t_cr": "core",
+    "thermal_system.t_cr_ref": "core_ref",
+    "thermal_system.t_sk": "skin",
+    "thermal_system.t_sk_ref": "skin_ref",
+}
+
+
+def apply_rules(df: pd.DataFrame, rules: dict) -> pd.DataFrame:
+    """Maps a table of patients to a table of solver inputs.
+
+    Args:
+        df (pd.DataFrame) : Table with one patient per row.
+        rules (dict) : Maps each flattened solver input to an expression of
+                the columns of df, a constant or a callable taking df.
+
+    Returns:
+        params (pd.DataFrame) : Table with one column per flattened solver
+                input and the same index as df.
+    """
+    params = dict()
+    for key, rule in rules.items():
+        if callable(rule):
+            value = rule(df)
+        elif isinstance(rule, str):
+            value = df.eval(rule)
+        else:
+            value = np.full(len(df), rule)
+        params[key] = np.asarray(value)
+
+        if params[key].shape != (len(df),):
+            logger.critical(
+                f"Rule for {key} returned shape {params[key].shape}, "
+                f"expected ({len(df)},)."
+            )
+            raise ValueError
+
+    return pd.DataFrame(params, index=df.index)
+
+
+def to_param_list(params: pd.DataFrame) -> list:
+    """Converts a table of flattened solver inputs into solve_system inputs.
+
+    Args:
+        params (pd.DataFrame) : Table of flattened solver inputs as returned
+                by apply_rules.
+
+    Returns:
+        param_list (list) : Nested input dictionaries, one per row, that can
+                be passed to solve_system_parallel or used as Optimiser inputs.
+    """
+    # Splits the keys once rather than unflattening every row
+    keys = [column.split(".") for column in params.columns]
+    if any(len(key) != 2 for key in keys):
+        return [_unflatten_dict(record) for record in params.to_dict("records")]
+
+    param_list = []
+    for values in zip(*(params[column].tolist() for column in params.columns)):
+        inputs = dict()
+        for (section, key), value in zip(keys, values):
+            inputs.setdefault(section, dict())[key] = value
+        param_list.append(inputs)
+    return param_list
+
+
+def read_table(
+        source: str,
+        table: Optional[str] = None,
+        columns: Optional[list] = None,
+        where: Optional[str] = None,
+        chunksize: int = 100000,
+) -> Iterator[pd.DataFrame]:
+    """Streams a table from a SQLite3 database or CSV file in chunks.
+
+    Args:
+        source (str) : Path to a SQLite3 database or a CSV file.
+        table (str, optional) : Table to read (SQLite3 only).
+        columns (list, optional) : Columns to read. If None (default), reads
+                every column.
+        where (str, optional) : SQL condition to filter rows (SQLite3 only).
+        chunksize (int, optional) : Number of rows per chunk.
+                Defaults to 100000.
+
+    Yields:
+        chunk (pd.DataFrame) : The next chunk of the table.
+    """
+    if os.path.splitext(source)[-1].lower() == ".csv":
+        yield from pd.read_csv(source, usecols=columns, chunksize=chunksize)
+        return
+
+    if table is None:
+        logger.critical(f"A table must be supplied to read from {source}.")
+        raise ValueError
+
+    columns_str = "*" if columns is None else ", ".join(columns)
+    query = f"SELECT {columns_str} FROM {table}"
+    if where is not None:
+        query += f" WHERE {where}"
+
+    con = sqlite3.connect(source)
+    try:
+        yield from pd.read_sql_query(query, con, chunksize=chunksize)
+    finally:
+        con.close()
+
+
+def ingest(
+        source: str,
+        rules: dict,
+        table: Optional[str] = None,
+        columns: Optional[list] = None,
+        where: Optional[str] = None,
+        chunksize: int = 100000,
+) -> Iterator[tuple]:
+    """Streams a patient table and maps each chunk to solver inputs.
+
+    Args:
+        source (str) : Path to a SQLite3 database or a CSV file.
+        rules (dict) : Rules passed to apply_rules.
+        table (str, optional) : Table to read (SQLite3 only).
+        columns (list, optional) : Columns to read. If None (default), reads
+                every column.
+        where (str, optional) : SQL condition to filter rows (SQLite3 only).
+        chunksize (int, optional) : Number of rows per chunk.
+                Defaults to 100000.
+
+    Yields:
+        chunk (pd.DataFrame) : The next chunk of the patient table.
+        params (pd.DataFrame) : Flattened solver inputs for the chunk.
+    """
+    num_rows = 0
+    for chunk in read_table(source, table, columns, where, chunksize):
+        num_rows += len(chunk)
+        logger.debug(f"Ingested {num_rows} rows from {source}")
+        yield chunk, apply_rules(chunk, rules)
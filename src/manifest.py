@@ -0,0 +1,205 @@
+#! /usr/bin/env python
+"""Manifest of completed calibrations for incremental reruns."""
+
+# Python imports
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+from typing import Optional
+
+# Module imports
+import numpy as np
+
+# Local imports
+from src.cl0 import _format_solver_inputs
+
+logger = logging.getLogger(__name__)
+
+
+def _json_default(value):
+    """Converts numpy types for JSON serialisation."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value)} is not JSON serialisable.")
+
+
+def _canonical(obj) -> str:
+    """Returns a canonical JSON string of an object."""
+    return json.dumps(obj, sort_keys=True, default=_json_default)
+
+
+def _quote(name: str) -> str:
+    """Quotes a table name for use in an SQL statement."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+class CalibrationManifest:
+
+    def __init__(
+            self,
+            db_path: str,
+            config: dict,
+            name: str = "calibration_manifest",
+            timeout: float = 60.0,
+    ):
+        """Connects to (or creates) a calibration manifest.
+
+        Each calibration is identified by the hash of its resolved solver
+        inputs (with any defaults filled in), its targets and the optimiser
+        configuration. The manifest stores the results of every hash along
+        with the hash each row id was last written with, so reruns only
+        optimise rows whose inputs (or the configuration) have changed and
+        rows sharing the same inputs are optimised once.
+
+        Args:
+                db_path (str) : Path to the SQLite3 database for the manifest.
+                config (dict) : Optimiser configuration (e.g. optimiser,
+                        parameter bounds and budget), changing it invalidates
+                        every stored result.
+                name (str, optional) : Name of the manifest table.
+                        Defaults to "calibration_manifest".
+                timeout (float, optional) : SQLite busy timeout in seconds.
+                        Defaults to 60.
+        """
+        self.db_path = db_path
+        self.name = name
+        self.rows_name = f"{name}_rows"
+        self.config = config
+        self._config_str = _canonical(config)
+
+        self.con = sqlite3.connect(db_path, timeout=timeout)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute(
+            f"CREATE TABLE IF NOT EXISTS {_quote(self.name)} "
+            "(hash TEXT PRIMARY KEY, results TEXT NOT NULL, created REAL)"
+        )
+        self.con.execute(
+            f"CREATE TABLE IF NOT EXISTS {_quote(self.rows_name)} "
+            "(row_id PRIMARY KEY, hash TEXT NOT NULL, updated REAL)"
+        )
+        self.con.commit()
+
+    def close(self):
+        """Closes the connection to the manifest."""
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def hash(self, inputs: dict, targets: Optional[dict] = None) -> str:
+        """Returns the hash of a calibration.
+
+        Args:
+                inputs (dict) : Fixed inputs as passed to solve_system.
+                targets (dict, optional) : Optimisation targets (e.g. sbp, dbp).
+
+        Returns:
+                hash (str) : Hex digest identifying the calibration.
+        """
+        resolved = _format_solver_inputs(**inputs)
+        payload = _canonical({
+            "inputs": resolved,
+            "targets": targets if targets is not None else dict(),
+        })
+        return hashlib.sha256(
+            (self._config_str + payload).encode("utf-8")
+        ).hexdigest()
+
+    def plan(self, hashes: dict) -> tuple:
+        """Splits rows by what needs to be done for them.
+
+        Rows in pending or cached may have old (or partially written) results
+        which should be removed before their new results are written.
+
+        Args:
+                hashes (dict) : Maps each row id to its calibration hash.
+
+        Returns:
+                pending (dict) : Maps each hash without results to the row ids
+                        sharing it, each needs a single optimisation.
+                cached (dict) : Maps each hash with stored results to the row
+                        ids that have not been written with it.
+                num_unchanged (int) : Number of rows already written with
+                        their current hash.
+        """
+        done = {
+            h for (h,) in self.con.execute(f"SELECT hash FROM {_quote(self.name)}")
+        }
+        written = dict(self.con.execute(
+            f"SELECT row_id, hash FROM {_quote(self.rows_name)}"
+        ).fetchall())
+
+        pending, cached = dict(), dict()
+        num_unchanged = 0
+        for row_id, h in hashes.items():
+            if written.get(row_id) == h:
+                num_unchanged += 1
+            elif h in done:
+                cached.setdefault(h, []).append(row_id)
+            else:
+                pending.setdefault(h, []).append(row_id)
+
+        logger.info(
+            f"{num_unchanged} rows unchanged, "
+            f"{sum(len(r) for r in cached.values())} rows from stored results, "
+            f"{sum(len(r) for r in pending.values())} rows sharing "
+            f"{len(pending)} new calibrations."
+        )
+        return pending, cached, num_unchanged
+
+    def record(self, h: str, results: list):
+        """Stores the results of a calibration.
+
+        Args:
+                h (str) : Calibration hash.
+                results (list) : Output rows of the calibration.
+        """
+        self.con.execute(
+            f"INSERT OR REPLACE INTO {_quote(self.name)} "
+            "(hash, results, created) VALUES (?, ?, ?)",
+            (h, _canonical(results), time.time()),
+        )
+        self.con.commit()
+
+    def results(self, h: str) -> Optional[list]:
+        """Returns the stored results of a calibration, or None."""
+        result = self.con.execute(
+            f"SELECT results FROM {_quote(self.name)} WHERE hash = ?", (h,),
+        ).fetchone()
+        return json.loads(result[0]) if result is not None else None
+
+    def mark_written(self, row_ids: list, h: str):
+        """Records that the results of a calibration were written for rows."""
+        now = time.time()
+        self.con.executemany(
+            f"INSERT OR REPLACE INTO {_quote(self.rows_name)} "
+            "(row_id, hash, updated) VALUES (?, ?, ?)",
+            ((r.item() if isinstance(r, np.generic) else r, h, now) for r in row_ids),
+        )
+        self.con.commit()
+
+    def forget_rows(self, row_ids: Optional[list] = None):
+        """Forgets which rows have been written (e.g. the outputs were replaced).
+
+        Stored results are kept so the rows can be rewritten without
+        optimising them again.
+
+        Args:
+                row_ids (list, optional) : Rows to forget. If None (default),
+                        forgets every row.
+        """
+        if row_ids is None:
+            self.con.execute(f"DELETE FROM {_quote(self.rows_name)}")
+        else:
+            self.con.executemany(
+                f"DELETE FROM {_quote(self.rows_name)} WHERE row_id = ?",
+                ((r,) for r in row_ids),
+            )
+        self.con.commit()
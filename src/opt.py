@@ -3,61 +3,61 @@
 
 # Python imports
 import sys
+import time
+import asyncio
 import logging
+import functools
+import threading
 from typing import Optional
-from collections.abc import MutableMapping
+from collections import deque
 from concurrent import futures
 
 # Module imports
 import numpy as np
 import nevergrad as ng
+from nevergrad.optimization.multiobjective import HypervolumeIndicator
 from tqdm import tqdm
 
 # Local imports
 from src import solve_system
-from src.cl0 import _format_solver_inputs
+from src.cl0 import _format_solver_inputs, _supervised_result
+from src.cl0 import _flatten_dict, _unflatten_dict
+from src.cl0 import SENSITIVITY_PARAMS, STATUS_OK, STATUS_TIMEOUT, STATUS_FAILED
+from src.checkpoint import save_state, load_state
+from src.telemetry import Telemetry
+from src import trace
+from src.supervisor import Supervisor
+from src.aio import AsyncSolver, default_solver
 
 logger = logging.getLogger(__name__)
 
 
-def _flatten_dict(
-        d: MutableMapping, parent_key: str = '', sep: str = '.'
-) -> MutableMapping:
-    """Takes a nested dictionary and returns a flattened year.
+class OptimisationCancelled(Exception):
+    """Raised inside a run that was cancelled through run_async."""
 
-    Args:
-        d (dict) : A nested dictionary.
-        parent_key (str) : Key of the parent dictionary.
-        sep (str, optional) : Separator to use for the flattened dictionary.
-                Defaults to '.'.
-    """
-    items = []
-    for k, v in d.items():
-        new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, MutableMapping):
-            items.extend(_flatten_dict(v, parent_key=new_key, sep=sep).items())
-        else:
-            items.append((new_key, v))
-    return dict(items)
+
+def _param_key(params: dict) -> tuple:
+    """Returns a hashable key for a dictionary of parameter values."""
+    return tuple(sorted(params.items()))
 
 
-def _unflatten_dict(dictionary: dict, sep: str = '.') -> dict:
-    """Unflattens a dictionary into a nested dictionary.
+def load_default_fidelities() -> list:
+    """Loads the default low fidelity rungs for multi-fidelity optimisation.
 
-    Args:
-        dictionary (dict) : Flattened dictionary.
-        sep (str, optional) : Separator for the flattened dictionary.
+    Each rung is a dictionary of generic parameters that override the
+    inputs, ordered from cheapest to most expensive. Full fidelity (the
+    inputs passed to the optimiser) is always the final rung and so is not
+    included.
+
+    Note that the explicit Runge-Kutta solver is unstable for this system
+    with few time steps or a 2nd order scheme, so the default rungs only
+    reduce the number of cardiac cycles.
     """
-    rtn_dict = dict()
-    for key, value in dictionary.items():
-        parts = key.split(".")
-        d = rtn_dict
-        for part in parts[:-1]:
-            if part not in d:
-                d[part] = dict()
-            d = d[part]
-        d[parts[-1]] = value
-    return rtn_dict
+
+    return [
+        {"ncycle": 2},
+        {"ncycle": 5},
+    ]
 
 
 def load_default_params() -> dict:
@@ -176,6 +176,16 @@ class Optimiser:
             pbar_pos: int = 0,
             tol: float = 0.0,
             multi_objective: bool = False,
+            checkpoint: Optional[str] = None,
+            checkpoint_every: int = 50,
+            fidelities: Optional[list] = None,
+            eta: float = 3,
+            stagnation_window: int = 0,
+            stagnation_tol: float = 1e-3,
+            telemetry: Optional[Telemetry] = None,
+            telemetry_name: Optional[str] = None,
+            divergence_penalty: float = 1e3,
+            timeout: Optional[float] = None,
             **kwargs,
     ):
         """Initialises the optimiser
@@ -202,10 +212,50 @@ class Optimiser:
                 multi_objective (bool, optional) : Whether to perform 
                         multi-objective optimisation.
                         Defaults to False.
+                checkpoint (str, optional) : Path to a checkpoint file.
+                        If the file exists the optimiser state is restored
+                        from it and the run continues where it stopped.
+                        If None (default), no checkpoints are written.
+                checkpoint_every (int, optional) : Number of evaluations
+                        between checkpoints. Defaults to 50.
+                fidelities (list, optional) : Low fidelity rungs for
+                        multi-fidelity optimisation, see
+                        load_default_fidelities. Each candidate is first
+                        screened at the cheapest rung and is only promoted to
+                        the next rung (and finally to full fidelity) if its
+                        loss is within the best 1/eta of the losses seen at
+                        that rung. If None (default), all candidates are
+                        evaluated at full fidelity.
+                eta (float, optional) : Reduction factor for the
+                        multi-fidelity promotion. Defaults to 3.
+                stagnation_window (int, optional) : Number of evaluations
+                        over which the Pareto front hypervolume must improve
+                        for multi-objective optimisation to continue.
+                        If 0 (default), the hypervolume is not tracked.
+                stagnation_tol (float, optional) : Relative reduction of the
+                        volume not dominated by the Pareto front over the
+                        stagnation window below which the optimisation is
+                        stopped. Defaults to 1e-3.
+                telemetry (Telemetry, optional) : Records the evaluations,
+                        solve times and NaN rate of each run, see
+                        telemetry.Telemetry. Defaults to None.
+                telemetry_name (str, optional) : Name of the patient the
+                        runs are recorded against. Defaults to "optimiser".
+                divergence_penalty (float, optional) : Loss (of each
+                        objective) of candidates whose solve diverged or left
+                        the physiological range, given without computing any
+                        metrics. Defaults to 1e3.
+                timeout (float, optional) : Wall clock time (s) each solve
+                        of a run may take. If supplied, the solves are run in
+                        num_workers supervised processes (see
+                        supervisor.Supervisor) rather than in the optimiser's
+                        threads, so a solve that hangs is killed and given
+                        divergence_penalty instead of stalling the run. The
+                        failed solves are kept in failures. Defaults to None.
         """
 
-        self.flat_inputs_raw = _flatten_dict(inputs)
         inputs = dict() if inputs is None else inputs
+        self.flat_inputs_raw = _flatten_dict(inputs)
         self.inputs = _format_solver_inputs(**inputs)
         self.flat_inputs = _flatten_dict(self.inputs)
 
@@ -240,6 +290,54 @@ class Optimiser:
         # If 'num_workers' > 1 then switch to optimisation to parallel mode
         self.parallel = bool(kwargs.get("num_workers", 1) - 1)
 
+        # Multi-fidelity rungs
+        self.fidelities = list(fidelities) if fidelities is not None else []
+        self.eta = eta
+        self.promotions = []
+        self._rung_losses = [[] for _ in self.fidelities]
+        self._rung_lock = threading.Lock()
+        self._fidelity = dict()
+
+        # Metrics of evaluations that have not yet been told
+        self._metrics = dict()
+        self.divergence_penalty = divergence_penalty
+        self.num_diverged = 0
+
+        # Supervised solves, only running during a run
+        self.timeout = timeout
+        self.failures = []
+        self._supervisor = None
+
+        # Solver pool and event loop of run_async, only set during a run
+        self._solver = None
+        self._loop = None
+        self.objectives = []
+        self._targets = []
+        self.results = None
+        self.pareto_results = None
+
+        # Pareto front hypervolume after each evaluation
+        self.hypervolumes = []
+        self._front = []
+        self._reference = None
+
+        # Restores the optimiser state from a checkpoint (if present)
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.evaluations = []
+        self._pending = []
+        self._resumed = False
+        self._last_checkpoint = 0
+        if checkpoint is not None:
+            state = load_state(checkpoint)
+            if state is not None:
+                self._restore_checkpoint(state, budget=kwargs.get("budget"))
+
+            self.optimiser.register_callback("ask", self._checkpoint_callback)
+
+        # Records every evaluated point and its loss(es)
+        self.optimiser.register_callback("tell", self._record_evaluation)
+
         # Registers early stopping (if tolerance > 0)
         if tol > 0:
             early_stopping = ng.callbacks.EarlyStopping(
@@ -247,11 +345,48 @@ class Optimiser:
             )
             self.optimiser.register_callback("ask", early_stopping)
 
+        # Registers early stopping on Pareto front stagnation
+        self.stagnation_window = stagnation_window
+        self.stagnation_tol = stagnation_tol
+        self.evaluations_saved = 0
+        if stagnation_window > 0:
+            if not multi_objective:
+                logger.warning(
+                    "Hypervolume stagnation is only tracked for "
+                    "multi-objective optimisation and will be ignored."
+                )
+            else:
+                early_stopping = ng.callbacks.EarlyStopping(
+                    self._hypervolume_stagnated
+                )
+                self.optimiser.register_callback("ask", early_stopping)
+
+        # Records throughput telemetry
+        self.telemetry = telemetry
+        self.telemetry_name = (
+            telemetry_name if telemetry_name is not None else "optimiser"
+        )
+        if telemetry is not None:
+            self.optimiser.register_callback(
+                "tell",
+                lambda *args, **kwargs: telemetry.record_evaluation(self.telemetry_name),
+            )
+
+        # Stops a run at the next candidate once it is cancelled
+        self._cancel = threading.Event()
+        self.optimiser.register_callback("ask", self._check_cancelled)
+
+        # Records the time spent asking and telling nevergrad (if tracing)
+        if trace.enabled():
+            self.optimiser.ask = trace.traced(self.optimiser.ask, "ask", "nevergrad")
+            self.optimiser.tell = trace.traced(self.optimiser.tell, "tell", "nevergrad")
+
         # Registers progress bar
         self.loss = np.inf
         if pbar:
             pbar = tqdm(
                 total=kwargs.get("budget", None),
+                initial=self.optimiser.num_tell,
                 position=pbar_pos,
                 file=sys.stdout,
                 leave=True,
@@ -269,7 +404,191 @@ class Optimiser:
         # Placeholder for recommendation
         self.recommendation = None
 
-    def solve_system(self, **flat_params) -> dict:
+    def _record_evaluation(self, optimiser, candidate, loss):
+        """Tell callback that stores the evaluated parameters and losses."""
+        self.evaluations.append({
+            "params": dict(candidate.kwargs),
+            "losses": np.array(candidate.losses, copy=True),
+            "loss": loss,
+            "fidelity": self._fidelity.get(
+                _param_key(candidate.kwargs), len(self.fidelities)
+            ),
+            "metrics": self._metrics.pop(_param_key(candidate.kwargs), {}),
+        })
+        if self.multi_objective:
+            self._update_front(self.evaluations[-1]["losses"])
+
+    def _update_front(self, losses: np.ndarray):
+        """Updates the non-dominated front and records its hypervolume.
+
+        Args:
+            losses (np.ndarray) : Losses of the latest evaluation.
+        """
+        if not np.all(np.isfinite(losses)):
+            self.hypervolumes.append(self.hypervolumes[-1] if self.hypervolumes else 0.0)
+            return
+
+        dominated = any(np.all(f <= losses) for f in self._front)
+        if not dominated:
+            self._front = [f for f in self._front if not np.all(losses <= f)]
+            self._front.append(losses)
+
+        # Points outside the reference do not contribute to the hypervolume
+        front = [f for f in self._front if np.all(f < self._reference)]
+        hypervolume = 0.0
+        if front:
+            hypervolume = HypervolumeIndicator(self._reference).compute(front)
+        self.hypervolumes.append(hypervolume)
+
+    def _hypervolume_stagnated(self, optimiser) -> bool:
+        """Early stopping criterion for the Pareto front hypervolume.
+
+        As all losses are relative errors, the ideal Pareto front is at the
+        origin. The criterion tracks the volume between the origin and the
+        reference point that is not dominated by the front and returns True
+        if it has reduced by less than stagnation_tol (relative) over the last
+        stagnation_window evaluations. The window only starts once a loss is
+        within the reference point, until then the hypervolume is 0.
+        """
+        start = next(
+            (i for i, hv in enumerate(self.hypervolumes) if hv > 0),
+            len(self.hypervolumes),
+        )
+        if len(self.hypervolumes) - start <= self.stagnation_window:
+            return False
+
+        volume = np.prod(self._reference)
+        current = self.hypervolumes[-1]
+        gap = volume - current
+        previous_gap = volume - self.hypervolumes[-1 - self.stagnation_window]
+        stagnated = previous_gap - gap <= self.stagnation_tol * previous_gap
+        if stagnated and not self.evaluations_saved:
+            self.evaluations_saved = max(0, optimiser.budget - optimiser.num_ask)
+            logger.info(
+                "Pareto front hypervolume stagnated at "
+                f"{current:.6g} after {optimiser.num_tell} evaluations, "
+                f"saving {self.evaluations_saved} evaluations."
+            )
+        return stagnated
+
+    def _check_cancelled(self, optimiser):
+        """Ask callback that stops a run cancelled through run_async."""
+        if self._cancel.is_set():
+            raise OptimisationCancelled
+
+    def _checkpoint_callback(self, optimiser):
+        """Ask callback that periodically writes a checkpoint."""
+        if optimiser.num_tell - self._last_checkpoint >= self.checkpoint_every:
+            self.save_checkpoint()
+
+    def _restore_checkpoint(self, state: dict, budget: Optional[int] = None):
+        """Restores the optimiser from a checkpoint state.
+
+        Args:
+            state (dict) : State as written by save_checkpoint.
+            budget (int, optional) : Budget to continue with, replacing that
+                    of the checkpoint. Defaults to None.
+        """
+        optimiser = state["optimiser"]
+        expected = set(self.optimiser.parametrization.kwargs.keys())
+        found = set(optimiser.parametrization.kwargs.keys())
+        if expected != found or type(optimiser) is not type(self.optimiser):
+            logger.critical(
+                f"Checkpoint {self.checkpoint} does not match the optimiser.\n"
+                f"Expected parameters:\n{sorted(expected)}\n"
+                f"Checkpoint parameters:\n{sorted(found)}"
+            )
+            raise ValueError("Checkpoint does not match the optimiser.")
+
+        if budget is not None and budget != optimiser.budget:
+            logger.warning(
+                f"Continuing {self.checkpoint} with a budget of {budget} "
+                f"instead of {optimiser.budget}."
+            )
+            optimiser.budget = budget
+
+        self.optimiser = optimiser
+        self.evaluations = state["evaluations"]
+        self.promotions = state["promotions"]
+        self._rung_losses = state["rung_losses"]
+        self._fidelity = state["fidelity"]
+        self.hypervolumes = state["hypervolumes"]
+        self._front = state["front"]
+        self._reference = state["reference"]
+        self._pending = state["pending"]
+        self._resumed = True
+        self._last_checkpoint = optimiser.num_tell
+        logger.info(
+            f"Resumed from {self.checkpoint} after {optimiser.num_tell} "
+            f"evaluations with {len(self._pending)} pending evaluations."
+        )
+
+    def save_checkpoint(self, path: Optional[str] = None):
+        """Writes the current optimisation state to a checkpoint.
+
+        The checkpoint contains the nevergrad optimiser, the evaluated points
+        and their losses, the current Pareto front (for multi-objective
+        optimisation) and any candidates that have been asked for but not yet
+        told. The latter are re-evaluated upon resuming.
+
+        Args:
+            path (str, optional) : Path to the checkpoint file. If None
+                    (default), uses the path given during initialisation.
+        """
+        path = path if path is not None else self.checkpoint
+        if path is None:
+            logger.critical("No checkpoint path has been specified.")
+            raise ValueError("No checkpoint path specified.")
+
+        opt = self.optimiser
+        pending = (
+            [x for x, _ in opt._running_jobs]
+            + [x for x, _ in opt._finished_jobs]
+        )
+
+        pareto_front = []
+        if self.multi_objective and opt.num_tell > 0:
+            pareto_front = [
+                {"params": dict(pf.value[1]), "losses": pf.losses}
+                for pf in opt.pareto_front()
+            ]
+
+        # Callbacks, running jobs (futures) and the traced ask and tell
+        # wrappers cannot be pickled
+        callbacks = opt._callbacks
+        running_jobs, finished_jobs = opt._running_jobs, opt._finished_jobs
+        opt._callbacks, opt._running_jobs, opt._finished_jobs = {}, [], deque()
+        traced = {
+            name: vars(opt).pop(name) for name in ("ask", "tell")
+            if name in vars(opt)
+        }
+        try:
+            save_state(path, {
+                "optimiser": opt,
+                "pending": pending,
+                "evaluations": self.evaluations,
+                "pareto_front": pareto_front,
+                "promotions": self.promotions,
+                "rung_losses": self._rung_losses,
+                "fidelity": self._fidelity,
+                "hypervolumes": self.hypervolumes,
+                "front": self._front,
+                "reference": self._reference,
+            })
+        finally:
+            opt._callbacks = callbacks
+            opt._running_jobs, opt._finished_jobs = running_jobs, finished_jobs
+            vars(opt).update(traced)
+
+        self._last_checkpoint = opt.num_tell
+
+    def solve_system(
+            self,
+            fidelity: Optional[dict] = None,
+            sensitivities: Optional[list] = None,
+            initial_state: Optional[np.ndarray] = None,
+            **flat_params,
+    ) -> dict:
         """Solves the system.
 
         Essentially, wraps around the Fortran solver code and returns the
@@ -277,12 +596,105 @@ class Optimiser:
 
         For more information about the solver, look at the function:
         solve_system in cl0 (closed-loop-0D) module.
+
+        Args:
+            fidelity (dict, optional) : Generic parameters that override the
+                    inputs e.g. to solve with fewer cycles.
+            sensitivities (list, optional) : Flattened parameters to
+                    differentiate the solution with respect to.
+            initial_state (np.ndarray, optional) : State to continue from,
+                    e.g. sol.metadata["state"] of an earlier solve.
         """
-        flat_inputs = self.flat_inputs
+        flat_inputs = dict(self.flat_inputs)
         for key, value in flat_params.items():
             flat_inputs[key] = value
+        if fidelity is not None:
+            for key, value in fidelity.items():
+                flat_inputs[f"generic_params.{key}"] = value
         params = _unflatten_dict(flat_inputs)
-        return solve_system(**params)
+
+        start = time.perf_counter()
+        if self._solver is not None:
+            # Solves in the pool of the AsyncSolver of run_async
+            future = asyncio.run_coroutine_threadsafe(
+                self._solver.solve(
+                    **params, sensitivities=sensitivities,
+                    initial_state=initial_state,
+                ),
+                self._loop,
+            )
+            if self._solver.processes:
+                sol = _supervised_result(future, params)
+            else:
+                sol = future.result()
+        elif self._supervisor is not None:
+            sol = _supervised_result(
+                self._supervisor.submit(
+                    **params, sensitivities=sensitivities,
+                    initial_state=initial_state,
+                ),
+                params,
+            )
+        else:
+            sol = solve_system(
+                **params, sensitivities=sensitivities, initial_state=initial_state,
+            )
+
+        if sol.metadata["status"] in (STATUS_TIMEOUT, STATUS_FAILED):
+            logger.warning(f"Solve failed: {sol.metadata['error']}")
+            self.failures.append({
+                "params": params,
+                "status": sol.metadata["status"],
+                "error": sol.metadata["error"],
+            })
+        if self.telemetry is None:
+            return sol
+
+        self.telemetry.record_solve(
+            time.perf_counter() - start,
+            sol.metadata["status"] == STATUS_OK,
+            self.telemetry_name,
+        )
+        return sol
+
+    def _promote(self, rung: int, loss, params: dict) -> bool:
+        """Decides whether a candidate is promoted to the next fidelity rung.
+
+        The first eta candidates at each rung are always promoted, after which
+        a candidate is promoted if its loss is within the best 1/eta of all of
+        the losses seen at that rung. Every promotion is logged.
+
+        Args:
+            rung (int) : Index of the rung the candidate was evaluated at.
+            loss (float or list) : Loss(es) of the candidate at that rung.
+            params (dict) : Flattened parameters of the candidate.
+
+        Returns:
+            promote (bool) : True if the candidate should be promoted.
+        """
+        score = float(np.sum(loss))
+        with self._rung_lock:
+            rung_losses = self._rung_losses[rung]
+            rung_losses.append(score)
+            if not np.isfinite(score):
+                promote = False
+            elif len(rung_losses) <= self.eta:
+                promote = True
+            else:
+                threshold = np.nanquantile(rung_losses, 1 / self.eta)
+                promote = score <= threshold
+
+            if promote:
+                self.promotions.append(
+                    {"rung": rung, "loss": score, "params": dict(params)}
+                )
+
+        if promote:
+            logger.info(
+                f"Promoted candidate from rung {rung} "
+                f"({self.fidelities[rung]}) with loss {score:.4f}:\n{params}"
+            )
+        return promote
 
     def get_systemic_sysdia_pres(self, sol: dict) -> tuple:
         """Returns the systemic systolic  and diastolic pressure.
@@ -362,6 +774,255 @@ class Optimiser:
         sys, dia = self.get_systemic_sysdia_pres(sol)
         return (sv / (sys - dia))
 
+    def get_metrics(self, sol: dict, summarise: Optional[list] = None) -> dict:
+        """Returns all of the output metrics that can be optimised for.
+
+        Args:
+            sol (dict) : Solution dictionary - output from cl0.solve_system.
+            summarise (list, optional) : Solution keys to summarise by their
+                    minimum, maximum and mean. Defaults to None.
+
+        Returns:
+            metrics (dict) : Systolic ('sys') and diastolic ('dia') pressure,
+                    cardiac output ('co'), stroke volume ('sv'),
+                    total peripheral resistance ('tpr'), total arterial
+                    compliance ('tac') and any waveform summaries.
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sys, dia = self.get_systemic_sysdia_pres(sol)
+            metrics = {
+                "sys": sys,
+                "dia": dia,
+                "co": self.get_cardiac_output(sol),
+                "sv": self.get_stroke_volume(sol),
+                "tpr": self.get_total_peripheral_resistance(sol),
+                "tac": self.get_total_arterial_compliance(sol),
+            }
+
+        for key in summarise if summarise is not None else []:
+            metrics[f"{key} (min)"] = np.min(sol[key])
+            metrics[f"{key} (max)"] = np.max(sol[key])
+            metrics[f"{key} (mean)"] = np.mean(sol[key])
+
+        return metrics
+
+    def get_metric_sensitivities(self, sol: dict) -> dict:
+        """Returns the derivatives of the output metrics.
+
+        The derivatives are of the same metrics as get_metrics, found from
+        the sensitivities of a solution solved with sensitivities.
+
+        Args:
+            sol (dict) : Solution dictionary - output from cl0.solve_system
+                    with sensitivities.
+
+        Returns:
+            sensitivities (dict) : Maps each metric ('sys', 'dia', 'co',
+                    'sv', 'tpr' and 'tac') to the derivative of the metric
+                    with respect to each parameter.
+        """
+        pressure = sol["Systemic Artery Pressure"]
+        i_sys, i_dia = np.argmax(pressure), np.argmin(pressure)
+        dt = np.diff(sol['Time (s)'])
+        dt = np.concatenate((np.zeros(1) + dt[0], dt))
+        duration = sol['Time (s)'][-1] - sol['Time (s)'][0]
+
+        metrics = self.get_metrics(sol)
+        _map = np.mean(pressure)
+        pulse = metrics["sys"] - metrics["dia"]
+
+        sensitivities = {key: dict() for key in metrics.keys()}
+        for param, sens in sol.metadata["sensitivities"].items():
+            d_sys = sens["Systemic Artery Pressure"][i_sys]
+            d_dia = sens["Systemic Artery Pressure"][i_dia]
+            d_co = 1000 * np.sum(sens["Aortic Valve Flow"]) * 60 / duration
+            d_sv = np.sum(sens["Aortic Valve Flow"] * dt)
+            d_map = np.mean(sens["Systemic Artery Pressure"])
+
+            sensitivities["sys"][param] = d_sys
+            sensitivities["dia"][param] = d_dia
+            sensitivities["co"][param] = d_co
+            sensitivities["sv"][param] = d_sv
+            sensitivities["tpr"][param] = (
+                d_map / metrics["co"] - _map * d_co / metrics["co"] ** 2
+            )
+            sensitivities["tac"][param] = (
+                d_sv / pulse - metrics["sv"] * (d_sys - d_dia) / pulse ** 2
+            )
+
+        return sensitivities
+
+    def refine(
+            self,
+            sbp: Optional[float] = None,
+            dbp: Optional[float] = None,
+            co: Optional[float] = None,
+            sv: Optional[float] = None,
+            tpr: Optional[float] = None,
+            tac: Optional[float] = None,
+            params: Optional[dict] = None,
+            max_iter: int = 20,
+            tol: float = 1e-8,
+            damping: float = 1e-3,
+    ) -> dict:
+        """Locally refines parameters with a gradient based optimiser.
+
+        Uses Levenberg-Marquardt on the relative errors of the metrics (the
+        loss of run with p=2) with the derivatives from the solver's
+        sensitivities, so typically converges in tens of solves. Only the
+        optimised parameters in SENSITIVITY_PARAMS are refined (within their
+        bounds), any others are held fixed. A good starting point is the
+        recommendation of run.
+
+        Args:
+                sbp, dbp, co, sv, tpr, tac (float, optional) : Targets, as
+                        for run. At least one must be provided.
+                params (dict, optional) : Flattened parameters to start from.
+                        If None (default), starts from the recommendation of
+                        the last single objective run, or the initial values.
+                max_iter (int, optional) : Maximum number of iterations.
+                        Defaults to 20.
+                tol (float, optional) : Loss to stop at. Defaults to 1e-8.
+                damping (float, optional) : Initial Levenberg-Marquardt
+                        damping. Defaults to 1e-3.
+
+        Returns:
+                recommendation (dict) : The full refined parameter dictionary,
+                        as returned by run. The refined parameters and the
+                        history of the refinement are stored in
+                        self.recommendation (for single objective
+                        optimisation) and self.refinements.
+        """
+        targets = [
+            (metric, target) for metric, target in (
+                ("sys", sbp), ("dia", dbp), ("co", co),
+                ("sv", sv), ("tpr", tpr), ("tac", tac),
+            ) if target is not None
+        ]
+        if not targets:
+            logger.critical("You haven't set anything to optimise for?!\n")
+            raise ValueError('No optimisation criteria specified.')
+
+        if params is None:
+            if isinstance(self.recommendation, dict):
+                params = self.recommendation
+            else:
+                params = {k: p.value for k, p in self.opt_params.items()}
+
+        keys = [k for k in self.opt_params.keys() if k in SENSITIVITY_PARAMS]
+        if not keys:
+            logger.critical(
+                "None of the optimised parameters can be refined, only "
+                f"{list(SENSITIVITY_PARAMS.keys())} can be."
+            )
+            raise ValueError
+        fixed = {k: v for k, v in params.items() if k not in keys}
+
+        bounds = [self.opt_params[k].bounds for k in keys]
+        lower = np.array([-np.inf if b[0] is None else b[0][0] for b in bounds])
+        upper = np.array([np.inf if b[1] is None else b[1][0] for b in bounds])
+
+        self.refinements = []
+
+        def evaluate(x):
+            flat_params = {**fixed, **dict(zip(keys, x))}
+            sol = self.solve_system(sensitivities=keys, **flat_params)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                metrics = self.get_metrics(sol)
+                sens = self.get_metric_sensitivities(sol)
+            residuals = np.array([(metrics[m] - t) / t for m, t in targets])
+            jacobian = np.array([[sens[m][k] / t for k in keys] for m, t in targets])
+            loss = float(residuals @ residuals)
+            self.refinements.append(
+                {"params": flat_params, "metrics": metrics, "loss": loss}
+            )
+            return residuals, jacobian, loss
+
+        x = np.clip([params[k] for k in keys], lower, upper).astype(np.float64)
+        residuals, jacobian, loss = evaluate(x)
+        for _ in range(max_iter):
+            if loss < tol or not np.isfinite(loss):
+                break
+
+            jtj = jacobian.T @ jacobian
+            step = np.linalg.lstsq(
+                jtj + damping * np.diag(np.diag(jtj) + 1e-12),
+                -jacobian.T @ residuals,
+                rcond=None,
+            )[0]
+            x_new = np.clip(x + step, lower, upper)
+            if np.allclose(x_new, x, rtol=1e-10, atol=0):
+                break
+
+            new = evaluate(x_new)
+            if np.isfinite(new[2]) and new[2] < loss:
+                x = x_new
+                residuals, jacobian, loss = new
+                damping /= 3
+            else:
+                damping *= 3
+
+        refined = dict(params)
+        refined.update(zip(keys, x.tolist()))
+        logger.info(
+            f"Refined to loss {loss:.4g} in {len(self.refinements)} solves:\n"
+            f"{refined}"
+        )
+        if not self.multi_objective:
+            self.recommendation = refined
+
+        full_recommendation = dict(self.flat_inputs)
+        full_recommendation.update(refined)
+        return _unflatten_dict(full_recommendation)
+
+    def _to_records(self, evaluations: list) -> np.ndarray:
+        """Converts evaluations into a NumPy record array.
+
+        The records contain the optimised parameters, the metrics,
+        the loss for each objective, the total loss and the fidelity rung.
+        Missing values are NaN.
+
+        Args:
+            evaluations (list) : Evaluations as stored in self.evaluations.
+
+        Returns:
+            records (np.recarray) : One record per evaluation.
+        """
+        param_names = list(self.opt_params.keys())
+        metric_names = []
+        for evaluation in evaluations:
+            for key in evaluation.get("metrics", {}).keys():
+                if key not in metric_names:
+                    metric_names.append(key)
+        loss_names = [f"loss_{o}" for o in self.objectives]
+
+        dtype = [
+            (name, np.float64)
+            for name in param_names + metric_names + loss_names + ["loss"]
+        ] + [("fidelity", np.int64)]
+        records = np.recarray(len(evaluations), dtype=dtype)
+        for name, _ in dtype[:-1]:
+            records[name] = np.nan
+
+        for i, evaluation in enumerate(evaluations):
+            for key, value in evaluation.get("params", {}).items():
+                records[key][i] = value
+            for key, value in evaluation.get("metrics", {}).items():
+                records[key][i] = value
+            metrics = evaluation.get("metrics", {})
+            for name, metric, target in self._targets:
+                if metric in metrics:
+                    records[f"loss_{name}"][i] = (
+                        np.abs(metrics[metric] - target) / target
+                    )
+            if self.multi_objective and "losses" in evaluation:
+                records["loss"][i] = np.sum(evaluation["losses"])
+            elif "loss" in evaluation:
+                records["loss"][i] = evaluation["loss"]
+            records["fidelity"][i] = evaluation.get("fidelity", -1)
+
+        return records
+
     def run(
             self,
             sbp: Optional[float] = None,
@@ -371,6 +1032,8 @@ class Optimiser:
             tpr: Optional[float] = None,
             tac: Optional[float] = None,
             p: float = 2.0,
+            summarise: Optional[list] = None,
+            return_results: bool = False,
             **kwargs
     ) -> dict:
         """Runs the optimiser.
@@ -399,6 +1062,17 @@ class Optimiser:
                 p (float, optional) : Uses L_p norm to convert multi-objective
                         optimisation into a single objective optimisation
                         problem. Defaults to 2.
+                summarise (list, optional) : Solution keys to summarise
+                        (minimum, maximum and mean) for each evaluation.
+                        Defaults to None.
+                return_results (bool, optional) : If True, also returns
+                        self.pareto_results, a record array of the parameters,
+                        metrics and losses for each recommendation.
+                        Defaults to False.
+
+        The parameters, metrics and losses of every evaluation are stored in
+        the record array self.results so the recommendations never need to
+        be solved again.
         """
 
         logger.info(
@@ -431,78 +1105,178 @@ class Optimiser:
                 "and you know what you're doing."
             )
 
-        if self.multi_objective:
+        if self.multi_objective and not self._resumed:
+            self._reference = np.array([10.0 for _ in range(num_objectives)])
             self.optimiser.tell(
-                ng.p.MultiobjectiveReference(),
-                [10 for _ in range(num_objectives)],
+                ng.p.MultiobjectiveReference(), list(self._reference),
             )
 
+        # Objectives, as (name, metric, target)
+        objectives = [
+            (name, metric, target) for name, metric, target in (
+                ("sbp", "sys", sbp),
+                ("dbp", "dia", dbp),
+                ("co", "co", co),
+                ("sv", "sv", sv),
+                ("tpr", "tpr", tpr),
+                ("tac", "tac", tac),
+            ) if target is not None
+        ]
+        self.objectives = [name for name, _, _ in objectives]
+        self._targets = objectives
+
+        # Loss function
+        def get_loss(sol, key):
+
+            # Penalises diverged solves, whose solution is NaN
+            if sol.metadata["status"] != STATUS_OK:
+                self._metrics[key] = dict()
+                self.num_diverged += 1
+                if self.multi_objective:
+                    return [self.divergence_penalty] * len(objectives)
+                return self.divergence_penalty
+
+            metrics = self.get_metrics(sol, summarise=summarise)
+            self._metrics[key] = metrics
+
+            loss = [
+                np.abs(metrics[metric] - target) / target
+                for _, metric, target in objectives
+            ]
+
+            if not self.multi_objective:
+                loss = np.sum([x ** p for x in loss])
+
+            return loss
+
         # Minimisation function
         def minimise(*args, **kwargs):
-            sol = self.solve_system(*args, **kwargs)
-
-            loss = []
-
-            # Systemic Systolic and Diastolic Blood Pressure
-            if sbp is not None or dbp is not None:
-                sys, dia = self.get_systemic_sysdia_pres(sol)
-                if sbp is not None:
-                    loss.append(np.abs(sys - sbp) / sbp)
-                if dbp is not None:
-                    loss.append(np.abs(dia - dbp) / dbp)
-
-            # Cardiac Output
-            if co is not None:
-                cardiac_output = self.get_cardiac_output(sol)
-                loss.append(np.abs(cardiac_output - co) / co)
-
-            # Stroke Volume
-            if sv is not None:
-                stroke_volume = self.get_stroke_volume(sol)
-                loss.append(np.abs(stroke_volume - sv) / sv)
-
-            # Total peripheral resistance
-            if tpr is not None:
-                total_peripheral_R = self.get_total_peripheral_resistance(sol)
-                loss.append(np.abs(total_peripheral_R - tpr) / tpr)
-
-            # Total arterial compliance
-            if tac is not None:
-                total_arterial_C = self.get_total_arterial_compliance(sol)
-                loss.append(np.abs(total_arterial_C - tac) / tac)
-
-            if self.multi_objective:
-                self.loss = np.sum(loss)
-            else:
-                loss = np.sum([x ** p for x in loss])
-                self.loss = loss
+
+            # Screens the candidate at the low fidelity rungs. Each rung
+            # continues from the state at the end of the previous one, so
+            # only the cycles it adds are solved
+            key = _param_key(kwargs)
+            full_ncycle = kwargs.get(
+                "generic_params.ncycle", self.flat_inputs["generic_params.ncycle"]
+            )
+            state, num_solved = None, 0
+            for rung, fidelity in enumerate(self.fidelities):
+                self._fidelity[key] = rung
+                ncycle = max(1, fidelity.get("ncycle", full_ncycle) - num_solved)
+                sol = self.solve_system(
+                    *args, fidelity={**fidelity, "ncycle": ncycle},
+                    initial_state=state, **kwargs,
+                )
+                loss = get_loss(sol, key)
+                if sol.metadata["status"] != STATUS_OK:
+                    return loss
+                if not self._promote(rung, loss, kwargs):
+                    return loss
+                state, num_solved = sol.metadata["state"], num_solved + ncycle
+
+            self._fidelity[key] = len(self.fidelities)
+            sol = self.solve_system(
+                *args, fidelity={"ncycle": max(1, full_ncycle - num_solved)},
+                initial_state=state, **kwargs,
+            )
+            loss = get_loss(sol, key)
+            self.loss = np.sum(loss)
 
             return loss
 
-        # Optimisation
-        # Whether to run parallel or not is determined if num_workers > 1.
-        # Which is specified during initialisation.
-        if self.parallel:
-            with futures.ThreadPoolExecutor(
-                    max_workers=self.optimiser.num_workers
-            ) as executor:
-                recommendation = self.optimiser.minimize(
-                    minimise, executor=executor, batch_mode=False, **kwargs
+        if trace.enabled():
+            minimise = trace.traced(minimise, "evaluate", "optimiser")
+
+        if self.telemetry is not None:
+            budget = self.optimiser.budget
+            self.telemetry.start_patient(
+                self.telemetry_name,
+                total=None if budget is None else budget - self.optimiser.num_tell,
+                num_workers=self.optimiser.num_workers,
+            )
+
+        if self.timeout is not None and self._solver is None:
+            self._supervisor = Supervisor(
+                solve_system, self.optimiser.num_workers, self.timeout,
+            )
+
+        try:
+            # Re-evaluates candidates that were pending when the checkpoint was made
+            while self._pending:
+                candidate = self._pending.pop(0)
+                self.optimiser.tell(
+                    candidate, minimise(*candidate.args, **candidate.kwargs)
                 )
-        else:
-            recommendation = self.optimiser.minimize(minimise, **kwargs)
+
+            # Optimisation
+            # Whether to run parallel or not is determined if num_workers > 1.
+            # Which is specified during initialisation.
+            if self.parallel:
+                with futures.ThreadPoolExecutor(
+                        max_workers=self.optimiser.num_workers
+                ) as executor:
+                    recommendation = self.optimiser.minimize(
+                        minimise, executor=executor, batch_mode=False, **kwargs
+                    )
+            else:
+                recommendation = self.optimiser.minimize(minimise, **kwargs)
+        except BaseException:
+            if self.telemetry is not None:
+                self.telemetry.finish_patient(self.telemetry_name, failed=True)
+            raise
+        finally:
+            if self._supervisor is not None:
+                self._supervisor.shutdown(cancel=True)
+                self._supervisor = None
+
+        if self.telemetry is not None:
+            self.telemetry.finish_patient(self.telemetry_name)
+
+        if self.num_diverged:
+            logger.info(f"{self.num_diverged} solves diverged or failed and were penalised.")
+
+        if self.checkpoint is not None:
+            self.save_checkpoint()
+
+        # Only recommends candidates evaluated at full fidelity
+        full_fidelity = [
+            e for e in self.evaluations
+            if e["fidelity"] == len(self.fidelities)
+        ]
 
         if self.multi_objective:
+            pareto_front = self.optimiser.pareto_front()
+            if self.fidelities:
+                full_keys = {_param_key(e["params"]) for e in full_fidelity}
+                pareto_front = [
+                    pf for pf in pareto_front
+                    if _param_key(pf.value[1]) in full_keys
+                ] or pareto_front
             self.recommendation = [
                 pf.value[1] for pf in sorted(
-                    self.optimiser.pareto_front(), key=lambda p: p.losses[0]
+                    pareto_front, key=lambda p: p.losses[0]
                 )
             ]
+        elif self.fidelities and full_fidelity:
+            best = min(full_fidelity, key=lambda e: e["loss"])
+            self.recommendation = dict(best["params"])
         else:
             self.recommendation = dict(recommendation[1].value.items())
 
         logger.info(self.recommendation)
 
+        # Records of all evaluations and of the recommendations
+        self.results = self._to_records(self.evaluations)
+        evaluated = {_param_key(e["params"]): e for e in self.evaluations}
+        recommendations = (
+            self.recommendation if self.multi_objective
+            else [self.recommendation]
+        )
+        self.pareto_results = self._to_records([
+            evaluated.get(_param_key(rec), {"params": rec})
+            for rec in recommendations
+        ])
+
         # Recombines optimised values into a full parameter dictionary
         if self.multi_objective:
             full_recommendation = []
@@ -511,9 +1285,57 @@ class Optimiser:
                 for key in list(rec.keys()):
                     full_rec[key] = rec[key]
                 full_recommendation.append(_unflatten_dict(full_rec))
-            return full_recommendation
+        else:
+            full_recommendation = self.flat_inputs
+            for key in list(self.recommendation.keys()):
+                full_recommendation[key] = self.recommendation[key]
+            full_recommendation = _unflatten_dict(full_recommendation)
 
-        full_recommendation = self.flat_inputs
-        for key in list(self.recommendation.keys()):
-            full_recommendation[key] = self.recommendation[key]
-        return _unflatten_dict(full_recommendation)
+        if return_results:
+            return full_recommendation, self.pareto_results
+        return full_recommendation
+
+    async def run_async(
+            self,
+            *args,
+            solver: Optional[AsyncSolver] = None,
+            executor=None,
+            **kwargs,
+    ):
+        """Runs the optimiser without blocking the event loop.
+
+        Takes the same arguments as run, which is run in a thread of the
+        executor. Every solve of the run goes through the pool of solver, so
+        concurrent runs and other callers of the solver share its workers and
+        its limit on pending solves, and the timeout argument of the
+        optimiser is replaced by that of the solver. If the calling task is
+        cancelled, the run stops before its next candidate and the
+        cancellation is raised once it has stopped (candidates already being
+        evaluated are finished first).
+
+        Args:
+                solver (AsyncSolver, optional) : Workers to solve with. If
+                        None (default), uses the pool shared by every caller,
+                        see aio.default_solver.
+                executor (Executor, optional) : Executor to run in. If None
+                        (default), uses the default executor of the loop.
+        """
+        loop = asyncio.get_running_loop()
+        self._cancel.clear()
+        self._solver = solver if solver is not None else default_solver()
+        self._loop = loop
+        run = loop.run_in_executor(
+            executor, functools.partial(self.run, *args, **kwargs),
+        )
+        try:
+            return await asyncio.shield(run)
+        except asyncio.CancelledError:
+            self._cancel.set()
+            try:
+                await run
+            except OptimisationCancelled:
+                pass
+            raise
+        finally:
+            self._solver = None
+            self._loop = None
@@ -0,0 +1,181 @@
+#! /usr/bin/env python
+"""Vectorised reduction of Pareto fronts stored in SQLite databases."""
+
+# Python imports
+import sqlite3
+import logging
+from typing import Optional
+
+# Module imports
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _quote(column: str) -> str:
+    """Quotes a column name for use in an SQL statement."""
+    return '"' + column.replace('"', '""') + '"'
+
+
+def _reduce_chunk(
+        data: np.ndarray,
+        columns: list,
+        opt_cols: dict,
+        static_cols: list,
+        var_col: str,
+) -> np.ndarray:
+    """Reduces the Pareto front of each id in a chunk into a single row.
+
+    The chunk must be sorted by id (the first column) and contain complete
+    Pareto fronts. Each member of a front is weighted by its inverse loss
+    where the loss is the sum of abs(target - value) / value over the
+    optimisation columns.
+
+    Args:
+        data (np.ndarray) : Array of shape (rows, columns) sorted by id.
+        columns (list) : Names of the columns of data.
+        opt_cols (dict) : Maps each optimisation column to its target column.
+        static_cols (list) : Columns that are constant across a front.
+        var_col (str) : Variable column of interest.
+
+    Returns:
+        reduced (np.ndarray) : Array of shape (ids, columns) with the reduced
+                rows in the same column order as data.
+    """
+    col = {c: i for i, c in enumerate(columns)}
+    ids = data[:, 0]
+
+    # Start index and size of each front
+    starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+    counts = np.diff(np.append(starts, ids.size))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        loss = np.zeros(ids.size)
+        for c, target in opt_cols.items():
+            loss += np.abs(data[:, col[target]] - data[:, col[c]]) / data[:, col[c]]
+        inv_loss = 1 / loss
+        weights = inv_loss / np.repeat(np.add.reduceat(inv_loss, starts), counts)
+
+    reduced = np.empty((starts.size, len(columns)))
+    reduced[:, 0] = ids[starts]
+    for c in static_cols + list(opt_cols.values()):
+        reduced[:, col[c]] = data[starts, col[c]]
+    for c in [var_col, *opt_cols.keys()]:
+        reduced[:, col[c]] = np.add.reduceat(data[:, col[c]] * weights, starts)
+
+    return reduced
+
+
+def reduce_pareto_front(
+        db_path: str,
+        table: str,
+        new_table: str,
+        id_col: str,
+        opt_cols: dict,
+        static_cols: list,
+        var_col: str,
+        chunksize: int = 100000,
+        id_range: Optional[tuple] = None,
+) -> int:
+    """Reduces every Pareto front in a table into a single loss weighted row.
+
+    The table is streamed in chunks ordered by id so only a single chunk is
+    held in memory. Each chunk is reduced with vectorised segment reductions
+    and the rows are written to the new table in a single transaction.
+    An index on the id column is created if one does not already exist.
+
+    Rows with any missing value in the used columns are ignored.
+
+    Args:
+        db_path (str) : Path to the SQLite3 database.
+        table (str) : Table containing the Pareto fronts.
+        new_table (str) : Table to write the reduced rows to.
+        id_col (str) : Column identifying each Pareto front.
+        opt_cols (dict) : Maps each optimisation column to its target column.
+        static_cols (list) : Columns that are constant across a front.
+        var_col (str) : Variable column of interest, this and the optimisation
+                columns are weighted by the inverse loss.
+        chunksize (int, optional) : Number of rows to read at a time.
+                Defaults to 100000.
+        id_range (tuple, optional) : Inclusive (min, max) range of ids to
+                reduce. If None (default), reduces all ids.
+
+    Returns:
+        num_ids (int) : Number of Pareto fronts reduced.
+    """
+    columns = [id_col, *opt_cols.keys(), *opt_cols.values(), var_col, *static_cols]
+    columns_str = ", ".join(_quote(c) for c in columns)
+
+    query = f"SELECT {columns_str} FROM {_quote(table)}"
+    if id_range is not None:
+        query += f" WHERE {_quote(id_col)} BETWEEN {id_range[0]} AND {id_range[1]}"
+    query += f" ORDER BY {_quote(id_col)}"
+
+    col_dtype_str = ", ".join(
+        f"{_quote(c)} INTEGER PRIMARY KEY" if c == id_col else f"{_quote(c)} REAL"
+        for c in columns
+    )
+    insert = (
+        f"INSERT OR REPLACE INTO {_quote(new_table)} ({columns_str}) "
+        f"VALUES ({', '.join('?' for _ in columns)})"
+    )
+
+    con = sqlite3.connect(db_path)
+    try:
+        con.execute(
+            f"CREATE INDEX IF NOT EXISTS {_quote(f'idx_{table}_{id_col}')} "
+            f"ON {_quote(table)} ({_quote(id_col)})"
+        )
+        con.execute(
+            f"CREATE TABLE IF NOT EXISTS {_quote(new_table)} "
+            f"({col_dtype_str}) WITHOUT ROWID"
+        )
+
+        logger.info(f"Reducing {table} into {new_table} with:\n{query}")
+        read_cursor = con.cursor()
+        read_cursor.execute(query)
+        write_cursor = con.cursor()
+
+        num_ids = 0
+        remainder = np.empty((0, len(columns)))
+        while True:
+            rows = read_cursor.fetchmany(chunksize)
+            finished = len(rows) == 0
+
+            data = np.array(rows, dtype=np.float64).reshape(-1, len(columns))
+            data = np.concatenate((remainder, data))
+            data = data[~np.isnan(data).any(axis=1)]
+            if data.shape[0] == 0:
+                if finished:
+                    break
+                continue
+
+            # The last front may continue into the next chunk
+            if not finished:
+                last = data[:, 0] == data[-1, 0]
+                remainder = data[last]
+                data = data[~last]
+            else:
+                remainder = np.empty((0, len(columns)))
+
+            if data.shape[0] > 0:
+                reduced = _reduce_chunk(data, columns, opt_cols, static_cols, var_col)
+                ids = reduced[:, 0].astype(np.int64).tolist()
+                write_cursor.executemany(
+                    insert,
+                    (
+                        (i, *row) for i, row in zip(ids, reduced[:, 1:].tolist())
+                    ),
+                )
+                num_ids += len(ids)
+                logger.debug(f"Reduced {num_ids} Pareto fronts")
+
+            if finished:
+                break
+
+        con.commit()
+    finally:
+        con.close()
+
+    logger.info(f"Reduced {num_ids} Pareto fronts into {new_table}")
+    return num_ids
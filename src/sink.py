@@ -0,0 +1,336 @@
+#! /usr/bin/env python
+"""Single writer results sink for SQLite databases."""
+
+# Python imports
+import time
+import queue
+import atexit
+import sqlite3
+import logging
+import numbers
+import threading
+import multiprocessing as mp
+from typing import Optional
+
+# Local imports
+from src.trace import span, flush as flush_trace
+
+logger = logging.getLogger(__name__)
+
+# Messages sent to the writer in addition to rows
+_FLUSH = "__flush__"
+_CLOSE = "__close__"
+
+
+def _quote(column: str) -> str:
+    """Quotes a column name for use in an SQL statement."""
+    return '"' + str(column).replace('"', '""') + '"'
+
+
+def _sql_type(value) -> str:
+    """Returns the SQLite column type for a value."""
+    if isinstance(value, (bool, numbers.Integral)):
+        return "INTEGER"
+    if isinstance(value, numbers.Real):
+        return "REAL"
+    if isinstance(value, (bytes, bytearray)):
+        return "BLOB"
+    return "TEXT"
+
+
+def _sql_value(value):
+    """Converts numpy scalars into values SQLite understands."""
+    if hasattr(value, "item") and not isinstance(value, (str, bytes)):
+        return value.item()
+    return value
+
+
+class _Writer:
+    """Owns the SQLite connection and writes batches of rows."""
+
+    def __init__(self, db_path, table, columns, index, replace, timeout):
+        self.table = table
+        self.index = list(index) if index is not None else []
+        self.columns = []
+
+        self.con = sqlite3.connect(db_path, timeout=timeout)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("PRAGMA synchronous=NORMAL")
+
+        if replace:
+            self.con.execute(f"DROP TABLE IF EXISTS {_quote(table)}")
+
+        existing = self.con.execute(
+            f"PRAGMA table_info({_quote(table)})"
+        ).fetchall()
+        self.columns = [c[1] for c in existing]
+
+        if columns is not None:
+            self._add_columns(columns)
+        self.con.commit()
+
+    def _add_columns(self, types: dict):
+        """Creates the table or adds any new columns to it."""
+        new = {c: t for c, t in types.items() if c not in self.columns}
+        if not new:
+            return
+
+        if not self.columns:
+            cols = ", ".join(f"{_quote(c)} {t}" for c, t in new.items())
+            self.con.execute(f"CREATE TABLE IF NOT EXISTS {_quote(self.table)} ({cols})")
+            for col in self.index:
+                self.con.execute(
+                    f"CREATE INDEX IF NOT EXISTS {_quote(f'idx_{self.table}_{col}')} "
+                    f"ON {_quote(self.table)} ({_quote(col)})"
+                )
+        else:
+            for c, t in new.items():
+                self.con.execute(
+                    f"ALTER TABLE {_quote(self.table)} ADD COLUMN {_quote(c)} {t}"
+                )
+        self.columns.extend(new.keys())
+
+    def write(self, rows: list):
+        """Writes a batch of rows in a single transaction."""
+        if not rows:
+            return
+
+        types = dict()
+        for row in rows:
+            for key, value in row.items():
+                if key not in types and value is not None:
+                    types[key] = _sql_type(value)
+        self._add_columns(types)
+
+        # Groups rows by their columns so each group is a single executemany
+        groups = dict()
+        for row in rows:
+            groups.setdefault(tuple(row.keys()), []).append(row)
+
+        for cols, group in groups.items():
+            insert = (
+                f"INSERT INTO {_quote(self.table)} "
+                f"({', '.join(_quote(c) for c in cols)}) "
+                f"VALUES ({', '.join('?' for _ in cols)})"
+            )
+            self.con.executemany(
+                insert,
+                ([_sql_value(row[c]) for c in cols] for row in group),
+            )
+        self.con.commit()
+
+    def close(self):
+        """Checkpoints the write ahead log and closes the connection."""
+        self.con.commit()
+        self.con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.con.close()
+
+
+def _writer_loop(
+        q, db_path, table, columns, index, replace, timeout,
+        batch_size, flush_interval, failed, errors=None,
+):
+    """Consumes rows from a queue and writes them in batches.
+
+    A batch is written when it reaches batch_size rows, when flush_interval
+    seconds have passed since the first row of the batch was received or when
+    a flush or close message is received. If writing fails, failed is set
+    before the writer stops.
+    """
+    try:
+        writer = _Writer(db_path, table, columns, index, replace, timeout)
+    except Exception as e:
+        if errors is not None:
+            errors.append(e)
+        failed.set()
+        raise
+
+    batch = []
+    pending = 0
+    deadline = None
+    closing = False
+    try:
+        while not closing:
+            wait = None if deadline is None else max(0.0, deadline - time.time())
+            try:
+                item = q.get(timeout=wait)
+            except queue.Empty:
+                item = _FLUSH
+            else:
+                pending += 1
+
+            if item == _CLOSE:
+                closing = True
+            elif item != _FLUSH:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.time() + flush_interval
+                if len(batch) < batch_size:
+                    continue
+
+            with span("db_write", "db", rows=len(batch)):
+                writer.write(batch)
+            flush_trace()
+            logger.debug(f"Wrote {len(batch)} rows to {table}")
+            batch = []
+            deadline = None
+            for _ in range(pending):
+                q.task_done()
+            pending = 0
+    except Exception as e:
+        logger.critical(f"Results sink for {table} failed.")
+        if errors is not None:
+            errors.append(e)
+        failed.set()
+        for _ in range(pending):
+            q.task_done()
+        # Marks everything queued after the failing batch as done, including
+        # any flush message, so that flush does not wait on a dead writer
+        while True:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                break
+            q.task_done()
+        raise
+    finally:
+        writer.close()
+
+
+class ResultsSink:
+
+    def __init__(
+            self,
+            db_path: str,
+            table: str,
+            columns: Optional[dict] = None,
+            index: Optional[list] = None,
+            replace: bool = False,
+            batch_size: int = 1000,
+            flush_interval: float = 5.0,
+            timeout: float = 60.0,
+            process: bool = False,
+    ):
+        """Initialises the results sink.
+
+        All rows are written by a single dedicated writer (a thread, or a
+        process if process is True) that is fed by a queue, so callers never
+        block on the database. Rows are written in batches with executemany
+        in a single transaction, with SQLite in write ahead log mode.
+
+        Args:
+                db_path (str) : Path to the SQLite3 database.
+                table (str) : Table to write to. It is created from the
+                        columns of the first batch if it does not exist and
+                        new columns are added as they appear.
+                columns (dict, optional) : Column names and SQLite types to
+                        create the table with upfront. Defaults to None.
+                index (list, optional) : Columns to index. Defaults to None.
+                replace (bool, optional) : If True, replaces any existing
+                        table. Defaults to False.
+                batch_size (int, optional) : Number of rows per transaction.
+                        Defaults to 1000.
+                flush_interval (float, optional) : Maximum time in seconds a
+                        row waits before being written. Defaults to 5.
+                timeout (float, optional) : SQLite busy timeout in seconds.
+                        Defaults to 60.
+                process (bool, optional) : If True, the writer is a separate
+                        process and the sink can be used by processes started
+                        after it. Defaults to False.
+        """
+        self.db_path = db_path
+        self.table = table
+        self.process = process
+        self._closed = False
+
+        args = (
+            db_path, table, columns, index, replace, timeout,
+            batch_size, flush_interval,
+        )
+        if process:
+            self._queue = mp.JoinableQueue()
+            self._failed = mp.Event()
+            self._errors = None
+            self._writer = mp.Process(
+                target=_writer_loop,
+                args=(self._queue, *args, self._failed),
+                daemon=True,
+            )
+        else:
+            self._queue = queue.Queue()
+            self._failed = threading.Event()
+            self._errors = []
+            self._writer = threading.Thread(
+                target=_writer_loop,
+                args=(self._queue, *args, self._failed, self._errors),
+                daemon=True,
+            )
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _check(self):
+        """Raises if the writer has failed."""
+        if self._errors:
+            raise RuntimeError(
+                f"Results sink for {self.table} failed."
+            ) from self._errors[0]
+        if self._failed.is_set():
+            raise RuntimeError(f"Results sink for {self.table} failed.")
+        if not self._writer.is_alive() and not self._closed:
+            logger.critical(f"Results sink writer for {self.table} has died.")
+            raise RuntimeError(f"Results sink for {self.table} is not running.")
+
+    def put(self, row: dict):
+        """Queues a single row, given as a dictionary of column values."""
+        self._check()
+        self._queue.put(dict(row))
+
+    def put_many(self, rows: list):
+        """Queues a list of rows."""
+        self._check()
+        for row in rows:
+            self._queue.put(dict(row))
+
+    def flush(self, poll_interval: float = 0.1):
+        """Blocks until every row queued so far has been committed.
+
+        Raises if the writer fails or dies before then, rather than waiting
+        on rows that will never be written.
+
+        Args:
+                poll_interval (float, optional) : Time in seconds between
+                        checks that the writer is still running. Defaults
+                        to 0.1.
+        """
+        self._check()
+        self._queue.put(_FLUSH)
+
+        # Queue.join has no timeout, so it is waited on in a helper thread
+        joined = threading.Event()
+        threading.Thread(
+            target=lambda: (self._queue.join(), joined.set()), daemon=True,
+        ).start()
+        while not joined.wait(poll_interval):
+            self._check()
+        self._check()
+
+    def close(self):
+        """Writes all remaining rows and stops the writer."""
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+
+        if self._writer.is_alive():
+            self._queue.put(_CLOSE)
+            self._writer.join()
+        if self._errors:
+            raise RuntimeError(
+                f"Results sink for {self.table} failed."
+            ) from self._errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
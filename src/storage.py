@@ -0,0 +1,296 @@
+#! /usr/bin/env python
+"""Chunked and compressed HDF5 storage of solutions and their inputs."""
+
+# Python imports
+import os
+import glob
+import logging
+from typing import Optional
+
+# Module imports
+import h5py
+import numpy as np
+import pandas as pd
+
+# Local imports
+from src.cl0 import SOLUTION_KEYS, _format_solver_inputs, _flatten_dict
+
+logger = logging.getLogger(__name__)
+
+
+class WaveformStore:
+
+    def __init__(
+            self,
+            path: str,
+            mode: str = "a",
+            chunk_runs: int = 16,
+            compression: Optional[str] = "gzip",
+            compression_opts: Optional[int] = 4,
+    ):
+        """Opens (or creates) a waveform store.
+
+        All waveforms are held in a single (runs, channels, samples) dataset,
+        chunked along runs with one channel per chunk so a single channel of
+        many runs can be read without decompressing the others. The inputs of
+        each run, with any defaults filled in, are stored as one column per
+        flattened parameter (e.g. "generic_params.period") in the "params"
+        group.
+
+        HDF5 files only support a single writer, concurrent writers should
+        each write to their own shard (see shard_path) which are combined
+        afterwards with merge_shards.
+
+        Args:
+                path (str) : Path to the HDF5 file.
+                mode (str, optional) : h5py file mode. Defaults to "a".
+                chunk_runs (int, optional) : Number of runs per chunk.
+                        Defaults to 16.
+                compression (str, optional) : HDF5 compression filter.
+                        Defaults to "gzip".
+                compression_opts (int, optional) : Compression level.
+                        Defaults to 4.
+        """
+        self.path = path
+        self.chunk_runs = chunk_runs
+        self.compression = compression
+        self.compression_opts = compression_opts
+
+        self.file = h5py.File(path, mode)
+        if "channels" not in self.file.attrs and self.file.mode != "r":
+            self.file.attrs["channels"] = list(SOLUTION_KEYS)
+        self.channels = [str(c) for c in self.file.attrs.get("channels", SOLUTION_KEYS)]
+        self._channel_idx = {c: i for i, c in enumerate(self.channels)}
+
+    def __len__(self) -> int:
+        if "waveforms" not in self.file:
+            return 0
+        return self.file["waveforms"].shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Closes the underlying file."""
+        if self.file.id.valid:
+            self.file.close()
+
+    @property
+    def columns(self) -> list:
+        """Names of the parameter columns."""
+        if "params" not in self.file:
+            return []
+        return list(self.file["params"].keys())
+
+    def _create_waveforms(self, nout: int):
+        """Creates the resizable waveform dataset."""
+        self.file.create_dataset(
+            "waveforms",
+            shape=(0, len(self.channels), nout),
+            maxshape=(None, len(self.channels), nout),
+            chunks=(self.chunk_runs, 1, nout),
+            dtype=np.float64,
+            compression=self.compression,
+            compression_opts=self.compression_opts,
+            shuffle=self.compression is not None,
+        )
+
+    def _append_params(self, start: int, num: int, params: dict):
+        """Appends num rows of parameter columns, padding missing values with NaN."""
+        grp = self.file.require_group("params")
+        for key in set(grp.keys()) | set(params.keys()):
+            if key not in grp:
+                grp.create_dataset(
+                    key,
+                    shape=(start,),
+                    maxshape=(None,),
+                    chunks=(max(self.chunk_runs, 1024),),
+                    dtype=np.float64,
+                    fillvalue=np.nan,
+                    compression=self.compression,
+                    compression_opts=self.compression_opts,
+                )
+            dset = grp[key]
+            dset.resize((start + num,))
+            dset[start:] = params.get(key, np.full(num, np.nan))
+
+    def append(self, sols: list, params: Optional[list] = None):
+        """Appends solutions, and the inputs that produced them, to the store.
+
+        Args:
+                sols (list) : Solution dictionaries as returned by solve_system.
+                params (list, optional) : Inputs passed to solve_system for each
+                        solution. Defaults are filled in before storing. If
+                        None (default), only the waveforms are stored.
+
+        Returns:
+                rows (slice) : Rows the solutions were written to.
+        """
+        if isinstance(sols, dict):
+            sols = [sols]
+            params = [params] if params is not None else None
+
+        if params is not None and len(params) != len(sols):
+            logger.critical(
+                f"Number of solutions ({len(sols)}) and parameters "
+                f"({len(params)}) are different."
+            )
+            raise ValueError
+
+        if len(sols) == 0:
+            return slice(len(self), len(self))
+
+        data = np.stack([
+            np.stack([sol[c] for c in self.channels]) for sol in sols
+        ])
+
+        if "waveforms" not in self.file:
+            self._create_waveforms(data.shape[-1])
+        dset = self.file["waveforms"]
+        if data.shape[-1] != dset.shape[-1]:
+            logger.critical(
+                f"Solutions have {data.shape[-1]} samples, "
+                f"expected {dset.shape[-1]} (nstep must be the same for every run)."
+            )
+            raise ValueError
+
+        start = dset.shape[0]
+        dset.resize((start + data.shape[0], *dset.shape[1:]))
+        dset[start:] = data
+
+        if params is not None:
+            columns = dict()
+            for i, p in enumerate(params):
+                flat = _flatten_dict(_format_solver_inputs(**(p or dict())))
+                for key, value in flat.items():
+                    columns.setdefault(key, np.full(len(params), np.nan))[i] = value
+            self._append_params(start, len(sols), columns)
+        elif "params" in self.file:
+            self._append_params(start, len(sols), dict())
+
+        self.file.flush()
+        return slice(start, start + data.shape[0])
+
+    def read(
+            self,
+            channels: Optional[list] = None,
+            rows=slice(None),
+            samples=slice(None),
+    ) -> np.ndarray:
+        """Reads a selection of the waveforms.
+
+        Args:
+                channels (list, optional) : Channels (solution keys) to read.
+                        If None (default), reads every channel.
+                rows (slice or array, optional) : Runs to read. Defaults to all.
+                samples (slice, optional) : Time samples to read. Defaults to all.
+
+        Returns:
+                data (np.ndarray) : Array of shape (rows, channels, samples).
+        """
+        dset = self.file["waveforms"]
+        if channels is None:
+            return dset[rows, :, samples]
+
+        idx = [self._channel_idx[c] for c in channels]
+        return np.stack([dset[rows, i, samples] for i in idx], axis=-2)
+
+    def channel(self, name: str, rows=slice(None), samples=slice(None)) -> np.ndarray:
+        """Reads a single channel of the waveforms as a (rows, samples) array."""
+        return self.file["waveforms"][rows, self._channel_idx[name], samples]
+
+    def params(self, columns: Optional[list] = None, rows=slice(None)) -> pd.DataFrame:
+        """Reads the parameter table.
+
+        Args:
+                columns (list, optional) : Parameter columns to read.
+                        If None (default), reads every column.
+                rows (slice or array, optional) : Runs to read. Defaults to all.
+
+        Returns:
+                params (pd.DataFrame) : Parameters with one row per run.
+        """
+        columns = self.columns if columns is None else columns
+        return pd.DataFrame(
+            {c: self.file["params"][c][rows] for c in columns},
+        )
+
+    def __getitem__(self, idx: int) -> dict:
+        """Returns a single run as a solution dictionary."""
+        data = self.file["waveforms"][idx]
+        return {c: data[i] for i, c in enumerate(self.channels)}
+
+
+def shard_path(path: str, rank: Optional[int] = None) -> str:
+    """Returns the path of a writer's shard of a store.
+
+    Args:
+        path (str) : Path of the merged store.
+        rank (int, optional) : Index of the writer. If None (default), uses
+                the process id.
+
+    Returns:
+        shard (str) : Path to the shard.
+    """
+    rank = os.getpid() if rank is None else rank
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{rank}{ext}"
+
+
+def merge_shards(
+        path: str,
+        shards: Optional[list] = None,
+        remove: bool = True,
+        rows_per_read: int = 256,
+) -> int:
+    """Appends the contents of shards into a single store.
+
+    Args:
+        path (str) : Path of the merged store, created if it does not exist.
+        shards (list, optional) : Paths of the shards. If None (default), all
+                shards of path created with shard_path are merged.
+        remove (bool, optional) : Removes each shard once merged.
+                Defaults to True.
+        rows_per_read (int, optional) : Number of runs copied at a time.
+                Defaults to 256.
+
+    Returns:
+        num_rows (int) : Number of runs merged.
+    """
+    if shards is None:
+        root, ext = os.path.splitext(path)
+        shards = sorted(glob.glob(f"{glob.escape(root)}.shard*{ext}"))
+
+    num_rows = 0
+    with WaveformStore(path) as store:
+        for shard_file in shards:
+            with WaveformStore(shard_file, mode="r") as shard:
+                if shard.channels != store.channels:
+                    logger.critical(f"Channels of {shard_file} do not match {path}.")
+                    raise ValueError
+
+                for i in range(0, len(shard), rows_per_read):
+                    rows = slice(i, min(i + rows_per_read, len(shard)))
+                    data = shard.file["waveforms"][rows]
+                    if "waveforms" not in store.file:
+                        store._create_waveforms(data.shape[-1])
+
+                    dset = store.file["waveforms"]
+                    start = dset.shape[0]
+                    dset.resize((start + data.shape[0], *dset.shape[1:]))
+                    dset[start:] = data
+                    if shard.columns or store.columns:
+                        store._append_params(start, data.shape[0], {
+                            c: shard.file["params"][c][rows] for c in shard.columns
+                        })
+                num_rows += len(shard)
+
+            logger.debug(f"Merged {shard_file} into {path}")
+            if remove:
+                os.remove(shard_file)
+
+    logger.info(f"Merged {num_rows} runs from {len(shards)} shards into {path}")
+    return num_rows
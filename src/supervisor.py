@@ -0,0 +1,276 @@
+#! /usr/bin/env python
+"""Supervised worker processes with per-task wall clock timeouts."""
+
+# Python imports
+import time
+import logging
+import threading
+import traceback
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from concurrent.futures import Future
+from collections import deque
+from typing import Optional
+
+# Local imports
+from src.trace import flush as flush_trace
+
+logger = logging.getLogger(__name__)
+
+
+class TaskTimeout(TimeoutError):
+    """Raised for a task that ran for longer than the timeout."""
+
+
+class WorkerDied(RuntimeError):
+    """Raised for a task whose worker exited (e.g. crashed) while running it."""
+
+
+def _worker_loop(conn, func):
+    """Runs the tasks sent over a connection until told to stop."""
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+
+        args, kwargs = task
+        try:
+            result = (True, func(*args, **kwargs))
+        except Exception as e:
+            logger.debug(f"Task failed:\n{traceback.format_exc()}")
+            result = (False, e)
+        flush_trace()
+
+        try:
+            conn.send(result)
+        except Exception as e:
+            # The result or exception could not be pickled
+            conn.send((False, RuntimeError(f"Could not return result: {e!r}")))
+
+
+class _Worker:
+
+    def __init__(self, ctx, func):
+        """A worker process and the task it is running."""
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_loop, args=(child, func), daemon=True,
+        )
+        self.process.start()
+        child.close()
+        self.task = None
+        self.deadline = None
+
+    def stop(self, timeout: float = 1.0):
+        """Asks the worker to exit, killing it if it does not."""
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        self.kill()
+
+    def kill(self):
+        """Kills the worker and releases its connection."""
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class Supervisor:
+
+    def __init__(
+            self,
+            func,
+            num_workers: Optional[int] = None,
+            timeout: Optional[float] = None,
+            mp_context=None,
+    ):
+        """Runs tasks in a fixed number of supervised worker processes.
+
+        Unlike mp.Pool, each task is given to a worker on its own and timed.
+        A worker that runs a task for longer than timeout is killed, as is
+        the case for a hang inside the Fortran library, and a worker that
+        exits while running a task (e.g. a segmentation fault) is noticed.
+        Either way the task fails with TaskTimeout or WorkerDied and a new
+        worker takes the place of the old one, so the number of live workers
+        never degrades. Tasks that raise fail with their exception.
+
+        Tasks are submitted from any thread and return a
+        concurrent.futures.Future, e.g.
+
+            with Supervisor(solve_system, num_workers=8, timeout=60) as sup:
+                futures = [sup.submit(**params) for params in param_list]
+                sols = [f.result() for f in futures]
+
+        Args:
+                func (callable) : Function run by the workers, must be
+                        picklable with the spawn and forkserver start methods.
+                num_workers (int, optional) : Number of worker processes.
+                        Defaults to the number of CPUs minus one.
+                timeout (float, optional) : Wall clock time (s) a task may
+                        run for. If None (default), tasks never time out but
+                        workers that die are still replaced.
+                mp_context (optional) : Multiprocessing context used to start
+                        the workers. Defaults to mp.get_context().
+        """
+        num_workers = mp.cpu_count() - 1 if num_workers is None else num_workers
+        self.func = func
+        self.num_workers = max(1, num_workers)
+        self.timeout = timeout
+        self._ctx = mp_context if mp_context is not None else mp.get_context()
+
+        # Counts of the tasks and workers that had to be dealt with
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.restarts = 0
+
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._wakeup_recv, self._wakeup_send = self._ctx.Pipe(duplex=False)
+        self._workers = [_Worker(self._ctx, func) for _ in range(self.num_workers)]
+
+        self._thread = threading.Thread(
+            target=self._monitor, name="supervisor", daemon=True,
+        )
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def submit(self, *args, **kwargs) -> Future:
+        """Queues a call of func with the arguments.
+
+        Returns:
+                future (Future) : Resolves to the return value of func, or
+                        fails with its exception, TaskTimeout or WorkerDied.
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                logger.critical("Cannot submit tasks after shutdown.")
+                raise RuntimeError
+            self._pending.append((future, args, kwargs))
+            self._wakeup_send.send(None)
+        return future
+
+    def shutdown(self, wait: bool = True, cancel: bool = False):
+        """Stops the workers once the queued tasks are done.
+
+        Args:
+                wait (bool, optional) : Whether to wait for the workers to
+                        stop. Defaults to True.
+                cancel (bool, optional) : Whether to cancel the tasks that
+                        have not started. Defaults to False.
+        """
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                if cancel:
+                    while self._pending:
+                        self._pending.popleft()[0].cancel()
+                self._wakeup_send.send(None)
+        if wait:
+            self._thread.join()
+
+    def _start_tasks(self):
+        """Gives the queued tasks to the idle workers."""
+        with self._lock:
+            for worker in self._workers:
+                while worker.task is None and self._pending:
+                    future, args, kwargs = self._pending.popleft()
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        worker.conn.send((args, kwargs))
+                    except Exception as e:
+                        future.set_exception(e)
+                        self.failed += 1
+                        continue
+                    worker.task = future
+                    if self.timeout is not None:
+                        worker.deadline = time.monotonic() + self.timeout
+
+    def _replace(self, idx: int, reason: str):
+        """Kills a worker and starts a new one in its place."""
+        worker = self._workers[idx]
+        logger.warning(
+            f"Replacing worker {worker.process.pid} ({reason})."
+        )
+        worker.kill()
+        self._workers[idx] = _Worker(self._ctx, self.func)
+        self.restarts += 1
+
+    def _finish(self, worker, ok: bool, value):
+        """Resolves the task of a worker."""
+        future, worker.task, worker.deadline = worker.task, None, None
+        if ok:
+            self.completed += 1
+            future.set_result(value)
+        else:
+            self.failed += 1
+            future.set_exception(value)
+
+    def _monitor(self):
+        """Hands out tasks and watches the workers until shutdown."""
+        while True:
+            self._start_tasks()
+            with self._lock:
+                busy = [w for w in self._workers if w.task is not None]
+                if self._closed and not busy and not self._pending:
+                    break
+
+            timeout = None
+            deadlines = [w.deadline for w in busy if w.deadline is not None]
+            if deadlines:
+                timeout = max(0.0, min(deadlines) - time.monotonic())
+            ready = wait(
+                [self._wakeup_recv]
+                + [w.conn for w in busy]
+                + [w.process.sentinel for w in busy],
+                timeout=timeout,
+            )
+            while self._wakeup_recv.poll():
+                self._wakeup_recv.recv()
+
+            now = time.monotonic()
+            for worker in busy:
+                idx = self._workers.index(worker)
+                if worker.conn in ready:
+                    try:
+                        ok, value = worker.conn.recv()
+                    except (EOFError, OSError):
+                        pass
+                    else:
+                        self._finish(worker, ok, value)
+                        continue
+
+                # The worker is replaced before the task fails, so the counts
+                # are up to date once the task has failed
+                if worker.conn in ready or worker.process.sentinel in ready:
+                    worker.process.join()
+                    exitcode = worker.process.exitcode
+                    self._replace(idx, f"exited with code {exitcode}")
+                    self._finish(worker, False, WorkerDied(
+                        f"Worker exited with code {exitcode} while running a task."
+                    ))
+                elif worker.deadline is not None and now >= worker.deadline:
+                    self.timeouts += 1
+                    self._replace(idx, f"task exceeded {self.timeout}s")
+                    self._finish(worker, False, TaskTimeout(
+                        f"Task did not finish within {self.timeout}s."
+                    ))
+
+        for worker in self._workers:
+            worker.stop()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
@@ -0,0 +1,339 @@
+#! /usr/bin/env python
+"""Live throughput telemetry for optimisation and sweep runs."""
+
+# Python imports
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from typing import Optional
+from collections import deque
+
+# Module imports
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Percentiles of the solve time reported
+PERCENTILES = (50, 90, 99)
+
+
+class _Counter:
+
+    def __init__(
+            self,
+            total: Optional[int] = None,
+            num_workers: int = 1,
+            window: int = 1000,
+    ):
+        """Evaluation and solve counters of a run or a patient.
+
+        Args:
+                total (int, optional) : Expected number of evaluations, used
+                        for the ETA.
+                num_workers (int, optional) : Number of workers solving in
+                        parallel. Defaults to 1.
+                window (int, optional) : Number of recent solve times kept
+                        for the percentiles. Defaults to 1000.
+        """
+        self.total = total
+        self.num_workers = max(1, num_workers)
+        self.start = time.time()
+        self.end = None
+        self.evaluations = 0
+        self.solves = 0
+        self.nans = 0
+        self.busy = 0.0
+        self.times = deque(maxlen=window)
+
+    def record_solve(self, duration: float, finite: bool = True):
+        """Records a solve and how long it took."""
+        self.solves += 1
+        self.nans += not finite
+        self.busy += duration
+        self.times.append(duration)
+
+    def summary(self, now: float) -> dict:
+        """Returns the current rates, percentiles and ETA."""
+        elapsed = max((self.end or now) - self.start, 1e-9)
+        rate = self.evaluations / elapsed
+
+        eta = None
+        if self.total is not None and rate > 0:
+            eta = max(self.total - self.evaluations, 0) / rate
+
+        times = np.array(self.times)
+        percentiles = {
+            f"p{q}": float(np.percentile(times, q)) if times.size else None
+            for q in PERCENTILES
+        }
+        return {
+            "elapsed_s": elapsed,
+            "evaluations": self.evaluations,
+            "total": self.total,
+            "evaluations_per_s": rate,
+            "solves": self.solves,
+            "solve_time_s": percentiles,
+            "utilisation": min(self.busy / (elapsed * self.num_workers), 1.0),
+            "nan_rate": self.nans / self.solves if self.solves else 0.0,
+            "eta_s": eta,
+        }
+
+
+class Telemetry:
+
+    def __init__(
+            self,
+            path: Optional[str] = None,
+            num_patients: Optional[int] = None,
+            num_workers: int = 1,
+            interval: float = 30.0,
+            window: int = 1000,
+            run_id: Optional[str] = None,
+    ):
+        """Collects and exports the throughput of a run.
+
+        Optimisers (and sweeps) record each evaluation and solve against the
+        patient they belong to. The run and per patient evaluations per
+        second, solve time percentiles, worker utilisation (the fraction of
+        the wall time the workers spent solving), NaN rate, queue depth and
+        ETA are periodically written to a file, so runs on nodes without a
+        terminal can be watched with e.g. `watch cat telemetry.json` or
+        scraped by the Prometheus node exporter.
+
+        Args:
+                path (str, optional) : File to write. Files ending in ".prom"
+                        are written in the Prometheus text format, any other
+                        as JSON. If None (default), nothing is written and the
+                        telemetry is only available through snapshot.
+                num_patients (int, optional) : Number of patients in the run,
+                        used for the run ETA.
+                num_workers (int, optional) : Number of workers solving in
+                        parallel within a patient. Defaults to 1.
+                interval (float, optional) : Minimum time (s) between writes.
+                        Defaults to 30.
+                window (int, optional) : Number of recent solve times kept
+                        for the percentiles. Defaults to 1000.
+                run_id (str, optional) : Name of the run. Defaults to the
+                        host name and process id.
+        """
+        self.path = path
+        self.prometheus = path is not None and path.endswith(".prom")
+        self.num_patients = num_patients
+        self.num_workers = num_workers
+        self.interval = interval
+        self.window = window
+        self.run_id = (
+            run_id if run_id is not None
+            else f"{socket.gethostname()}-{os.getpid()}"
+        )
+
+        self.run = _Counter(None, num_workers, window)
+        self.patients = dict()
+        self.finished = deque(maxlen=100)
+        self.num_finished = 0
+        self.num_failed = 0
+        self.queue = None
+
+        self._lock = threading.Lock()
+        self._last_write = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start_patient(
+            self,
+            name: str,
+            total: Optional[int] = None,
+            num_workers: Optional[int] = None,
+    ):
+        """Starts tracking a patient.
+
+        Args:
+                name (str) : Name of the patient.
+                total (int, optional) : Expected number of evaluations (e.g.
+                        the optimiser budget), used for the patient ETA.
+                num_workers (int, optional) : Number of workers solving the
+                        patient. Defaults to the workers of the run.
+        """
+        num_workers = self.num_workers if num_workers is None else num_workers
+        with self._lock:
+            self.patients[str(name)] = _Counter(total, num_workers, self.window)
+        self.write(force=False)
+
+    def finish_patient(self, name: str, failed: bool = False):
+        """Stops tracking a patient."""
+        now = time.time()
+        with self._lock:
+            counter = self.patients.pop(str(name), None)
+            self.num_finished += 1
+            self.num_failed += failed
+            if counter is not None:
+                counter.end = now
+                self.finished.append({
+                    "patient": str(name),
+                    "failed": failed,
+                    **counter.summary(now),
+                })
+        self.write(force=False)
+
+    def record_solve(
+            self,
+            duration: float,
+            finite: bool = True,
+            patient: Optional[str] = None,
+    ):
+        """Records a solve.
+
+        Args:
+                duration (float) : Wall time of the solve (s).
+                finite (bool, optional) : Whether the solution (or its loss)
+                        was finite. Defaults to True.
+                patient (str, optional) : Patient the solve belongs to.
+        """
+        with self._lock:
+            self.run.record_solve(duration, finite)
+            counter = self.patients.get(str(patient))
+            if counter is not None:
+                counter.record_solve(duration, finite)
+
+    def record_evaluation(self, patient: Optional[str] = None):
+        """Records a completed evaluation (a told candidate)."""
+        with self._lock:
+            self.run.evaluations += 1
+            counter = self.patients.get(str(patient))
+            if counter is not None:
+                counter.evaluations += 1
+        self.write(force=False)
+
+    def set_queue(self, progress: dict):
+        """Records the state of a work queue, see WorkQueue.progress."""
+        with self._lock:
+            self.queue = dict(progress)
+        self.write(force=False)
+
+    def snapshot(self) -> dict:
+        """Returns the current telemetry of the run and each patient."""
+        now = time.time()
+        with self._lock:
+            run = self.run.summary(now)
+
+            # The run ETA is from the time taken by each finished patient
+            run["patients_finished"] = self.num_finished
+            run["patients_failed"] = self.num_failed
+            run["patients_active"] = len(self.patients)
+            run["patients_total"] = self.num_patients
+            remaining = None
+            if self.queue is not None:
+                remaining = self.queue.get("pending", 0) + self.queue.get("claimed", 0)
+            elif self.num_patients is not None:
+                remaining = max(self.num_patients - self.num_finished, 0)
+            run["eta_s"] = None
+            if remaining is not None and self.num_finished > 0:
+                run["eta_s"] = remaining * run["elapsed_s"] / self.num_finished
+
+            return {
+                "run_id": self.run_id,
+                "timestamp": now,
+                "run": run,
+                "queue": self.queue,
+                "patients": {
+                    name: counter.summary(now)
+                    for name, counter in self.patients.items()
+                },
+                "finished": list(self.finished),
+            }
+
+    def _to_prometheus(self, snapshot: dict) -> str:
+        """Formats a snapshot in the Prometheus text format."""
+        lines = []
+
+        def add(name: str, value, labels: Optional[dict] = None):
+            if value is None:
+                return
+            labels = {"run": snapshot["run_id"], **(labels or dict())}
+            label = ",".join(
+                '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                for k, v in labels.items()
+            )
+            lines.append(f"cl0_{name}{{{label}}} {float(value)}")
+
+        def header(name: str, help_text: str):
+            lines.append(f"# HELP cl0_{name} {help_text}")
+            lines.append(f"# TYPE cl0_{name} gauge")
+
+        summaries = {"run": snapshot["run"], **snapshot["patients"]}
+        for name, key, help_text in (
+                ("evaluations", "evaluations", "Completed evaluations."),
+                ("evaluations_per_second", "evaluations_per_s", "Evaluations per second."),
+                ("solves", "solves", "Completed solves."),
+                ("worker_utilisation", "utilisation", "Fraction of worker time spent solving."),
+                ("nan_rate", "nan_rate", "Fraction of solves that were not finite."),
+                ("eta_seconds", "eta_s", "Estimated time remaining."),
+        ):
+            header(name, help_text)
+            for scope, summary in summaries.items():
+                add(name, summary[key], None if scope == "run" else {"patient": scope})
+
+        header("solve_time_seconds", "Percentiles of the recent solve times.")
+        for scope, summary in summaries.items():
+            for q, value in summary["solve_time_s"].items():
+                labels = {"quantile": int(q[1:]) / 100}
+                if scope != "run":
+                    labels["patient"] = scope
+                add("solve_time_seconds", value, labels)
+
+        header("patients", "Patients by state.")
+        for state in ("finished", "failed", "active"):
+            add("patients", snapshot["run"][f"patients_{state}"], {"state": state})
+
+        if snapshot["queue"] is not None:
+            header("queue_depth", "Work queue items by status.")
+            for status, count in snapshot["queue"].items():
+                add("queue_depth", count, {"status": status})
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, force: bool = True):
+        """Rewrites the telemetry file.
+
+        The file is replaced atomically so readers never see a partial
+        file.
+
+        Args:
+                force (bool, optional) : If False, only writes if at least
+                        interval seconds have passed since the last write.
+                        Defaults to True.
+        """
+        if self.path is None:
+            return
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_write < self.interval:
+                return
+            self._last_write = now
+
+        snapshot = self.snapshot()
+        if self.prometheus:
+            text = self._to_prometheus(snapshot)
+        else:
+            text = json.dumps(snapshot, indent=2)
+
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(text)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not write telemetry to {self.path}: {e}")
+
+    def close(self):
+        """Writes the final telemetry."""
+        with self._lock:
+            self.run.end = time.time()
+        self.write()
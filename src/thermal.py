@@ -0,0 +1,280 @@
+#! /usr/bin/env python
+"""Dynamic two-node thermal model coupled beat by beat to the solver."""
+
+# Python imports
+import math
+import logging
+from typing import Optional
+
+# Module imports
+import numpy as np
+
+# Local imports
+from src.cl0 import load_defaults, solve_system_stream, _merge_inputs
+
+logger = logging.getLogger(__name__)
+
+C_BODY = 3492.0         # Specific heat of the body (J/kg/K)
+C_BLOOD = 1.163         # Specific heat of blood (W h/L/K)
+K_CR_SK = 5.28          # Conductance between core and skin (W/m^2/K)
+C_SWEAT = 170.0         # Sweating coefficient (g/m^2/hr)
+C_SHIVER = 19.4         # Shivering coefficient (W/m^2/K^2)
+LEWIS = 16.5            # Lewis relation (K/kPa)
+I_CL = 0.45             # Vapour permeation efficiency of clothing
+H_R = 4.7               # Linear radiative heat transfer coefficient (W/m^2/K)
+MET = 58.2              # Metabolic rate of 1 met (W/m^2)
+SKBF_MIN = 0.5          # Minimum skin blood flow (L/m^2/hr)
+SKBF_MAX = 90.0         # Maximum skin blood flow (L/m^2/hr)
+
+
+def _p_sat(t: float) -> float:
+    """Saturated vapour pressure (kPa) of water at a temperature (°C)."""
+    return 0.61078 * math.exp(17.27 * t / (t + 237.3))
+
+
+class TwoNodeThermal:
+
+    def __init__(
+            self,
+            thermal_system: Optional[dict] = None,
+            height: float = 160,
+            weight: float = 80,
+            t_air: float = 28.0,
+            t_rad: Optional[float] = None,
+            rh: float = 0.5,
+            v_air: float = 0.1,
+            met: float = 1.0,
+            clo: float = 0.5,
+            max_dt: float = 5.0,
+    ):
+        """Gagge's two-node model of core and skin temperature.
+
+        The body is a core node and a skin shell exchanging heat by
+        conduction and skin blood flow. The core produces metabolic heat (and
+        heat from shivering) and loses heat through respiration, the skin
+        exchanges heat with the environment by convection, radiation and
+        evaporation of sweat. Skin blood flow follows the same vasodilation
+        and vasoconstriction signals as the resistance index of the solver,
+        so the temperatures evolve over minutes and can be passed to the
+        solver as its thermal_system inputs.
+
+        The environment (t_air, t_rad, rh, v_air, met and clo) can be changed
+        between steps.
+
+        Args:
+                thermal_system (dict, optional) : Initial and neutral core and
+                        skin temperatures along with the basal skin blood flow
+                        and the vasodilation and vasoconstriction coefficients,
+                        as passed to solve_system. Missing values use the
+                        solver defaults.
+                height (float, optional) : Height (cm). Defaults to 160.
+                weight (float, optional) : Weight (kg). Defaults to 80.
+                t_air (float, optional) : Air temperature (°C). Defaults to 28.
+                t_rad (float, optional) : Mean radiant temperature (°C).
+                        If None (default), equal to the air temperature.
+                rh (float, optional) : Relative humidity (0 to 1).
+                        Defaults to 0.5.
+                v_air (float, optional) : Air speed (m/s). Defaults to 0.1.
+                met (float, optional) : Metabolic rate (met). Defaults to 1.
+                clo (float, optional) : Clothing insulation (clo).
+                        Defaults to 0.5.
+                max_dt (float, optional) : Largest explicit time step (s),
+                        longer steps are split. Defaults to 5.
+        """
+        therm = load_defaults()["thermal_system"]
+        therm.update(thermal_system or dict())
+
+        self.q_sk_basal = therm["q_sk_basal"]
+        self.k_dil = therm["k_dil"]
+        self.k_con = therm["k_con"]
+        self.t_cr = therm["t_cr"]
+        self.t_sk = therm["t_sk"]
+        self.t_cr_ref = therm["t_cr_ref"]
+        self.t_sk_ref = therm["t_sk_ref"]
+
+        self.weight = weight
+        self.area = 0.202 * weight ** 0.425 * (height / 100) ** 0.725
+        self.t_air = t_air
+        self.t_rad = t_rad
+        self.rh = rh
+        self.v_air = v_air
+        self.met = met
+        self.clo = clo
+        self.max_dt = max_dt
+        self.t = 0.0
+
+    def resistance_index(self) -> float:
+        """Ratio of regulated to basal skin blood flow, as used by the solver."""
+        if abs(self.q_sk_basal) <= 1e-30:
+            return 1.0
+        wsig_cr = max(0.0, self.t_cr - self.t_cr_ref)
+        csig_sk = max(0.0, self.t_sk_ref - self.t_sk)
+        return (self.q_sk_basal + self.k_dil * wsig_cr) / (
+            self.q_sk_basal * (1 + self.k_con * csig_sk)
+        )
+
+    def skin_blood_flow(self) -> float:
+        """Regulated skin blood flow (L/m^2/hr)."""
+        return self.q_sk_basal * self.resistance_index()
+
+    def derivatives(self, skbf: float) -> tuple:
+        """Rates of change of core and skin temperature (°C/s).
+
+        Args:
+                skbf (float) : Skin blood flow (L/m^2/hr).
+
+        Returns:
+                dt_cr (float) : Rate of change of core temperature.
+                dt_sk (float) : Rate of change of skin temperature.
+        """
+        skbf = min(max(skbf, SKBF_MIN), SKBF_MAX)
+        t_rad = self.t_air if self.t_rad is None else self.t_rad
+        m = self.met * MET
+
+        # Thermoregulatory signals
+        alpha = 0.0418 + 0.745 / (skbf + 0.585)
+        t_b = alpha * self.t_sk + (1 - alpha) * self.t_cr
+        t_b_ref = alpha * self.t_sk_ref + (1 - alpha) * self.t_cr_ref
+        wsig_sk = max(0.0, self.t_sk - self.t_sk_ref)
+        csig_sk = max(0.0, self.t_sk_ref - self.t_sk)
+        csig_cr = max(0.0, self.t_cr_ref - self.t_cr)
+        wsig_b = max(0.0, t_b - t_b_ref)
+
+        # Respiratory losses (vapour pressure in mmHg)
+        p_a = self.rh * _p_sat(self.t_air)
+        res = 0.0023 * m * (44 - 7.5006 * p_a) + 0.0014 * m * (34 - self.t_air)
+
+        # Dry heat loss through the clothing
+        h_c = max(3.0, 8.6 * self.v_air ** 0.53)
+        h = h_c + H_R
+        t_op = (H_R * t_rad + h_c * self.t_air) / h
+        r_cl = 0.155 * self.clo
+        f_cl = 1 + 0.15 * self.clo
+        dry = (self.t_sk - t_op) / (r_cl + 1 / (f_cl * h))
+
+        # Evaporative heat loss, limited by the wettedness of the skin
+        e_max = (_p_sat(self.t_sk) - p_a) / (
+            r_cl / (LEWIS * I_CL) + 1 / (f_cl * LEWIS * h_c)
+        )
+        e_rsw = 0.68 * C_SWEAT * wsig_b * math.exp(wsig_sk / 10.7)
+        if e_max > 0:
+            e_sk = min(e_max, 0.06 * e_max + 0.94 * e_rsw)
+        else:
+            e_sk = 0.0
+
+        # Heat storage in each node
+        q_cr_sk = (K_CR_SK + C_BLOOD * skbf) * (self.t_cr - self.t_sk)
+        s_cr = m + C_SHIVER * csig_sk * csig_cr - res - q_cr_sk
+        s_sk = q_cr_sk - dry - e_sk
+
+        heat_capacity = self.weight * C_BODY / self.area
+        return (
+            s_cr / ((1 - alpha) * heat_capacity),
+            s_sk / (alpha * heat_capacity),
+        )
+
+    def step(self, dt: float, skbf: Optional[float] = None):
+        """Advances the temperatures with fixed skin blood flow.
+
+        Args:
+                dt (float) : Time step (s).
+                skbf (float, optional) : Skin blood flow (L/m^2/hr). If None
+                        (default), uses the regulated skin blood flow.
+        """
+        num_steps = max(1, math.ceil(dt / self.max_dt))
+        h = dt / num_steps
+        for _ in range(num_steps):
+            dt_cr, dt_sk = self.derivatives(
+                self.skin_blood_flow() if skbf is None else skbf
+            )
+            self.t_cr += h * dt_cr
+            self.t_sk += h * dt_sk
+        self.t += dt
+
+    def inputs(self) -> dict:
+        """Current temperatures as solver inputs."""
+        return {"thermal_system": {"t_cr": self.t_cr, "t_sk": self.t_sk}}
+
+
+def solve_system_thermal(
+        model: TwoNodeThermal,
+        duration: float,
+        inputs: Optional[dict] = None,
+        schedule=None,
+        output: str = "metrics",
+        decimate: int = 1,
+        channels: Optional[list] = None,
+        initial_state: Optional[np.ndarray] = None,
+):
+    """Couples the two-node thermal model to the solver beat by beat.
+
+    Uses a multi-rate scheme: each beat is solved with the resistances given
+    by the current temperatures held fixed, then the thermal model advances
+    by the period of the beat using the cycle averaged flow. The skin is
+    treated as a bed in parallel with the rest of the systemic circulation,
+    its share of the cardiac output at the first beat matches the regulated
+    skin blood flow and its conductance then follows the resistance index,
+    so a heart that cannot raise its output limits the heat carried to the
+    skin. An hour of simulation costs a few thousand single beat solves.
+
+    Args:
+        model (TwoNodeThermal) : Thermal model, updated in place.
+        duration (float) : Simulated time (s).
+        inputs (dict, optional) : Base inputs passed to solve_system, the
+                thermal_system inputs other than t_cr and t_sk should match
+                the model.
+        schedule (callable, optional) : Other inputs that change every beat,
+                a callable taking the start time of the beat and the beat
+                number, see solve_system_stream.
+        output (str, optional) : "metrics" (default) or "waveforms", see
+                solve_system_stream.
+        decimate (int, optional) : Keeps every decimate-th sample of the
+                waveforms. Defaults to 1.
+        channels (list, optional) : Solution keys to yield with waveforms.
+                If None (default), yields every key.
+        initial_state (np.ndarray, optional) : State to start from.
+
+    Yields:
+        beat (dict) : As solve_system_stream along with the core and skin
+                temperature ('t_cr', 't_sk') and skin blood flow ('skbf',
+                L/m^2/hr) used for the beat, in the metadata for waveforms.
+    """
+    inputs = dict() if inputs is None else inputs
+
+    def beats(t: float, beat: int) -> Optional[dict]:
+        overrides = dict() if schedule is None else schedule(t, beat)
+        if overrides is None:
+            return None
+        return _merge_inputs(overrides, model.inputs())
+
+    skin_ratio = None
+    for result in solve_system_stream(
+            beats, inputs, duration, output, decimate, channels, initial_state,
+    ):
+        info = result if output == "metrics" else result.metadata
+        metrics = info if output == "metrics" else info["metrics"]
+        period = info["period"]
+
+        # Cycle averaged systemic flow (L/m^2/hr)
+        flow = metrics["co"] * 60 / model.area
+        if not (np.isfinite(flow) and flow > 0):
+            logger.critical(
+                f"Beat {info['beat']} at {info['t']:.1f}s has a cardiac output "
+                f"of {metrics['co']}, the solve may have diverged."
+            )
+            raise ValueError("Cannot couple the thermal model to this beat.")
+        lam = model.resistance_index()
+        if skin_ratio is None:
+            share = min(model.skin_blood_flow() / flow, 0.99)
+            skin_ratio = share / (1 - share) / lam
+        conductance = skin_ratio * lam
+        skbf = flow * conductance / (1 + conductance)
+
+        state = {"t_cr": model.t_cr, "t_sk": model.t_sk, "skbf": skbf}
+        if output == "metrics":
+            result.update(state)
+        else:
+            result.metadata.update(state)
+        yield result
+
+        model.step(period, skbf)
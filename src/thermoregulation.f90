@@ -54,4 +54,35 @@ contains
     new_r_sk = r_sk / lambda
 
   end function calc_r_sk
+
+  pure subroutine calc_resistance_index_d(therm, lambda, dlambda_dk_dil, dlambda_dk_con)
+    ! Calculates the resistance index and its derivatives with respect to the
+    ! coefficients of vasodilation and vasoconstriction.
+
+    ! Declares variables
+    type (thermal_system), intent(in) :: therm  ! Thermal system coefficients
+    real(dp), intent(out) :: lambda             ! Resistance index
+    real(dp), intent(out) :: dlambda_dk_dil     ! d(lambda) / d(k_dil)
+    real(dp), intent(out) :: dlambda_dk_con     ! d(lambda) / d(k_con)
+
+    real(dp) :: wsig_cr                         ! Warm signal - core.
+    real(dp) :: csig_sk                         ! Cold signal - skin.
+
+    ! Avoids diving by 0, matching calc_r_sk
+    if (abs(therm%q_sk_basal) > 1e-30) then
+       wsig_cr = max(0.0_dp, therm%T_cr - therm%T_cr_ref)
+       csig_sk = max(0.0_dp, therm%T_sk_ref - therm%T_sk)
+       lambda = calc_resistance_index(&
+            therm%q_sk_basal, &
+            therm%k_dil, therm%T_cr, therm%T_cr_ref, &
+            therm%k_con, therm%T_sk, therm%T_sk_ref)
+       dlambda_dk_dil = wsig_cr / (therm%q_sk_basal * (1 + therm%k_con * csig_sk))
+       dlambda_dk_con = -lambda * csig_sk / (1 + therm%k_con * csig_sk)
+    else
+       lambda = 1.0_dp
+       dlambda_dk_dil = 0.0_dp
+       dlambda_dk_con = 0.0_dp
+    end if
+
+  end subroutine calc_resistance_index_d
 end module thermoregulation
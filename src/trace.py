@@ -0,0 +1,242 @@
+#! /usr/bin/env python
+"""Opt-in span tracing exported as a Chrome Trace Event (Perfetto) timeline.
+
+Tracing is enabled by setting the CL0_TRACE environment variable to the path
+of the trace to write (or by calling enable), e.g.
+
+    CL0_TRACE=run.json python scripts/optimisation_example.py
+
+and the trace is written when the program exits. Open it in
+https://ui.perfetto.dev or chrome://tracing to see a timeline of every
+process and thread.
+
+Worker processes (which inherit the environment variable) append their spans
+to part files next to the trace, which are merged into the trace by the
+process that enabled tracing. When tracing is off, span returns a shared no-op
+context manager so the instrumented code pays for a single function call.
+"""
+
+# Python imports
+import os
+import json
+import time
+import glob
+import atexit
+import logging
+import threading
+import contextlib
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Returned by span when tracing is off
+_NULL_SPAN = contextlib.nullcontext()
+
+_path = None
+_owner = None
+_pid = None
+_events = []
+_threads = set()
+_lock = threading.Lock()
+
+
+def _now() -> float:
+    """Returns a timestamp in microseconds shared by every process."""
+    return time.perf_counter_ns() / 1000
+
+
+def _parts_dir(path: str) -> str:
+    """Returns the directory of the per-process part files of a trace."""
+    return f"{path}.parts"
+
+
+def enabled() -> bool:
+    """Whether tracing is on."""
+    return _path is not None
+
+
+def enable(path: str):
+    """Starts tracing to a file, written when the program exits.
+
+    Args:
+        path (str) : Path of the Chrome Trace Event JSON file.
+    """
+    _start(path, owner=True)
+
+
+def _start(path: str, owner: bool):
+    """Starts tracing in this process, as the owner of the trace or a worker."""
+    global _path, _owner, _pid
+    _path = os.path.abspath(path)
+    _pid = os.getpid()
+    os.makedirs(_parts_dir(_path), exist_ok=True)
+
+    if owner:
+        # Removes the parts of an earlier run to the same path
+        for part in glob.glob(os.path.join(_parts_dir(_path), "*.jsonl")):
+            os.remove(part)
+        _owner = _pid
+
+        # Worker processes inherit the trace through the environment
+        os.environ["CL0_TRACE"] = _path
+        os.environ["CL0_TRACE_OWNER"] = str(_pid)
+
+    _process_name("main" if owner else "worker")
+
+
+def disable():
+    """Stops tracing and discards the spans that have not been saved."""
+    global _path
+    _path = None
+    with _lock:
+        _events.clear()
+        _threads.clear()
+
+
+def _check_process():
+    """Discards the spans of the parent in a newly forked process."""
+    global _pid
+    pid = os.getpid()
+    if pid != _pid:
+        _pid = pid
+        _events.clear()
+        _threads.clear()
+        _process_name("worker")
+
+
+def _process_name(name: str):
+    """Records the name of the current process."""
+    _events.append({
+        "name": "process_name", "ph": "M", "pid": os.getpid(), "tid": 0,
+        "args": {"name": f"{name} ({os.getpid()})"},
+    })
+
+
+def _record(event: dict):
+    """Adds an event, naming its thread the first time it is seen."""
+    with _lock:
+        _check_process()
+        tid = event["tid"]
+        if tid not in _threads:
+            _threads.add(tid)
+            _events.append({
+                "name": "thread_name", "ph": "M", "pid": event["pid"], "tid": tid,
+                "args": {"name": threading.current_thread().name},
+            })
+        _events.append(event)
+
+
+class _Span:
+
+    __slots__ = ("name", "cat", "args", "start")
+
+    def __init__(self, name: str, cat: str, args: dict):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = _now()
+        return self
+
+    def __exit__(self, *exc):
+        end = _now()
+        _record({
+            "name": self.name,
+            "cat": self.cat,
+            "ph": "X",
+            "ts": self.start,
+            "dur": end - self.start,
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+            "args": self.args,
+        })
+        return False
+
+
+def span(name: str, cat: str = "cl0", **args):
+    """Context manager that records the time spent in a block.
+
+    Args:
+        name (str) : Name of the span.
+        cat (str, optional) : Category of the span, e.g. "solver" or "db".
+        **args : Extra values shown with the span.
+    """
+    if _path is None:
+        return _NULL_SPAN
+    return _Span(name, cat, args)
+
+
+def traced(func, name: Optional[str] = None, cat: str = "cl0"):
+    """Wraps a function so every call is recorded as a span."""
+    name = name if name is not None else func.__name__
+
+    def wrapper(*args, **kwargs):
+        with span(name, cat):
+            return func(*args, **kwargs)
+
+    wrapper.__wrapped__ = func
+    return wrapper
+
+
+def flush():
+    """Appends the spans of this process to its part file.
+
+    Worker processes call this after each task as they may be terminated
+    without running exit handlers.
+    """
+    if _path is None:
+        return
+    with _lock:
+        _check_process()
+        events = list(_events)
+        _events.clear()
+    if not events:
+        return
+
+    path = os.path.join(_parts_dir(_path), f"{os.getpid()}.jsonl")
+    try:
+        os.makedirs(_parts_dir(_path), exist_ok=True)
+        with open(path, "a") as f:
+            f.write("".join(json.dumps(e) + "\n" for e in events))
+    except OSError as e:
+        logger.warning(f"Could not write trace events to {path}: {e}")
+
+
+def save() -> Optional[str]:
+    """Merges the spans of every process into the trace file.
+
+    Only the process that enabled tracing writes the trace, other processes
+    flush their spans.
+
+    Returns:
+        path (str) : Path of the trace, or None if tracing is off.
+    """
+    if _path is None:
+        return None
+    flush()
+    if os.getpid() != _owner:
+        return None
+
+    events = []
+    parts = sorted(glob.glob(os.path.join(_parts_dir(_path), "*.jsonl")))
+    for part in parts:
+        with open(part, "r") as f:
+            events.extend(json.loads(line) for line in f if line.strip())
+
+    with open(_path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    for part in parts:
+        os.remove(part)
+    with contextlib.suppress(OSError):
+        os.rmdir(_parts_dir(_path))
+
+    logger.info(f"Wrote {len(events)} trace events to {_path}.")
+    return _path
+
+
+# Enables tracing from the environment, worker processes started with spawn
+# re-import this module and pick it up here
+if os.environ.get("CL0_TRACE"):
+    _start(os.environ["CL0_TRACE"], owner=not os.environ.get("CL0_TRACE_OWNER"))
+atexit.register(save)
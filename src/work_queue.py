@@ -0,0 +1,308 @@
+#! /usr/bin/env python
+"""Shared SQLite work queue for balancing jobs across processes and nodes."""
+
+# Python imports
+import os
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+
+
+def _quote(name: str) -> str:
+    """Quotes a table name for use in an SQL statement."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+class WorkQueue:
+
+    def __init__(
+            self,
+            db_path: str,
+            name: str = "work_queue",
+            lease: float = 3600.0,
+            max_attempts: int = 3,
+            worker: Optional[str] = None,
+            timeout: float = 60.0,
+    ):
+        """Connects to (or creates) a work queue.
+
+        Items are claimed atomically in batches so any number of workers, on
+        any number of nodes sharing the database file, can pull work until
+        the queue is empty. A claimed item is leased to its worker, if the
+        lease expires before the item is completed (e.g. the worker was
+        killed) the item becomes available again. Items that fail, or whose
+        lease expires, more than max_attempts times are marked as failed.
+
+        Args:
+                db_path (str) : Path to the SQLite3 database holding the queue.
+                name (str, optional) : Name of the queue table.
+                        Defaults to "work_queue".
+                lease (float, optional) : Time in seconds a worker has to
+                        complete (or renew) a claimed item. Defaults to 3600.
+                max_attempts (int, optional) : Maximum number of times an item
+                        is claimed before being marked as failed. Defaults to 3.
+                worker (str, optional) : Name of this worker. If None (default),
+                        uses the host name and process id.
+                timeout (float, optional) : SQLite busy timeout in seconds.
+                        Defaults to 60.
+        """
+        self.db_path = db_path
+        self.name = name
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.worker = (
+            worker if worker is not None else f"{socket.gethostname()}:{os.getpid()}"
+        )
+
+        # Transactions are managed explicitly so claims can take the write
+        # lock before reading
+        self.con = sqlite3.connect(db_path, timeout=timeout, isolation_level=None)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute(
+            f"CREATE TABLE IF NOT EXISTS {_quote(name)} ("
+            "item PRIMARY KEY, "
+            "status TEXT NOT NULL, "
+            "worker TEXT, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "lease_expires REAL, "
+            "updated REAL, "
+            "error TEXT)"
+        )
+        self.con.execute(
+            f"CREATE INDEX IF NOT EXISTS {_quote(f'idx_{name}_status')} "
+            f"ON {_quote(name)} (status, lease_expires)"
+        )
+
+    def close(self):
+        """Closes the connection to the queue."""
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, items: list) -> int:
+        """Adds items to the queue, items already in the queue are ignored.
+
+        Args:
+                items (list) : Items (e.g. row ids) to add.
+
+        Returns:
+                num_added (int) : Number of new items.
+        """
+        now = time.time()
+        self.con.execute("BEGIN IMMEDIATE")
+        try:
+            before = self.con.total_changes
+            self.con.executemany(
+                f"INSERT OR IGNORE INTO {_quote(self.name)} "
+                "(item, status, updated) VALUES (?, ?, ?)",
+                ((item, PENDING, now) for item in items),
+            )
+            num_added = self.con.total_changes - before
+            self.con.execute("COMMIT")
+        except Exception:
+            self.con.execute("ROLLBACK")
+            raise
+
+        logger.debug(f"Added {num_added} items to {self.name}")
+        return num_added
+
+    def _expire_leases(self, now: float):
+        """Returns items with expired leases to the queue (or fails them)."""
+        self.con.execute(
+            f"UPDATE {_quote(self.name)} SET "
+            f"status = CASE WHEN attempts >= ? THEN '{FAILED}' ELSE '{PENDING}' END, "
+            "error = 'Lease expired', worker = NULL, updated = ? "
+            f"WHERE status = '{CLAIMED}' AND lease_expires < ?",
+            (self.max_attempts, now, now),
+        )
+
+    def claim(self, num: int = 1) -> list:
+        """Atomically claims pending items.
+
+        Args:
+                num (int, optional) : Maximum number of items to claim.
+                        Defaults to 1.
+
+        Returns:
+                items (list) : Claimed items, empty if there is no work left.
+        """
+        now = time.time()
+        self.con.execute("BEGIN IMMEDIATE")
+        try:
+            self._expire_leases(now)
+            items = [
+                r[0] for r in self.con.execute(
+                    f"SELECT item FROM {_quote(self.name)} "
+                    f"WHERE status = '{PENDING}' ORDER BY item LIMIT ?",
+                    (num,),
+                )
+            ]
+            self.con.executemany(
+                f"UPDATE {_quote(self.name)} SET status = '{CLAIMED}', "
+                "worker = ?, attempts = attempts + 1, lease_expires = ?, updated = ? "
+                "WHERE item = ?",
+                ((self.worker, now + self.lease, now, item) for item in items),
+            )
+            self.con.execute("COMMIT")
+        except Exception:
+            self.con.execute("ROLLBACK")
+            raise
+
+        logger.debug(f"{self.worker} claimed {items} from {self.name}")
+        return items
+
+    def _update_claimed(self, items: list, assignment: str, params: tuple) -> int:
+        """Updates items that are still claimed by this worker."""
+        self.con.execute("BEGIN IMMEDIATE")
+        try:
+            before = self.con.total_changes
+            self.con.executemany(
+                f"UPDATE {_quote(self.name)} SET {assignment} "
+                f"WHERE item = ? AND worker = ? AND status = '{CLAIMED}'",
+                ((*params, item, self.worker) for item in items),
+            )
+            num_updated = self.con.total_changes - before
+            self.con.execute("COMMIT")
+        except Exception:
+            self.con.execute("ROLLBACK")
+            raise
+
+        if num_updated < len(items):
+            logger.warning(
+                f"{len(items) - num_updated} items are no longer claimed by "
+                f"{self.worker}, their lease may have expired."
+            )
+        return num_updated
+
+    def complete(self, items: list) -> int:
+        """Marks claimed items as done.
+
+        Returns:
+                num_completed (int) : Number of items completed. Items whose
+                        lease expired and were claimed by another worker are
+                        not counted.
+        """
+        return self._update_claimed(
+            items,
+            f"status = '{DONE}', lease_expires = NULL, updated = ?",
+            (time.time(),),
+        )
+
+    def fail(self, items: list, error: Optional[str] = None) -> int:
+        """Returns claimed items to the queue, or fails them after max_attempts.
+
+        Args:
+                items (list) : Items that failed.
+                error (str, optional) : Error message to record.
+
+        Returns:
+                num_failed (int) : Number of items updated.
+        """
+        return self._update_claimed(
+            items,
+            f"status = CASE WHEN attempts >= ? THEN '{FAILED}' ELSE '{PENDING}' END, "
+            "worker = NULL, lease_expires = NULL, error = ?, updated = ?",
+            (self.max_attempts, error, time.time()),
+        )
+
+    def release(self, items: list) -> int:
+        """Returns claimed items to the queue without counting an attempt."""
+        return self._update_claimed(
+            items,
+            f"status = '{PENDING}', attempts = attempts - 1, "
+            "worker = NULL, lease_expires = NULL, updated = ?",
+            (time.time(),),
+        )
+
+    def renew(self, items: list) -> int:
+        """Extends the lease of claimed items, for items that take a long time."""
+        now = time.time()
+        return self._update_claimed(
+            items, "lease_expires = ?, updated = ?", (now + self.lease, now),
+        )
+
+    @contextmanager
+    def heartbeat(self, items: list, interval: Optional[float] = None):
+        """Keeps renewing the lease of claimed items while they are worked on.
+
+        The leases are renewed by a background thread, so an item that takes
+        longer than the lease is not reclaimed by another worker, e.g.
+
+            with queue.heartbeat([item]):
+                ...
+
+        Args:
+                items (list) : Claimed items to renew.
+                interval (float, optional) : Time in seconds between renewals.
+                        Defaults to a third of the lease.
+        """
+        interval = interval if interval is not None else self.lease / 3
+        stop = threading.Event()
+
+        def renew():
+            # SQLite connections cannot be shared between threads
+            queue = WorkQueue(
+                self.db_path, self.name, self.lease, self.max_attempts,
+                self.worker, self.timeout,
+            )
+            try:
+                while not stop.wait(interval):
+                    try:
+                        queue.renew(items)
+                    except sqlite3.Error as e:
+                        logger.warning(f"Could not renew the lease of {items}: {e}")
+            finally:
+                queue.close()
+
+        thread = threading.Thread(target=renew, name="heartbeat", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def retry_failed(self) -> int:
+        """Returns all failed items to the queue with their attempts reset."""
+        cursor = self.con.execute(
+            f"UPDATE {_quote(self.name)} SET status = '{PENDING}', attempts = 0, "
+            f"updated = ? WHERE status = '{FAILED}'",
+            (time.time(),),
+        )
+        return cursor.rowcount
+
+    def progress(self) -> dict:
+        """Returns the number of items in each state (and in total)."""
+        counts = {PENDING: 0, CLAIMED: 0, DONE: 0, FAILED: 0}
+        counts.update(self.con.execute(
+            f"SELECT status, COUNT(*) FROM {_quote(self.name)} GROUP BY status"
+        ).fetchall())
+        counts["total"] = sum(counts.values())
+        return counts
+
+    def __iter__(self):
+        """Claims and yields items one at a time until the queue is empty.
+
+        The caller must complete, fail or release each item.
+        """
+        while True:
+            items = self.claim()
+            if not items:
+                return
+            yield items[0]
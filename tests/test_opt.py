@@ -0,0 +1,55 @@
+#! /usr/bin/env python
+"""Tests of the optimiser."""
+
+# Local imports
+from src import trace
+from src.opt import Optimiser
+from src.checkpoint import load_state
+
+PARAMS = {"left_ventricle": {"emax": [0.25, 0.75, 0.5]}}
+INPUTS = {"generic_params": {"ncycle": 2}}
+
+
+def test_checkpoint_with_tracing(tmp_path, monkeypatch):
+    """Checkpoints are written and resumed from while tracing is enabled."""
+    # Keeps the variables set by trace.enable from leaking into other tests
+    monkeypatch.delenv("CL0_TRACE", raising=False)
+    monkeypatch.delenv("CL0_TRACE_OWNER", raising=False)
+    checkpoint = str(tmp_path / "run.opt")
+    trace.enable(str(tmp_path / "trace.json"))
+    try:
+        opt = Optimiser(
+            optimiser="RandomSearch", inputs=INPUTS, params=PARAMS,
+            budget=4, pbar=False, checkpoint=checkpoint, checkpoint_every=2,
+        )
+        opt.run(sbp=120)
+        assert load_state(checkpoint)["optimiser"].num_tell == 4
+
+        # The traced ask and tell are kept after checkpointing and restored
+        # after resuming
+        assert "ask" in vars(opt.optimiser)
+        resumed = Optimiser(
+            optimiser="RandomSearch", inputs=INPUTS, params=PARAMS,
+            budget=4, pbar=False, checkpoint=checkpoint,
+        )
+        assert resumed.optimiser.num_tell == 4
+        assert "tell" in vars(resumed.optimiser)
+    finally:
+        trace.disable()
+
+
+def test_resume_with_new_budget(tmp_path):
+    """A budget passed when resuming replaces that of the checkpoint."""
+    checkpoint = str(tmp_path / "run.opt")
+    opt = Optimiser(
+        optimiser="RandomSearch", inputs=INPUTS, params=PARAMS,
+        budget=3, pbar=False, checkpoint=checkpoint,
+    )
+    opt.run(sbp=120)
+
+    resumed = Optimiser(
+        optimiser="RandomSearch", inputs=INPUTS, params=PARAMS,
+        budget=6, pbar=False, checkpoint=checkpoint,
+    )
+    resumed.run(sbp=120)
+    assert resumed.optimiser.num_tell == 6
@@ -0,0 +1,37 @@
+#! /usr/bin/env python
+"""Tests of the SQLite results sink."""
+
+# Python imports
+import pytest
+
+# Local imports
+from src.sink import ResultsSink
+
+
+@pytest.mark.parametrize("process", [False, True])
+def test_flush_raises_on_write_error(tmp_path, process):
+    """A failed write makes flush raise instead of waiting forever."""
+    sink = ResultsSink(
+        str(tmp_path / "results.db"), "results", batch_size=2, process=process,
+    )
+    # Lists cannot be stored by SQLite, so the first batch fails to write
+    sink.put_many([{"a": [1, 2]}, {"a": 3}, {"a": 4}, {"a": 5}])
+    with pytest.raises(RuntimeError):
+        sink.flush()
+    try:
+        sink.close()
+    except RuntimeError:
+        pass
+
+
+def test_flush_writes_rows(tmp_path):
+    """Rows are committed by the time flush returns."""
+    import sqlite3
+
+    db_path = str(tmp_path / "results.db")
+    with ResultsSink(db_path, "results", batch_size=2) as sink:
+        sink.put_many([{"a": i, "b": 0.5 * i} for i in range(5)])
+        sink.flush()
+        con = sqlite3.connect(db_path)
+        assert con.execute("SELECT COUNT(*) FROM results").fetchone()[0] == 5
+        con.close()
@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+"""Tests of the supervised worker processes."""
+
+# Python imports
+import os
+import time
+
+# Module imports
+import pytest
+
+# Local imports
+from src.supervisor import Supervisor, TaskTimeout, WorkerDied
+
+
+def _task(action: str, value=None):
+    """Task run by the workers, returns, sleeps, raises or exits."""
+    if action == "sleep":
+        time.sleep(value)
+    elif action == "raise":
+        raise ValueError(value)
+    elif action == "exit":
+        os._exit(value)
+    return value
+
+
+def test_results():
+    """Tasks return their results in their futures."""
+    with Supervisor(_task, num_workers=2) as supervisor:
+        futures = [supervisor.submit("return", i) for i in range(10)]
+        assert [f.result(timeout=30) for f in futures] == list(range(10))
+    assert supervisor.completed == 10
+    assert supervisor.failed == 0
+    assert supervisor.restarts == 0
+
+
+def test_task_exception():
+    """A task that raises fails with its exception and keeps its worker."""
+    with Supervisor(_task, num_workers=1) as supervisor:
+        with pytest.raises(ValueError, match="bad input"):
+            supervisor.submit("raise", "bad input").result(timeout=30)
+        assert supervisor.submit("return", 1).result(timeout=30) == 1
+    assert supervisor.completed == 1
+    assert supervisor.failed == 1
+    assert supervisor.restarts == 0
+
+
+def test_timeout_replaces_worker():
+    """A task that runs past the timeout is killed and its worker replaced."""
+    with Supervisor(_task, num_workers=1, timeout=0.5) as supervisor:
+        pid = supervisor._workers[0].process.pid
+        start = time.monotonic()
+        with pytest.raises(TaskTimeout):
+            supervisor.submit("sleep", 30).result(timeout=30)
+        assert time.monotonic() - start < 10
+
+        # The new worker runs the next task
+        assert supervisor.submit("return", 2).result(timeout=30) == 2
+        assert supervisor._workers[0].process.pid != pid
+    assert supervisor.timeouts == 1
+    assert supervisor.restarts == 1
+    assert supervisor.failed == 1
+    assert supervisor.completed == 1
+
+
+def test_worker_exit_replaces_worker():
+    """A worker that exits mid task fails it with WorkerDied and is replaced."""
+    with Supervisor(_task, num_workers=1) as supervisor:
+        with pytest.raises(WorkerDied, match="code 3"):
+            supervisor.submit("exit", 3).result(timeout=30)
+        assert supervisor.submit("return", 4).result(timeout=30) == 4
+        assert len(supervisor._workers) == 1
+    assert supervisor.timeouts == 0
+    assert supervisor.restarts == 1
+    assert supervisor.failed == 1
+    assert supervisor.completed == 1
+
+
+def test_shutdown_cancels_pending():
+    """shutdown(cancel=True) cancels queued tasks and finishes running ones."""
+    supervisor = Supervisor(_task, num_workers=1)
+    running = supervisor.submit("sleep", 0.5)
+    while not running.running():
+        time.sleep(0.01)
+    pending = [supervisor.submit("return", i) for i in range(3)]
+
+    supervisor.shutdown(cancel=True)
+    assert running.result(timeout=30) == 0.5
+    assert all(f.cancelled() for f in pending)
+    assert supervisor.completed == 1
+    assert not any(w.process.is_alive() for w in supervisor._workers)
+
+    with pytest.raises(RuntimeError):
+        supervisor.submit("return", 5)
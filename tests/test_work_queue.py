@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+"""Tests of the shared SQLite work queue."""
+
+# Python imports
+import time
+import threading
+
+# Local imports
+from src.work_queue import WorkQueue, CLAIMED, DONE, FAILED, PENDING
+
+
+def test_concurrent_claims_are_unique(tmp_path):
+    """Workers on separate connections never claim the same item."""
+    db_path = str(tmp_path / "queue.db")
+    with WorkQueue(db_path) as queue:
+        queue.add(range(200))
+
+    claimed = {}
+    start = threading.Barrier(2)
+
+    def work(name):
+        # Each worker has its own connection, as on separate nodes
+        with WorkQueue(db_path, worker=name) as queue:
+            claimed[name] = []
+            start.wait()
+            while True:
+                items = queue.claim(3)
+                if not items:
+                    return
+                claimed[name].extend(items)
+                time.sleep(0.005)
+                queue.complete(items)
+
+    threads = [threading.Thread(target=work, args=(f"w{i}",)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    items = claimed["w0"] + claimed["w1"]
+    assert sorted(items) == list(range(200))
+    assert claimed["w0"] and claimed["w1"]
+    with WorkQueue(db_path) as queue:
+        assert queue.progress()[DONE] == 200
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    """An item whose lease expires is claimed again by another worker."""
+    db_path = str(tmp_path / "queue.db")
+    first = WorkQueue(db_path, lease=0.1, worker="first")
+    second = WorkQueue(db_path, lease=0.1, worker="second")
+    first.add([1])
+
+    assert first.claim() == [1]
+    assert second.claim() == []
+    time.sleep(0.2)
+    assert second.claim() == [1]
+
+    # The first worker no longer holds the item
+    assert first.complete([1]) == 0
+    assert second.complete([1]) == 1
+    first.close()
+    second.close()
+
+
+def test_heartbeat_keeps_lease(tmp_path):
+    """Items worked on inside heartbeat are not reclaimed."""
+    db_path = str(tmp_path / "queue.db")
+    first = WorkQueue(db_path, lease=0.3, worker="first")
+    second = WorkQueue(db_path, lease=0.3, worker="second")
+    first.add([1])
+
+    item = first.claim()[0]
+    with first.heartbeat([item], interval=0.05):
+        time.sleep(0.8)
+        assert second.claim() == []
+        assert first.progress()[CLAIMED] == 1
+    assert first.complete([item]) == 1
+    first.close()
+    second.close()
+
+
+def test_max_attempts_fails_item(tmp_path):
+    """An item is marked as failed once it has failed max_attempts times."""
+    with WorkQueue(str(tmp_path / "queue.db"), max_attempts=2) as queue:
+        queue.add([1])
+
+        assert queue.claim() == [1]
+        queue.fail([1], "first")
+        assert queue.progress()[PENDING] == 1
+
+        assert queue.claim() == [1]
+        queue.fail([1], "second")
+        assert queue.progress()[FAILED] == 1
+        assert queue.claim() == []
+
+        assert queue.retry_failed() == 1
+        assert queue.claim() == [1]
+
+
+def test_expired_leases_count_as_attempts(tmp_path):
+    """Items whose lease keeps expiring are eventually failed."""
+    with WorkQueue(str(tmp_path / "queue.db"), lease=0.05, max_attempts=2) as queue:
+        queue.add([1])
+        assert queue.claim() == [1]
+        time.sleep(0.1)
+        assert queue.claim() == [1]
+        time.sleep(0.1)
+        assert queue.claim() == []
+        assert queue.progress()[FAILED] == 1